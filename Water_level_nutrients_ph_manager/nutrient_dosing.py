@@ -0,0 +1,171 @@
+import math
+
+from utilities import clock
+
+# Learned nutrient dosing: instead of running every nutrient pump for its fixed time and measuring again until
+# the target is reached, dose_nutrients asks a NutrientResponseModel how long to run each pump to cover the whole
+# gap in one pass. The model learns, for every pump, how many ppm one second of that pump adds to one inch of
+# water in the reservoir (the ppm gained is inversely proportional to the volume, which the eTape level measures).
+# It can start from the rates the calibrated flow of the pumps and the strength of the concentrate give (see
+# calibrated_rates), the passes sized from such rates cover only part of the gap until a reading confirms them.
+
+
+def calibrated_rates(flow_rates, stock_mg_per_ml, liters_per_inch, pump_names):
+    """
+    Return the expected rate (ppm per second for one inch of water) of each pump.
+
+    Args:
+        flow_rates: Pump name -> mL per second (DoseLedger.flow_rates).
+        stock_mg_per_ml: Nutrients (mg) in one mL of the concentrate.
+        liters_per_inch: Liters of water per inch of water level.
+        pump_names: Nutrient pumps to give a rate to, the pumps without a flow rate get none.
+    """
+    # One second adds flow mL of concentrate, stock_mg_per_ml mg each, to level * liters_per_inch liters (ppm = mg/L)
+    return {name: flow_rates[name] * stock_mg_per_ml / liters_per_inch
+            for name in pump_names if flow_rates.get(name, 0.0) > 0}
+
+
+class NutrientResponseModel:
+    """
+    Online estimate of the ppm response of each nutrient pump.
+
+    The rates are fitted with a normalized least mean squares update on every pass: the ppm change seen after
+    the pass is compared with the change predicted from the run time of each pump and the water level, and the
+    difference is shared between the pumps in proportion to their contribution. Without initial rates, the first
+    pass uses the configured run times as a probe and gives every pump the same rate. Initial rates are only
+    estimates, until a pass has measured them a pass covers unconfirmed_share of the gap, so a concentrate up to
+    twice as strong as configured still does not overshoot.
+
+    Dosed nutrients take a while to blend into the reservoir, so the reading after a pass only shows part of it.
+    The model assumes each dose blends in exponentially with the mix_time time constant: it uses that to learn
+    the full effect of a dose from the part already visible, and it subtracts what is still blending in from the
+    gap before sizing the next pass, so the same gap is never dosed twice.
+    """
+
+    def __init__(self, aggressiveness=0.95, mix_time=20.0, learning_rate=0.5, max_scale=20.0, min_pulse=0.1,
+                 initial_rates=None, unconfirmed_share=0.5):
+        """
+        Args:
+            aggressiveness: Share of the ppm gap covered by each pass (below 1 avoids overshooting, which can
+                only be undone by adding water).
+            mix_time: Time constant (seconds) of the blending of a dose into the reservoir.
+            learning_rate: Share of the prediction error corrected at each pass once a pump has a rate.
+            max_scale: Longest pass allowed, as a multiple of the configured run time of each pump.
+            min_pulse: Shortest run time of a pump (seconds).
+            initial_rates: Pump name -> expected rate to start from (see calibrated_rates), learned from a probe
+                pass if None.
+            unconfirmed_share: Share of the ppm gap covered by a pass while a pump of it runs on its initial rate.
+        """
+        self.aggressiveness = aggressiveness
+        self.mix_time = mix_time
+        self.learning_rate = learning_rate
+        self.max_scale = max_scale
+        self.min_pulse = min_pulse
+        # pump name -> ppm gained per second of the pump for one inch of water
+        self.rates = dict(initial_rates or {})
+        # Pumps whose rate was measured by at least one pass
+        self.confirmed = set()
+        self.unconfirmed_share = unconfirmed_share
+        # (clock time, pump name, seconds per inch of water) of the doses given since the last reading
+        self._new_doses = []
+        # (clock time, ppm) of the doses that may still be blending in
+        self._blending = []
+        # Clock time of the reading the last plan was made from
+        self._planned_at = None
+
+    def reset(self):
+        # Dosing runs are far apart, whatever was dosed before is blended in by now
+        self._new_doses = []
+        self._blending = []
+
+    def _visible(self, dose_time, now):
+        """Share of a dose given at dose_time that has blended in at now."""
+        if self.mix_time <= 0:
+            return 1.0
+        return 1 - math.exp(-max(0.0, now - dose_time) / self.mix_time)
+
+    def pending(self, now=None):
+        """Return the ppm dosed but not blended in yet."""
+        now = clock.monotonic() if now is None else now
+        return sum(ppm * (1 - self._visible(dose_time, now)) for dose_time, ppm in self._blending)
+
+    def predict(self, doses, level):
+        """Return the ppm the given [(pump, seconds)] doses add once mixed in, None if a pump has no rate yet."""
+        level = max(level, 0.1)
+        change = 0.0
+        for pump, seconds in doses:
+            if pump.name not in self.rates:
+                return None
+            change += self.rates[pump.name] * seconds / level
+        return change
+
+    def plan(self, current_ppm, target_ppm, level, pump_info, tolerance=0.0):
+        """
+        Return the [(pump, seconds)] doses of the next pass, an empty list to wait for the last pass to blend in.
+
+        Args:
+            current_ppm: ppm measured now.
+            target_ppm: ppm to reach.
+            level: Water level (inches).
+            pump_info: [(pump, configured seconds)] of the plant, the recipe whose proportions are kept.
+            tolerance: Gap (ppm) small enough to be left to what is still blending in.
+        """
+        self._planned_at = clock.monotonic()
+        gap = target_ppm - current_ppm - self.pending(self._planned_at)
+        if gap <= tolerance:
+            return []
+        per_pass = self.predict(pump_info, level)
+        if not per_pass:
+            return list(pump_info)
+        share = self.aggressiveness
+        if any(pump.name not in self.confirmed for pump, seconds in pump_info if seconds > 0):
+            share = min(share, self.unconfirmed_share)
+        scale = min(self.max_scale, share * gap / per_pass)
+        return [(pump, max(self.min_pulse, seconds * scale)) for pump, seconds in pump_info if seconds > 0]
+
+    def dosed(self, pump, seconds, level):
+        """Record a dose, call it right after the pump stopped."""
+        # The dose is spread over the run of the pump, count it as given in the middle of the run
+        self._new_doses.append((clock.monotonic() - seconds / 2, pump.name, seconds / max(level, 0.1)))
+
+    def observe(self, ppm_before, ppm_after, settled=False):
+        """
+        Learn from the ppm change between the reading of the last plan and now.
+
+        Args:
+            settled: True if the readings were seen to settle, everything dosed is then taken as blended in.
+        """
+        now = clock.monotonic()
+
+        def visible(dose_time):
+            return 1.0 if settled else self._visible(dose_time, now)
+        # Take out the part of the change that comes from the doses of the previous passes
+        change = ppm_after - ppm_before
+        earlier = 0.0
+        for dose_time, ppm in self._blending:
+            earlier += ppm * (visible(dose_time) - self._visible(dose_time, self._planned_at))
+        change -= earlier
+        inputs = [(name, value * visible(dose_time)) for dose_time, name, value in self._new_doses]
+        if inputs and not any(name in self.rates for name, _ in inputs):
+            # First pass: nothing tells the pumps apart yet, start them all at the same rate
+            total = sum(value for _, value in inputs)
+            for name, _ in inputs:
+                self.rates[name] = max(0.0, change / total) if total > 0 else 0.0
+        elif inputs:
+            predicted = sum(self.rates.get(name, 0.0) * value for name, value in inputs)
+            # A small pass next to a lot of earlier doses still blending in says little about the rates
+            confidence = predicted / (predicted + abs(earlier)) if predicted > 0 else 1.0
+            norm = sum(value * value for _, value in inputs)
+            step = self.learning_rate * confidence * (change - predicted) / norm
+            for name, value in inputs:
+                rate = self.rates.get(name, 0.0)
+                # One pass can at most halve or double a rate
+                updated = rate + step * value
+                self.rates[name] = min(2 * rate, max(rate / 2, updated)) if rate > 0 else max(0.0, updated)
+        self.confirmed.update(name for name, _ in inputs)
+        for dose_time, name, value in self._new_doses:
+            self._blending.append((dose_time, self.rates.get(name, 0.0) * value))
+        self._new_doses = []
+        # Forget the doses that are blended in
+        self._blending = [(dose_time, ppm) for dose_time, ppm in self._blending
+                          if not settled and now - dose_time < 5 * self.mix_time]
@@ -0,0 +1,138 @@
+from user_controlled_constants import (PUMP_CURRENTS, DRIVER_CURRENT_BUDGET, PUMP_SUPPLY_POWER_BUDGET,
+                                      PUMP_SUPPLY_VOLTAGE, NUTRIENT_EXCLUSION_GROUPS, NUTRIENT_EXCLUSION_GAP,
+                                      WATER_PUMP_POSITION, NUTRIENT_PUMP1_POSITION, NUTRIENT_PUMP2_POSITION,
+                                      NUTRIENT_PUMP3_POSITION, NUTRIENT_PUMP4_POSITION, PH_UP_PUMP_POSITION,
+                                      PH_DOWN_PUMP_POSITION)
+from utilities import clock, tracing
+
+# Parallel dosing: a dosing pass used to run the nutrient pumps one after the other, so it lasted the sum of their
+# run times. The pumps sit on two motor driver boards and can run together, as long as the pumps running at the
+# same time stay within the current each board can deliver and the power of the supply, and pumps that must not
+# meet (the A and B parts of a nutrient) take turns. A DosePlanner turns the doses of a pass into a timetable
+# respecting those constraints, and run_plan() starts and stops the pumps on it from the calling thread.
+
+# Motor driver board of each pump, from its position ('driver0.motor4')
+PUMP_DRIVERS = {name: position.split('.')[0] for name, position in (
+    ('fresh_water', WATER_PUMP_POSITION), ('nutrient1', NUTRIENT_PUMP1_POSITION),
+    ('nutrient2', NUTRIENT_PUMP2_POSITION), ('nutrient3', NUTRIENT_PUMP3_POSITION),
+    ('nutrient4', NUTRIENT_PUMP4_POSITION), ('ph_up', PH_UP_PUMP_POSITION), ('ph_down', PH_DOWN_PUMP_POSITION))}
+
+
+class DosePlanner:
+    """
+    Schedule the doses of a pass so they run together within the current budgets.
+
+    Whenever a pump stops (or an exclusion gap ends), the doses still waiting are started longest first, each one
+    as soon as it fits in the budgets; a dose that does not fit even alone still runs, alone.
+    """
+
+    def __init__(self, currents=PUMP_CURRENTS, driver_budget=DRIVER_CURRENT_BUDGET,
+                 power_budget=PUMP_SUPPLY_POWER_BUDGET, voltage=PUMP_SUPPLY_VOLTAGE,
+                 exclusion_groups=NUTRIENT_EXCLUSION_GROUPS, gap=NUTRIENT_EXCLUSION_GAP):
+        """
+        Args:
+            currents: Pump name -> current (amps) it draws while running.
+            driver_budget: Largest current (amps) of the pumps running at once on one driver board.
+            power_budget: Largest power (watts) of the pumps running at once.
+            voltage: Voltage of the pump supply, to turn the power budget into a current.
+            exclusion_groups: Groups of pump names never running at the same time, in the order of the recipe.
+            gap: Shortest time (seconds) between the end of a pump of a group and the start of the next one.
+        """
+        self.currents = currents
+        self.driver_budget = driver_budget
+        self.current_budget = power_budget / voltage
+        self.gap = gap
+        # Pump name -> index of its exclusion group
+        self.group_of = {name: index for index, group in enumerate(exclusion_groups) for name in group}
+
+    def _fits(self, pump, running):
+        current = self.currents.get(pump.name, 0.0)
+        total = current + sum(self.currents.get(other.name, 0.0) for _, other in running)
+        driver = PUMP_DRIVERS.get(pump.name)
+        on_driver = current + sum(self.currents.get(other.name, 0.0) for _, other in running
+                                  if PUMP_DRIVERS.get(other.name) == driver)
+        # A small margin so budgets exactly filled (3 x 0.4 A on a 1.2 A board) are not refused by rounding
+        return total <= self.current_budget + 1e-9 and on_driver <= self.driver_budget + 1e-9
+
+    def plan(self, doses):
+        """
+        Args:
+            doses: [(pump, seconds)] in the order of the recipe.
+
+        Returns:
+            list: [(start, pump, seconds)] with start the offset (seconds) from the beginning of the pass, sorted by
+                start. The pass lasts max(start + seconds).
+        """
+        pending = [(index, pump, seconds) for index, (pump, seconds) in enumerate(doses) if seconds > 0]
+        # (end, pump) of the doses running at `now`
+        running = []
+        # Exclusion group index -> time its next pump may start
+        group_free = {}
+        plan = []
+        now = 0.0
+        while pending:
+            for entry in sorted(pending, key=lambda dose: (-dose[2], dose[0])):
+                index, pump, seconds = entry
+                if any(other is pump for _, other in running) or (running and not self._fits(pump, running)):
+                    continue
+                group = self.group_of.get(pump.name)
+                if group is not None:
+                    # The pumps of a group take turns in the order of the recipe
+                    if group_free.get(group, 0.0) > now or any(
+                            other_index < index and self.group_of.get(other.name) == group
+                            for other_index, other, _ in pending):
+                        continue
+                    group_free[group] = now + seconds + self.gap
+                running.append((now + seconds, pump))
+                plan.append((now, pump, seconds))
+                pending.remove(entry)
+            if not pending:
+                break
+            # Move on to the next time something can change: a pump stopping or an exclusion gap ending
+            now = min([end for end, _ in running] + [free for free in group_free.values() if free > now])
+            running = [(end, pump) for end, pump in running if end > now]
+        return plan
+
+
+def run_plan(plan, dosed=None):
+    """
+    Start and stop the pumps at the times of a DosePlanner plan, every pump is stopped if anything goes wrong.
+
+    Args:
+        plan: [(start, pump, seconds)] from DosePlanner.plan().
+        dosed: Called as dosed(pump, seconds) right after each pump stopped.
+    """
+    # Stops before starts at the same time, so a budget freed by a pump is free when the next one starts
+    events = sorted([(start, 1, pump, seconds) for start, pump, seconds in plan] +
+                    [(start + seconds, 0, pump, seconds) for start, pump, seconds in plan],
+                    key=lambda event: (event[0], event[1]))
+    begin = clock.monotonic()
+    running = []
+    try:
+        for at, is_start, pump, seconds in events:
+            clock.sleep(begin + at - clock.monotonic())
+            if is_start:
+                pump.start()
+                running.append(pump)
+            else:
+                pump.stop()
+                running.remove(pump)
+                if dosed is not None:
+                    dosed(pump, seconds)
+    finally:
+        for pump in running:
+            pump.stop()
+
+
+@tracing.traced()
+def run_doses(doses, dosed=None, planner=None):
+    """
+    Run the doses of a pass [(pump, seconds)] together, within the budgets of planner (a DosePlanner with the
+    settings of user_controlled_constants.py by default).
+
+    Returns:
+        float: Duration of the pass (seconds).
+    """
+    plan = (planner or DosePlanner()).plan(doses)
+    run_plan(plan, dosed)
+    return max([start + seconds for start, _, seconds in plan] or [0.0])
@@ -0,0 +1,182 @@
+# pH controllers decide how long the pH up or pH down pump runs at each cycle of the balancing loop
+# (see run_ph_controller in ph_management.py). They all work in pump seconds:
+# - next_pulse() returns a signed run time, positive for the pH up pump and negative for the pH down pump,
+# - observe() is called after each pulse with the pH before and after it, so a controller can learn how the
+#   reservoir responds.
+# The response of the reservoir (pH change per second of pump) is the acid flow of the pump divided by the buffer
+# capacity of the water, which grows with the volume and the nutrient content, so it changes over time.
+
+
+class PHController:
+    """Base class of the pH controllers, subclasses implement next_pulse() and may implement observe()."""
+
+    # Shortest and longest pulse (seconds) a controller may ask for
+    MIN_PULSE = 0.05
+    MAX_PULSE = 2.0
+
+    def __init__(self, min_pulse=None, max_pulse=None):
+        self.min_pulse = self.MIN_PULSE if min_pulse is None else min_pulse
+        self.max_pulse = self.MAX_PULSE if max_pulse is None else max_pulse
+
+    def next_pulse(self, ph, target_ph, ph_dosing_time):
+        """
+        Args:
+            ph: Current pH.
+            target_ph: pH to reach.
+            ph_dosing_time: [PH_UP_SLEEP_TIME, PH_DOWN_SLEEP_TIME, LOOP_SLEEP_TIME] of the plant.
+
+        Returns:
+            float: Seconds to run the pH up pump (positive) or the pH down pump (negative).
+        """
+        raise NotImplementedError
+
+    def observe(self, pulse, ph_before, ph_after, mixed=None):
+        """
+        Learn from the pH change that followed a pulse.
+
+        Args:
+            mixed: Share of the doses given so far that is mixed in by the ph_after reading, 1 when the readings
+                were seen to settle, None if unknown.
+        """
+
+    def reset(self):
+        """Forget the state built during a balancing run (called when a new run starts)."""
+
+    def clamp(self, pulse):
+        """Limit the run time of a pulse to [min_pulse, max_pulse], keeping its sign."""
+        run_time = min(self.max_pulse, max(self.min_pulse, abs(pulse)))
+        return run_time if pulse > 0 else -run_time
+
+
+class BangBangController(PHController):
+    """The original behaviour: the same fixed pulse (PH_UP_SLEEP_TIME or PH_DOWN_SLEEP_TIME) every cycle."""
+
+    def next_pulse(self, ph, target_ph, ph_dosing_time):
+        return ph_dosing_time[0] if ph < target_ph else -ph_dosing_time[1]
+
+
+class PIDController(PHController):
+    """
+    Pulse proportional to the pH error, plus an integral term that grows while the error persists and a
+    derivative term that slows down the pulses while the pH is already moving towards the target.
+
+    The gains are in pump seconds per pH unit (per cycle for the integral term).
+    """
+
+    def __init__(self, kp=3.0, ki=0.3, kd=0.0, min_pulse=None, max_pulse=None):
+        super().__init__(min_pulse, max_pulse)
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def next_pulse(self, ph, target_ph, ph_dosing_time):
+        error = target_ph - ph
+        if self.last_error is not None and (error > 0) != (self.last_error > 0):
+            # Crossed the target, the accumulated integral would now push the wrong way
+            self.integral = 0.0
+        derivative = 0.0 if self.last_error is None else error - self.last_error
+        self.last_error = error
+        pulse = self.kp * error + self.ki * (self.integral + error) + self.kd * derivative
+        # Anti-windup: only integrate while the pulse is not saturated
+        if abs(pulse) < self.max_pulse:
+            self.integral += error
+        if pulse == 0 or (pulse > 0) != (error > 0):
+            # Never dose against the error, fall back to the smallest pulse in the right direction
+            pulse = error
+        return self.clamp(pulse)
+
+
+class TitrationController(PHController):
+    """
+    Size each pulse from an online estimate of the titration curve of the reservoir.
+
+    The pH change per pump second is estimated separately for the pH up and the pH down pumps (their solutions
+    differ), with older observations slowly forgotten as the buffer capacity changes with the nutrients and the
+    volume. Until a pump was observed, the configured pulse of the plant is used as a probe.
+
+    A dose does not show up at once: only part of it is mixed in by the next reading (mixed_share, unless the
+    readings were seen to settle), the rest keeps moving the pH over the following cycles. The controller keeps
+    track of that pending change, takes it into account when it learns the gain, and subtracts it from the error
+    before sizing the next pulse (a zero pulse means waiting one more cycle for the last dose to mix in).
+    """
+
+    def __init__(self, aggressiveness=0.9, forgetting=0.7, mixed_share=0.5, min_pulse=None, max_pulse=None):
+        """
+        Args:
+            aggressiveness: Share of the remaining error corrected by each pulse (below 1 avoids overshooting).
+            forgetting: Weight kept by past observations at each new one (0 uses only the last pulse).
+            mixed_share: Share of what is still mixing in that shows up at each reading.
+            min_pulse: Shortest pulse (seconds).
+            max_pulse: Longest pulse (seconds).
+        """
+        super().__init__(min_pulse, max_pulse)
+        self.aggressiveness = aggressiveness
+        self.forgetting = forgetting
+        self.mixed_share = mixed_share
+        # Weighted sums of pulse seconds and pH changes for the up (+1) and down (-1) pumps, kept between runs
+        self._pulse_sums = {1: 0.0, -1: 0.0}
+        self._change_sums = {1: 0.0, -1: 0.0}
+        self.pending = 0.0
+
+    def reset(self):
+        # Balancing runs are far apart, whatever was dosed before is mixed in by now
+        self.pending = 0.0
+
+    def gain(self, direction):
+        """
+        Return the estimated pH change per second of the pH up (direction 1) or pH down (direction -1) pump,
+        None before the pump was observed.
+        """
+        if self._pulse_sums[direction] <= 0 or self._change_sums[direction] <= 0:
+            return None
+        return self._change_sums[direction] / self._pulse_sums[direction]
+
+    def next_pulse(self, ph, target_ph, ph_dosing_time):
+        direction = 1 if ph < target_ph else -1
+        # Error left once what is still mixing in has shown up
+        error = (target_ph - ph - self.pending) * direction
+        if error <= 0:
+            return 0.0
+        gain = self.gain(direction)
+        if gain is None:
+            return ph_dosing_time[0] if direction > 0 else -ph_dosing_time[1]
+        pulse = self.aggressiveness * error / gain
+        if pulse < self.min_pulse / 2:
+            # Closer than half the smallest pulse can correct, wait for the pending change instead
+            return 0.0
+        return self.clamp(direction * pulse)
+
+    def observe(self, pulse, ph_before, ph_after, mixed=None):
+        mixed_share = self.mixed_share if mixed is None else mixed
+        change = ph_after - ph_before
+        if pulse != 0:
+            direction = 1 if pulse > 0 else -1
+            # The reading shows mixed_share of the pending change and of the new dose: solve for the new dose.
+            # Changes against the pump (drift, noise) count as no change, the estimate only uses positive sums.
+            dose_change = max(0.0, (change / mixed_share - self.pending) * direction)
+            self._pulse_sums[direction] = self._pulse_sums[direction] * self.forgetting + abs(pulse)
+            self._change_sums[direction] = self._change_sums[direction] * self.forgetting + dose_change
+            gain = self.gain(direction) or 0.0
+            self.pending += direction * gain * abs(pulse)
+        self.pending *= 1 - mixed_share
+
+
+# Names accepted by PH_CONTROLLER in user_controlled_constants.py
+PH_CONTROLLERS = {
+    'bang_bang': BangBangController,
+    'pid': PIDController,
+    'titration': TitrationController,
+}
+
+
+def make_ph_controller(name):
+    """Return a new controller from its name in PH_CONTROLLERS."""
+    try:
+        return PH_CONTROLLERS[name]()
+    except KeyError:
+        raise ValueError("Unknown pH controller %r, use one of %s" % (name, ', '.join(PH_CONTROLLERS)))
@@ -1,58 +1,87 @@
-from time import sleep
+import logging
 
-# Target pH values and limits
-from main import pHUpPump, pHDownPump
-from utilities.AtlasI2C import get_ph
+from file_operations.logging_config import RateLimitedLogger
+from user_controlled_constants import PH_TOLERANCE, SETTLE_DEAD_TIME
+from utilities import tracing
+from utilities.clock import sleep
+from utilities.AtlasI2C import get_ph, invalidate_readings
+from utilities.hardware import get_hardware
+from utilities.settling import wait_until_settled
 
+# Status lines of the balancing loop, at most one of each kind every LOG_RATE_LIMIT_INTERVAL seconds
+status_log = RateLimitedLogger(logging.getLogger(__name__))
 
-def balance_ph(target_min_max_ph, ph_dosing_time):
-    TARGET_PH = target_min_max_ph[0]
-    MIN_PH = target_min_max_ph[1]
-    MAX_PH = target_min_max_ph[2]
 
-    ph_up_sleep_time = ph_dosing_time[0]
-    ph_down_sleep_time = ph_dosing_time[1]
-    loop_sleep_time = ph_dosing_time[2]
+def run_ph_controller(target_ph, ph_dosing_time, controller=None, tolerance=PH_TOLERANCE):
+    """
+    Dose pH up or pH down until the pH reaches target_ph, each pulse sized by a pH controller.
 
-    if get_ph() < MIN_PH:  # Check if the current pH value is less than the minimum pH value
-        while get_ph() < TARGET_PH:  # Keep running the loop while the pH value is less than the target pH value
-            print("Increasing PH, PH: %f" % (
-                get_ph()))  # Print the current pH value and indicate that it's being increased
-            pHUpPump.start()  # Start the pH up pump
-            sleep(ph_up_sleep_time)  # Pause the program for 0.1 seconds
-            pHUpPump.stop()  # Stop the pH up pump
-            sleep(loop_sleep_time)  # Pause the program for 10 seconds
-        pHUpPump.stop()  # Stop the pH up pump when the pH value reaches the target value
-    elif get_ph() > MAX_PH:  # Check if the current pH value is greater than the maximum pH value
-        while get_ph() > TARGET_PH:  # Keep running the loop while the pH value is greater than the target pH value
-            print("Reducing PH, PH: %f" % (get_ph()))  # Print the current pH value and indicate that it's being reduced
-            pHDownPump.start()  # Start the pH down pump
-            sleep(ph_down_sleep_time)  # Pause the program for 0.1 seconds
-            pHDownPump.stop()  # Stop the pH down pump
-            sleep(loop_sleep_time)  # Pause the program for 10 seconds
-        pHDownPump.stop()  # Stop the pH down pump when the pH value reaches the target value
-
-
-def balance_PH_exact(target_min_max_ph, ph_dosing_time):
-    TARGET_PH = target_min_max_ph[0]
+    Args:
+        target_ph: pH to reach.
+        ph_dosing_time: [PH_UP_SLEEP_TIME, PH_DOWN_SLEEP_TIME, LOOP_SLEEP_TIME] of the plant.
+        controller: PHController sizing the pulses (see ph_controllers.py), the one of the hardware (chosen by
+            PH_CONTROLLER) if None.
+        tolerance: Stop once the pH is this close to the target (pH units), or once it crossed it.
 
-    ph_up_sleep_time = ph_dosing_time[0]
-    ph_down_sleep_time = ph_dosing_time[1]
+    Returns:
+        int: Number of pulses dosed.
+    """
+    if controller is None:
+        controller = get_hardware().ph_controller
+    controller.reset()
+    pHUpPump = get_hardware().ph_up_pump
+    pHDownPump = get_hardware().ph_down_pump
     loop_sleep_time = ph_dosing_time[2]
-    if get_ph() < TARGET_PH:  # Check if the current pH value is less than the target pH value
-        while get_ph() < TARGET_PH:  # Keep running the loop while the pH value is less than the target pH value
-            print("Increasing PH, PH: %f" % (
-                get_ph()))  # Print the current pH value and indicate that it's being increased
-            pHUpPump.start()  # Start the pH up pump
-            sleep(ph_up_sleep_time)  # Pause the program for PH_UP_SLEEP_TIME
-            pHUpPump.stop()  # Stop the pH up pump
-            sleep(loop_sleep_time)  # Pause the program for LOOP_SLEEP_TIME
-        pHUpPump.stop()  # Stop the pH up pump when the pH value reaches the target value
-    elif get_ph() > TARGET_PH:  # Check if the current pH value is greater than the target pH value
-        while get_ph() > TARGET_PH:  # Keep running the loop while the pH value is greater than the target pH value
-            print("Reducing PH, PH: %f" % (get_ph()))  # Print the current pH value and indicate that it's being reduced
-            pHDownPump.start()  # Start the pH down pump
-            sleep(ph_down_sleep_time)  # Pause the program for PH_DOWN_SLEEP_TIME
-            pHDownPump.stop()  # Stop the pH down pump
-            sleep(loop_sleep_time)  # Pause the program for LOOP_SLEEP_TIME
-        pHDownPump.stop()  # Stop the pH down pump when the pH value reaches the target value
+
+    current_ph = get_ph()  # Read the pH once per loop, the same value is used for the checks and the print
+    # Side of the target the pH started on, the loop ends when the pH gets to the other side
+    raising = current_ph < target_ph
+    pulses = 0
+    while abs(current_ph - target_ph) > tolerance and (current_ph < target_ph) == raising:
+        pulse = controller.next_pulse(current_ph, target_ph, ph_dosing_time)
+        if pulse > 0:
+            # Log the pH and that it is being increased
+            status_log.info("Increasing PH, PH: %f", current_ph, pump=pHUpPump.name, ph=current_ph,
+                            target=target_ph, seconds=pulse)
+        elif pulse < 0:
+            # Log the pH and that it is being reduced
+            status_log.info("Reducing PH, PH: %f", current_ph, pump=pHDownPump.name, ph=current_ph,
+                            target=target_ph, seconds=-pulse)
+        else:
+            status_log.info("Waiting for the last dose to mix in, PH: %f", current_ph, sensor='ph', ph=current_ph,
+                            target=target_ph)
+        if pulse:
+            pump = pHUpPump if pulse > 0 else pHDownPump
+            pump.start()  # Start the pH up or down pump
+            sleep(abs(pulse))  # Run it for the time chosen by the controller
+            pump.stop()  # Stop the pump
+            invalidate_readings()  # The last reading is outdated now that pH up or down was added
+            pulses += 1
+        # Wait for the pH to settle, LOOP_SLEEP_TIME at most, and after a pulse for the pH to move away from its
+        # reading before the pulse
+        settled = wait_until_settled(['ph'], loop_sleep_time, SETTLE_DEAD_TIME,
+                                     baselines={'ph': current_ph} if pulse else None)
+        previous_ph, current_ph = current_ph, get_ph()
+        controller.observe(pulse, previous_ph, current_ph, 1.0 if settled else None)
+    return pulses
+
+
+@tracing.traced()
+def balance_ph(target_min_max_ph, ph_dosing_time, controller=None):
+    MIN_PH = target_min_max_ph[0]
+    MAX_PH = target_min_max_ph[1]
+    # Aim for the middle of the range so the pH does not drift straight back out of it
+    TARGET_PH = (MIN_PH + MAX_PH) / 2
+
+    current_ph = get_ph()
+    # Only act once the pH left the range (soft limits), then bring it back to the middle
+    if current_ph < MIN_PH or current_ph > MAX_PH:
+        return run_ph_controller(TARGET_PH, ph_dosing_time, controller)
+    return 0
+
+
+@tracing.traced()
+def balance_PH_exact(target_min_max_ph, ph_dosing_time, controller=None):
+    TARGET_PH = target_min_max_ph[0]
+    # Bring the pH to the target whichever side of it it is on
+    return run_ph_controller(TARGET_PH, ph_dosing_time, controller)
@@ -0,0 +1,121 @@
+import logging
+import threading
+
+from utilities import clock
+from utilities.hardware import get_hardware, use_hardware
+from utilities.pumps import stop_pumps_list
+
+# Every plant profile runs in its own thread, so the dosing loop or the long sleep of one plant never holds up
+# the others. What the plants share is arbitrated where it is used:
+# - I2C transfers go through the locked bus manager (utilities/i2c_bus.py),
+# - an Atlas board is held for a whole command (AtlasI2C.lock),
+# - a pump belongs to the thread that started it until that thread stops it (Pump.lock),
+# - the state file store and the telemetry ring serialize their writes.
+# All those waits go through the package clock, so the plants also run side by side on a virtual clock.
+# Each plant has a reservoir with its own sensors and pumps (see PLANT_HARDWARE), only one plant may use the default
+# hardware: two plants sharing a reservoir would fill and dose it for two different targets.
+
+# Serializes the questions asked on the console (priming, starting targets) when several plants start at once
+console_lock = threading.Lock()
+
+
+class PlantTask(threading.Thread):
+    """One plant profile running its control function in a thread of its own."""
+
+    def __init__(self, plant_name, plant_params, run_function, stop_event, hardware=None):
+        """
+        Args:
+            plant_name: Name of the plant in the plant dictionary, also used for its state file.
+            plant_params: Settings of the plant (ph_settings, water_settings, nutrient_settings).
+            run_function: Called as run_function(plant_name, plant_params, stop_event), it should return soon
+                after stop_event is set.
+            stop_event: threading.Event set to ask the plant to stop.
+            hardware: Hardware context of the reservoir of this plant, the shared one if None.
+        """
+        super().__init__(name=plant_name, daemon=True)
+        self.plant_name = plant_name
+        self.plant_params = plant_params
+        self.run_function = run_function
+        self.stop_event = stop_event
+        self.hardware = hardware
+        # Exception that ended the task, if any
+        self.error = None
+        # A virtual clock must wait for this thread before moving on, register before the thread starts
+        self._clock = clock.get_clock()
+        self._clock.add_participant()
+
+    def run(self):
+        try:
+            with use_hardware(self.hardware or get_hardware()):
+                try:
+                    self.run_function(self.plant_name, self.plant_params, self.stop_event)
+                except Exception as error:
+                    self.error = error
+                    logging.error(f"Plant {self.plant_name} stopped after an error: {error}")
+                    # Never leave a pump of this plant running, pumps held by other plants are left alone
+                    stop_pumps_list([pump for pump in get_hardware().all_pumps
+                                     if pump.owner == threading.get_ident()])
+        finally:
+            self._clock.remove_participant()
+
+
+class MultiPlantController:
+    """Run several plant profiles at the same time, one PlantTask each."""
+
+    def __init__(self, plants, run_function, hardware_for_plant=None):
+        """
+        Args:
+            plants: Dictionary of plant name -> settings, like the plant dictionaries of user_controlled_constants.
+            run_function: Control function of one plant, see PlantTask.
+            hardware_for_plant: Function returning the hardware context of a plant from its name, None for the
+                plant using the default context. All the plants use the default context if None, which is only
+                allowed for a single plant.
+        """
+        self.plants = plants
+        self.run_function = run_function
+        self.hardware_for_plant = hardware_for_plant
+        self.stop_event = threading.Event()
+        self.tasks = []
+
+    def start(self):
+        """Start one thread per plant, ValueError if several plants would share the default hardware."""
+        hardware = {plant_name: self.hardware_for_plant(plant_name) if self.hardware_for_plant else None
+                    for plant_name in self.plants}
+        shared = [plant_name for plant_name, plant_hardware in hardware.items() if plant_hardware is None]
+        if len(shared) > 1:
+            raise ValueError("Plants %s would all drive the default reservoir, give all of them but one their own "
+                             "hardware in PLANT_HARDWARE" % ', '.join(shared))
+        for plant_name, plant_params in self.plants.items():
+            task = PlantTask(plant_name, plant_params, self.run_function, self.stop_event, hardware[plant_name])
+            self.tasks.append(task)
+        for task in self.tasks:
+            task.start()
+        return self
+
+    def stop(self):
+        """Ask every plant to stop after its current step."""
+        self.stop_event.set()
+
+    def emergency_stop(self):
+        """Stop every pump of every plant straight away, from any thread."""
+        self.stop()
+        for task in self.tasks:
+            stop_pumps_list((task.hardware or get_hardware()).all_pumps)
+
+    def join(self, timeout=None):
+        """
+        Wait for the plants to finish.
+
+        Args:
+            timeout: Maximum real time to wait for each plant (seconds), wait forever if None.
+
+        Returns:
+            bool: True if every plant has finished.
+        """
+        for task in self.tasks:
+            task.join(timeout)
+        return not any(task.is_alive() for task in self.tasks)
+
+    def errors(self):
+        """Return plant name -> exception for the plants that stopped on an error."""
+        return {task.plant_name: task.error for task in self.tasks if task.error is not None}
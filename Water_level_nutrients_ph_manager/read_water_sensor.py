@@ -1,28 +1,132 @@
-import math
+import statistics
+import threading
 
-from main import adc, GAIN
+from Water_level_nutrients_ph_manager.water_level_calibration import level_table
+from user_controlled_constants import (ADC_GAIN, WATER_LEVEL_OVERSAMPLING, WATER_LEVEL_SAMPLES, WATER_LEVEL_DATA_RATE,
+                                      WATER_LEVEL_FILTER, WATER_LEVEL_TRIM)
+from utilities import clock, metrics, tracing
+from utilities.hardware import get_hardware
 
-print('Reading ADS1x15 Values')
+ADC_READ_TIME = metrics.histogram('water_level_read_seconds', 'Time taken by a water level reading (ADC conversions).',
+                                  ['mode'])
 
 
+@tracing.traced(category='sensor')
 def get_water_level(a, b, c):
     """
     Calculate the water level using a liquid eTape sensor and the ADC.
 
+    The sensor/baseline ratio is converted with the lookup table of the water level calibration, a, b and c
+    (the quadratic curve ratio = a*level^2 + b*level + c) are only used while no calibration is saved.
+
+    With WATER_LEVEL_OVERSAMPLING set, the level is computed from a burst of samples (see WaterLevelSampler).
+
     Returns:
         float: Water level value.
     """
+    if WATER_LEVEL_OVERSAMPLING:
+        return get_hardware().water_level_sampler.read(a, b, c)
+
     # Read baseline and raw eTape sensor values from the ADC
-    baseline = adc.read_adc(1, gain=GAIN)
-    raw_val = adc.read_adc(0, gain=GAIN)
+    start = clock.monotonic()
+    adc = get_hardware().adc
+    baseline = adc.read_adc(1, gain=ADC_GAIN)
+    raw_val = adc.read_adc(0, gain=ADC_GAIN)
+    ADC_READ_TIME.labels('single').observe(clock.monotonic() - start)
+
+    # Convert the reading ratio with the calibration table (the quadratic curve until the reservoir is calibrated)
+    return level_table(a, b, c).to_level(raw_val / baseline)
+
+
+class WaterLevelSampler:
+    """
+    Oversampled water level readings.
+
+    Each reading runs the ADS1115 in continuous conversion mode on the baseline channel, then on the eTape
+    channel, collecting `samples` conversions of each into a preallocated buffer. The baseline is reduced to one
+    robust value, every eTape sample is converted to a level with the lookup table, and the levels are reduced with
+    a median or a trimmed mean, so one bad conversion no longer starts or stops a refill.
+
+    With NumPy installed the buffer is a NumPy array and the samples are converted in one vectorized lookup,
+    without it the same is done on lists.
+
+    A reading costs 2 * samples conversions, about 2 * samples / data_rate seconds (37 ms with the defaults).
+    """
+
+    # Conversion rates (samples per second) the ADS1115 supports
+    DATA_RATES = (8, 16, 32, 64, 128, 250, 475, 860)
 
-    # Calculate the reading ratio
-    reading = raw_val / baseline
+    def __init__(self, adc, samples=WATER_LEVEL_SAMPLES, data_rate=WATER_LEVEL_DATA_RATE,
+                 reduction=WATER_LEVEL_FILTER, trim=WATER_LEVEL_TRIM, gain=ADC_GAIN):
+        """
+        Args:
+            adc: ADS1115 (or anything with start_adc/get_last_result/stop_adc).
+            samples: Conversions per channel and per reading.
+            data_rate: ADS1115 conversion rate, one of DATA_RATES.
+            reduction: 'median', 'trimmed_mean' or 'mean'.
+            trim: Share of the samples dropped at each end by the trimmed mean.
+            gain: ADC gain.
+        """
+        if data_rate not in self.DATA_RATES:
+            raise ValueError("Unsupported ADS1115 data rate %r, use one of %s" % (data_rate, self.DATA_RATES))
+        if reduction not in ('median', 'trimmed_mean', 'mean'):
+            raise ValueError("Unknown water level filter %r" % reduction)
+        self.adc = adc
+        self.samples = samples
+        self.data_rate = data_rate
+        self.reduction = reduction
+        self.trim = trim
+        self.gain = gain
+        # Row 0 holds the baseline channel, row 1 the eTape channel
+        try:
+            import numpy
+        except ImportError:
+            self.numpy = None
+            self.buffer = [[0.0] * samples, [0.0] * samples]
+        else:
+            self.numpy = numpy
+            self.buffer = numpy.empty((2, samples))
+        # Continuous mode takes over the ADC, readings from several plant threads must not interleave
+        self.lock = threading.Lock()
+        # Spread of the levels of the last reading (inches), a large one points at a noisy sensor
+        self.last_spread = None
 
-    # Calculate the quadratic equation coefficient
-    c_2 = c - reading
+    def _collect(self, row, channel):
+        # The first result is returned by start_adc, the next ones are ready every 1 / data_rate seconds
+        values = self.buffer[row]
+        values[0] = self.adc.start_adc(channel, gain=self.gain, data_rate=self.data_rate)
+        try:
+            for index in range(1, self.samples):
+                clock.sleep(1.0 / self.data_rate)
+                values[index] = self.adc.get_last_result()
+        finally:
+            # Back to single shot mode, which also powers the converter down between readings
+            self.adc.stop_adc()
 
-    # Solve the quadratic equation to get the water level
-    water_level = ((-b) - math.sqrt(b * b - 4 * a * c_2)) / (2 * a)
+    def reduce(self, values):
+        """Reduce a 1-D array (or a list) of samples to one value with the configured filter."""
+        if self.reduction == 'median':
+            return float(statistics.median(values) if self.numpy is None else self.numpy.median(values))
+        if self.reduction == 'trimmed_mean':
+            cut = int(len(values) * self.trim)
+            values = sorted(values)[cut:len(values) - cut]
+        return float(statistics.mean(values) if self.numpy is None else self.numpy.mean(values))
 
-    return water_level
+    def read(self, a, b, c):
+        """Return the filtered water level (inches)."""
+        start = clock.monotonic()
+        clock.acquire(self.lock)
+        try:
+            self._collect(0, 1)
+            self._collect(1, 0)
+            baseline = self.reduce(self.buffer[0])
+            table = level_table(a, b, c)
+            if self.numpy is None:
+                levels = [table.to_level(value / baseline) for value in self.buffer[1]]
+            else:
+                levels = table.to_levels(self.buffer[1] / baseline)
+        finally:
+            self.lock.release()
+        ADC_READ_TIME.labels('oversampled').observe(clock.monotonic() - start)
+        self.last_spread = float(max(levels) - min(levels))
+        return self.reduce(levels)
@@ -0,0 +1,250 @@
+import functools
+import json
+import math
+import os
+import sys
+
+from file_operations.plant_vals_file_manager import BASE_DIRECTORY, atomic_write
+from user_controlled_constants import (ADC_GAIN, WATER_LEVEL_SAMPLES, WATER_LEVEL_TABLE_SIZE, WATER_LEVEL_MAX_LEVEL,
+                                      WATER_LEVEL_CALIBRATION_FILE)
+
+# Water level calibration: the eTape reads a sensor/baseline ratio that drops as the water rises. Instead of the
+# hand fitted QUADRATIC_COEFFICIENTS, a calibration records (ratio, inches) pairs measured on the reservoir, fits
+# a model to them and stores the model as a dense lookup table over evenly spaced ratios. Converting a ratio is
+# then an index computation and a linear interpolation, for one reading as well as for a NumPy array of them. Only
+# fitting a calibration and converting arrays need NumPy.
+
+CALIBRATION_PATH = os.path.join(BASE_DIRECTORY, WATER_LEVEL_CALIBRATION_FILE)
+# Version written in the calibration file
+CALIBRATION_FORMAT_VERSION = 1
+# Models WaterLevelCalibration.fit() knows
+CALIBRATION_MODELS = ('polynomial', 'piecewise')
+
+
+class LevelTable:
+    """
+    Dense ratio -> inches table over evenly spaced ratios.
+
+    Ratios outside the table are clamped to its ends, so a reading past the calibrated range reads as the lowest
+    or highest calibrated level.
+    """
+
+    def __init__(self, start, step, levels):
+        """
+        Args:
+            start: Ratio of the first entry.
+            step: Ratio between two entries (positive).
+            levels: Water level (inches) of each entry.
+        """
+        if step <= 0 or len(levels) < 2:
+            raise ValueError("A level table needs a positive step and at least two entries")
+        self.start = float(start)
+        self.step = float(step)
+        # Plain floats, a single reading is converted without NumPy (which costs more than the lookup for one value)
+        self.levels = [float(level) for level in levels]
+        self._last_index = len(self.levels) - 1
+        # NumPy copy of the levels for to_levels, made on its first use
+        self._level_array = None
+
+    @property
+    def end(self):
+        return self.start + self.step * self._last_index
+
+    def to_level(self, ratio):
+        """Return the water level (inches) of one ratio."""
+        position = (ratio - self.start) / self.step
+        if position <= 0:
+            return self.levels[0]
+        if position >= self._last_index:
+            return self.levels[-1]
+        index = int(position)
+        low = self.levels[index]
+        return low + (position - index) * (self.levels[index + 1] - low)
+
+    def to_levels(self, ratios):
+        """Return the water levels (inches) of a ratio or of an array of ratios, as a float or an array."""
+        import numpy
+        if numpy.ndim(ratios) == 0:
+            return self.to_level(float(ratios))
+        position = numpy.clip((numpy.asarray(ratios, dtype=float) - self.start) / self.step, 0, self._last_index)
+        index = numpy.minimum(position.astype(int), self._last_index - 1)
+        if self._level_array is None:
+            self._level_array = numpy.array(self.levels)
+        low = self._level_array[index]
+        return low + (position - index) * (self._level_array[index + 1] - low)
+
+    def to_dict(self):
+        return {'start': self.start, 'step': self.step, 'levels': self.levels}
+
+    @classmethod
+    def from_function(cls, function, low_ratio, high_ratio, size=WATER_LEVEL_TABLE_SIZE):
+        """Tabulate function (inches of a list of ratios) over [low_ratio, high_ratio]."""
+        step = (high_ratio - low_ratio) / (size - 1)
+        ratios = [low_ratio + step * index for index in range(size)]
+        return cls(low_ratio, step, function(ratios))
+
+
+@functools.lru_cache(maxsize=8)
+def quadratic_table(a, b, c, max_level=WATER_LEVEL_MAX_LEVEL, size=WATER_LEVEL_TABLE_SIZE):
+    """
+    Return the table of the original eTape curve, ratio = a*level^2 + b*level + c, from 0 to max_level inches.
+    Used until the reservoir is calibrated.
+    """
+    def levels(ratios):
+        # The root get_water_level used to compute for every reading, now computed once per table entry
+        return [((-b) - math.sqrt(max(0.0, b * b - 4 * a * (c - ratio)))) / (2 * a) for ratio in ratios]
+
+    ratio_at_max = a * max_level * max_level + b * max_level + c
+    return LevelTable.from_function(levels, min(c, ratio_at_max), max(c, ratio_at_max), size)
+
+
+class WaterLevelCalibration:
+    """
+    Measured (ratio, inches) pairs of one reservoir and the lookup table fitted to them.
+
+    Calibrate by reading the ratio at several known levels from empty to full, then fitting either a polynomial
+    (the ratio as a function of the level, degree 2 by default like QUADRATIC_COEFFICIENTS, a smooth curve that
+    averages out reading noise) or a piecewise linear model through the points (follows any shape of sensor,
+    needs more points).
+    """
+
+    def __init__(self, points=None, path=CALIBRATION_PATH):
+        """
+        Args:
+            points: [(ratio, inches)] already measured.
+            path: File the calibration is saved to.
+        """
+        self.points = [(float(ratio), float(inches)) for ratio, inches in points or []]
+        self.path = path
+        self.model = None
+        self.degree = None
+        self.table = None
+
+    def add_point(self, ratio, inches):
+        """Record the ratio read with the water at a known level."""
+        self.points.append((float(ratio), float(inches)))
+
+    def record_point(self, inches, samples=WATER_LEVEL_SAMPLES):
+        """
+        Read the ratio of the sensor now and record it for a water level measured by hand.
+
+        Returns:
+            float: The ratio recorded (the mean of `samples` readings).
+        """
+        from utilities.hardware import get_hardware
+        adc = get_hardware().adc
+        total = 0.0
+        for _ in range(samples):
+            total += adc.read_adc(0, gain=ADC_GAIN) / adc.read_adc(1, gain=ADC_GAIN)
+        ratio = total / samples
+        self.add_point(ratio, inches)
+        return ratio
+
+    def fit(self, model='polynomial', degree=2, size=WATER_LEVEL_TABLE_SIZE):
+        """
+        Fit a model to the points and build its table, over the range of ratios that was calibrated.
+
+        Returns:
+            LevelTable: The new table, also kept in self.table.
+        """
+        import numpy
+        if model not in CALIBRATION_MODELS:
+            raise ValueError("Unknown calibration model %r, use one of %s" % (model, ', '.join(CALIBRATION_MODELS)))
+        # Points read at the same ratio are averaged, the interpolation needs distinct increasing ratios
+        by_ratio = {}
+        for ratio, inches in self.points:
+            by_ratio.setdefault(ratio, []).append(inches)
+        ratios = numpy.array(sorted(by_ratio))
+        inches = numpy.array([sum(by_ratio[ratio]) / len(by_ratio[ratio]) for ratio in ratios])
+        needed = degree + 1 if model == 'polynomial' else 2
+        if len(ratios) < needed:
+            raise ValueError("The %s model needs at least %d calibration points, got %d"
+                             % (model, needed, len(ratios)))
+        if model == 'polynomial':
+            # Fitted the way the sensor is described, ratio as a polynomial of the level (the inverse has a steep
+            # root near empty that no low degree polynomial follows), then inverted on a dense grid of levels
+            curve = numpy.polynomial.Polynomial.fit(inches, ratios, degree)
+            dense_levels = numpy.linspace(inches.min(), inches.max(), size * 4)
+            dense_ratios = curve(dense_levels)
+            if numpy.any(numpy.diff(dense_ratios) >= 0):
+                raise ValueError("The fitted curve is not monotonic, use a lower degree or the piecewise model")
+            # numpy.interp needs increasing ratios, they decrease as the level rises
+            dense_ratios, dense_levels = dense_ratios[::-1], dense_levels[::-1]
+
+            def function(values):
+                return numpy.interp(values, dense_ratios, dense_levels)
+            low_ratio, high_ratio = dense_ratios[0], dense_ratios[-1]
+        else:
+            def function(values):
+                return numpy.interp(values, ratios, inches)
+            low_ratio, high_ratio = ratios[0], ratios[-1]
+        self.model = model
+        self.degree = degree if model == 'polynomial' else None
+        self.table = LevelTable.from_function(function, low_ratio, high_ratio, size)
+        return self.table
+
+    def to_dict(self):
+        return {'version': CALIBRATION_FORMAT_VERSION, 'model': self.model, 'degree': self.degree,
+                'points': self.points, 'table': self.table.to_dict() if self.table is not None else None}
+
+    def save(self):
+        """Write the points and the table to self.path (atomically, a half written table would be worse)."""
+        atomic_write(self.path, json.dumps(self.to_dict()))
+
+    @classmethod
+    def load(cls, path=CALIBRATION_PATH):
+        """Return the calibration saved at path, None if the reservoir was never calibrated."""
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        if data.get('version') != CALIBRATION_FORMAT_VERSION:
+            raise ValueError("Unsupported water level calibration file version %r in %s"
+                             % (data.get('version'), path))
+        calibration = cls(data['points'], path)
+        calibration.model = data['model']
+        calibration.degree = data['degree']
+        if data['table'] is not None:
+            table = data['table']
+            calibration.table = LevelTable(table['start'], table['step'], table['levels'])
+        return calibration
+
+
+def level_table(a, b, c):
+    """Return the table used to convert ratios: the calibrated one if any, else the table of the quadratic."""
+    from utilities.hardware import get_hardware
+    table = get_hardware().water_level_table
+    return table if table is not None else quadratic_table(a, b, c)
+
+
+def calibrate(model='polynomial', degree=2, plant=None):
+    """
+    Interactive calibration: record the ratio at levels measured by hand, then fit and save the table.
+
+    Args:
+        plant: Plant of PLANT_HARDWARE whose reservoir is calibrated, the default reservoir if None.
+    """
+    from utilities.hardware import get_hardware, plant_hardware, use_hardware
+    hardware = (plant_hardware(plant) if plant else None) or get_hardware()
+    with use_hardware(hardware):
+        calibration = WaterLevelCalibration(path=hardware.own_file(CALIBRATION_PATH))
+        print("Set the water to a known level, type it in inches and press enter (empty line when done)")
+        while True:
+            line = sys.stdin.readline().strip()
+            if not line:
+                break
+            ratio = calibration.record_point(float(line))
+            print("Recorded ratio %f at %s inches" % (ratio, line))
+    calibration.fit(model, degree)
+    calibration.save()
+    # Show how far the fitted curve is from each point
+    for ratio, inches in sorted(calibration.points):
+        print("ratio %f measured %.2f in fitted %.2f in" % (ratio, inches, calibration.table.to_level(ratio)))
+    print("Calibration saved to %s" % calibration.path)
+
+
+if __name__ == "__main__":
+    # python -m Water_level_nutrients_ph_manager.water_level_calibration [polynomial|piecewise] [degree] [plant]
+    calibrate(sys.argv[1] if len(sys.argv) > 1 else 'polynomial', int(sys.argv[2]) if len(sys.argv) > 2 else 2,
+              sys.argv[3] if len(sys.argv) > 3 else None)
@@ -1,53 +1,224 @@
+import logging
+
+from Water_level_nutrients_ph_manager.parallel_dosing import run_doses
 from Water_level_nutrients_ph_manager.read_water_sensor import get_water_level
-from main import *
-from time import sleep
-from utilities.AtlasI2C import get_ppm
+from Water_level_nutrients_ph_manager.ph_management import balance_PH_exact
+from file_operations.logging_config import RateLimitedLogger
+from file_operations.plant_vals_file_manager import read_from_file, write_to_file
+from user_controlled_constants import (QUADRATIC_COEFFICIENTS, NUTRIENT_LEARNED_DOSING, NUTRIENT_PPM_TOLERANCE,
+                                      NUTRIENT_PARALLEL_DOSING, FILL_PREDICTIVE, FILL_MIN_POLL_INTERVAL,
+                                      FILL_MAX_POLL_INTERVAL, FILL_LEVEL_TOLERANCE, SETTLE_DEAD_TIME,
+                                      WATER_LEVEL_MAX_LEVEL)
+from utilities import clock, tracing
+from utilities.clock import sleep
+from utilities.AtlasI2C import get_ppm, invalidate_readings
+from utilities.hardware import get_hardware
+from utilities.settling import wait_until_settled
+
+# Coefficients of the eTape curve used by get_water_level
+a, b, c = QUADRATIC_COEFFICIENTS
+
+# Status lines of the fill and dosing loops, at most one of each kind every LOG_RATE_LIMIT_INTERVAL seconds
+status_log = RateLimitedLogger(logging.getLogger(__name__))
+
+
+def check_fill_target(target_level):
+    """
+    Raise ValueError if target_level can not be filled to: the water level readings stop at WATER_LEVEL_MAX_LEVEL
+    (the top of the eTape), a higher target would run the pump until the reservoir overflows.
+    """
+    if not 0 < target_level <= WATER_LEVEL_MAX_LEVEL:
+        raise ValueError("Target water level %s out of the range of the water level sensor (0 to %s inches)"
+                         % (target_level, WATER_LEVEL_MAX_LEVEL))
 
 
-def fill_water(target_level):
+@tracing.traced()
+def fill_water(target_level, predictive=None):
     """
     Fill the water reservoir until the target water level is reached.
 
     param target_level: The desired water level to be reached in the reservoir.
+    param predictive: Stop the pump at the predicted crossing time instead of checking every 5 seconds,
+        FILL_PREDICTIVE if None (see fill_water_predictive).
+    Returns the water level read once the pump stopped, as fill_water_predictive does (None if the fill failed).
+    Raises ValueError if the target is out of the range of the water level sensor (see check_fill_target).
     """
+    check_fill_target(target_level)
+    if FILL_PREDICTIVE if predictive is None else predictive:
+        return fill_water_predictive(target_level)
+    fresh_waterPump = get_hardware().fresh_water_pump
     try:
         # Continuously check the current water level in the reservoir
-        while get_water_level(a, b, c) < target_level:
+        current_level = get_water_level(a, b, c)
+        while current_level < target_level:
             # Display the current water level while adding water
-            print("Adding water... level %f" % (get_water_level(a, b, c)))
+            status_log.info("Adding water... level %f", current_level, pump=fresh_waterPump.name,
+                            water_level=current_level, target=target_level)
             # Start the water pump to fill the reservoir
             fresh_waterPump.start()
             # Wait for 5 seconds to allow the water pump to operate
             sleep(5)
+            current_level = get_water_level(a, b, c)
         # Stop the water pump once the target water level is reached
         fresh_waterPump.stop()
+        # Fresh water diluted the reservoir, drop the cached pH/EC readings
+        invalidate_readings()
+        return current_level
     except Exception as ee:
         # Log the error message and stop the water pump in case of an exception
         logging.error(f"An error occurred while filling water: {ee}")
         fresh_waterPump.stop()
 
 
-def dose_nutrients(target_ppm_local, pump_info, NUTRIENT_WAIT_TIME_LOOP):
-    # Keep dosing nutrients until the target PPM is reached
-    while get_ppm() < target_ppm_local:
-        # Iterate through each pump and its corresponding dosing time in the pump_info list
-        for pump, dosing_time in pump_info:
-            # Print the current PPM
-            print("Adding nutrients... PPM %f" % (get_ppm()))
+def estimate_fill_rate(samples):
+    """
+    Return the rise of the water level (inches per second) fitted by least squares to [(time, level)] samples,
+    None with fewer than two samples.
+    """
+    if len(samples) < 2:
+        return None
+    mean_time = sum(time for time, _ in samples) / len(samples)
+    mean_level = sum(level for _, level in samples) / len(samples)
+    spread = sum((time - mean_time) ** 2 for time, _ in samples)
+    if spread <= 0:
+        return None
+    return sum((time - mean_time) * (level - mean_level) for time, level in samples) / spread
 
-            # Start the pump
-            pump.start()
 
-            # Sleep for the specified dosing time
-            sleep(dosing_time)
+def fill_water_predictive(target_level):
+    """
+    Fill the water reservoir, stopping the pump when the level is predicted to reach target_level.
 
-            # Stop the pump
-            pump.stop()
+    The flow is estimated from the slope of the level readings taken since the pump started. Far from the target
+    the level is read every FILL_MAX_POLL_INTERVAL seconds at most; the polls get closer as the predicted
+    crossing gets near, and once it is due before the next poll the pump is stopped right at that time instead
+    of running on until the next check. Each poll costs one water level reading.
 
-        # Sleep for 10 seconds before checking the PPM again
-        sleep(NUTRIENT_WAIT_TIME_LOOP)
+    Returns:
+        float: The water level measured once the pump stopped, None if the fill failed.
+
+    Raises:
+        ValueError: The target is out of the range of the water level sensor (see check_fill_target).
+    """
+    check_fill_target(target_level)
+    fresh_waterPump = get_hardware().fresh_water_pump
+    try:
+        current_level = get_water_level(a, b, c)
+        while current_level < target_level - FILL_LEVEL_TOLERANCE:
+            # Display the current water level while adding water
+            status_log.info("Adding water... level %f", current_level, pump=fresh_waterPump.name,
+                            water_level=current_level, target=target_level)
+            fresh_waterPump.start()
+            samples = [(clock.monotonic(), current_level)]
+            # The first reading only measures the flow
+            wait = FILL_MIN_POLL_INTERVAL * 4
+            while True:
+                sleep(wait)
+                current_level = get_water_level(a, b, c)
+                samples.append((clock.monotonic(), current_level))
+                if current_level >= target_level:
+                    break
+                rate = estimate_fill_rate(samples)
+                if not rate or rate <= 0:
+                    # No rise seen yet (pump priming, noise), check again later
+                    wait = FILL_MAX_POLL_INTERVAL
+                    continue
+                remaining = (target_level - current_level) / rate
+                if remaining <= FILL_MIN_POLL_INTERVAL * 2:
+                    # The crossing comes before the next poll would: stop the pump right then
+                    sleep(remaining)
+                    break
+                # Poll half way to the predicted crossing, so the estimate is refined as it gets close
+                wait = min(FILL_MAX_POLL_INTERVAL, max(FILL_MIN_POLL_INTERVAL, remaining / 2))
+            fresh_waterPump.stop()
+            current_level = get_water_level(a, b, c)
+        # Fresh water diluted the reservoir, drop the cached pH/EC readings
+        invalidate_readings()
+        return current_level
+    except Exception as ee:
+        # Log the error message and stop the water pump in case of an exception
+        logging.error(f"An error occurred while filling water: {ee}")
+        fresh_waterPump.stop()
 
 
+@tracing.traced()
+def dose_nutrients(target_ppm_local, pump_info, NUTRIENT_WAIT_TIME_LOOP, model=None, learned=None):
+    """
+    Dose nutrients until the reservoir reaches target_ppm_local.
+
+    Args:
+        target_ppm_local: ppm to reach.
+        pump_info: [(pump, seconds)] run time of each nutrient pump for one pass (the plant recipe).
+        NUTRIENT_WAIT_TIME_LOOP: Time (seconds) left to the nutrients to mix in before measuring again.
+        model: NutrientResponseModel sizing each pass to cover the whole gap, the one of the hardware if None.
+        learned: Size the passes with the model, NUTRIENT_LEARNED_DOSING if None. When False, every pass runs the
+            pumps for their fixed time and the model is not used at all.
+
+    Returns:
+        int: Number of dosing passes.
+    """
+    if learned is None:
+        learned = NUTRIENT_LEARNED_DOSING
+    if not learned:
+        model = None
+    elif model is None:
+        model = get_hardware().nutrient_model
+    if model is not None:
+        model.reset()
+        # The volume (level) does not change noticeably while dosing, read it once
+        level = get_water_level(a, b, c)
+
+    def dosed(pump, seconds):
+        if model is not None:
+            model.dosed(pump, seconds, level)
+    # Measure once per pass, the PPM does not settle while the pumps are running anyway
+    current_ppm = get_ppm()
+    passes = 0
+    # Keep dosing nutrients until the target PPM is reached, with learned passes until it is within the tolerance
+    tolerance = NUTRIENT_PPM_TOLERANCE if model is not None else 0
+    while current_ppm < target_ppm_local - tolerance:
+        doses = pump_info if model is None else model.plan(current_ppm, target_ppm_local, level, pump_info,
+                                                           NUTRIENT_PPM_TOLERANCE)
+        if doses:
+            # Log the current PPM
+            status_log.info("Adding nutrients... PPM %f", current_ppm, sensor='ec', ppm=current_ppm,
+                            target=target_ppm_local)
+            passes += 1
+        else:
+            status_log.info("Waiting for the last nutrients to mix in... PPM %f", current_ppm, sensor='ec',
+                            ppm=current_ppm, target=target_ppm_local)
+
+        if NUTRIENT_PARALLEL_DOSING:
+            # Run the pumps together, within the current budgets and the exclusion groups
+            run_doses(doses, dosed)
+        else:
+            # Iterate through each pump and its corresponding dosing time in the pump_info list
+            for pump, dosing_time in doses:
+                # Start the pump
+                pump.start()
+
+                # Sleep for the specified dosing time
+                sleep(dosing_time)
+
+                # Stop the pump
+                pump.stop()
+                dosed(pump, dosing_time)
+
+        if doses:
+            # The last reading is outdated now that nutrients were added (a waiting pass keeps the filters going)
+            invalidate_readings()
+
+        # Wait for the EC to settle before checking the PPM again, NUTRIENT_WAIT_TIME_LOOP at most, and after a
+        # pass for the EC (2 x ppm) to move away from its reading before the pass
+        settled = wait_until_settled(['ec'], NUTRIENT_WAIT_TIME_LOOP, SETTLE_DEAD_TIME,
+                                     baselines={'ec': current_ppm * 2} if doses else None)
+        previous_ppm, current_ppm = current_ppm, get_ppm()
+        if model is not None:
+            model.observe(previous_ppm, current_ppm, settled)
+    return passes
+
+
+@tracing.traced()
 def adjust_water_level_and_nutrients(FILENAME, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST,
                                      NUTRIENT_WAIT_TIME_LOOP, target_min_max_ph, ph_dosing_time):
     # Read target PPM and water level from file
@@ -58,7 +229,7 @@ def adjust_water_level_and_nutrients(FILENAME, NUTRIENT_PPM_SAFETY_MARGIN, NUTRI
 
     # Fill water to the target level
     fill_water(target_water_level)
-    sleep(30)  # Wait for PPM readings to settle
+    wait_until_settled(['ph', 'ec'], 30, SETTLE_DEAD_TIME)  # Wait for PPM readings to settle, 30 seconds at most
 
     # Call proprietary algorithm for updating target PPM
     target_ppm = proprietary_ppm_update_algorithm(target_ppm, pre_fillup_ppm)
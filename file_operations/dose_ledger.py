@@ -0,0 +1,320 @@
+import array
+import bisect
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+from file_operations.plant_vals_file_manager import BASE_DIRECTORY, atomic_write
+from user_controlled_constants import PUMP_FLOW_RATES, PUMP_CALIBRATION_FILE, DOSE_LEDGER_FILE
+from utilities import clock
+
+DOSE_LEDGER_PATH = os.path.join(BASE_DIRECTORY, DOSE_LEDGER_FILE)
+PUMP_CALIBRATION_PATH = os.path.join(BASE_DIRECTORY, PUMP_CALIBRATION_FILE)
+PUMP_CALIBRATION_VERSION = 1
+
+# File layout: a header (magic, format version), then one record per pump run, appended when the pump stops.
+HEADER_FORMAT = struct.Struct('<4sH')
+MAGIC = b'HDLG'
+VERSION = 1
+# Record: wall clock time the pump stopped, run time (seconds), volume (mL, negative for a reverse run), pump id
+# (see pump_id_of_name), length of the plant name, then the plant name (UTF-8)
+RECORD_FORMAT = struct.Struct('<dffBB')
+
+SECONDS_PER_DAY = 86400
+
+
+class _Series:
+    """
+    Runs of one pump for one plant: the time each run ended and the running totals of volume and run time, in
+    arrays. The volume dispensed between two times is the difference of two totals found by bisection, so range
+    queries cost O(log n) whatever the length of the history.
+    """
+
+    __slots__ = ('ends', 'volumes', 'seconds')
+
+    def __init__(self):
+        self.ends = array.array('d')
+        # Totals up to and including each run
+        self.volumes = array.array('d')
+        self.seconds = array.array('d')
+
+    def add(self, end, seconds, ml):
+        if self.ends and end < self.ends[-1]:
+            # The wall clock went back (NTP correction), keep the ends sorted
+            end = self.ends[-1]
+        self.ends.append(end)
+        self.volumes.append((self.volumes[-1] if self.volumes else 0.0) + ml)
+        self.seconds.append((self.seconds[-1] if self.seconds else 0.0) + seconds)
+
+    def _total(self, totals, start, end):
+        first = 0 if start is None else bisect.bisect_left(self.ends, start)
+        last = len(self.ends) if end is None else bisect.bisect_left(self.ends, end)
+        if last <= first:
+            return 0.0
+        return totals[last - 1] - (totals[first - 1] if first else 0.0)
+
+    def volume(self, start=None, end=None):
+        """Volume (mL) of the runs that ended in [start, end)."""
+        return self._total(self.volumes, start, end)
+
+    def run_time(self, start=None, end=None):
+        """Run time (seconds) of the runs that ended in [start, end)."""
+        return self._total(self.seconds, start, end)
+
+
+class DoseLedger:
+    """
+    History of every pump run with the volume it dispensed, by pump and by plant.
+
+    The pumps report their starts and stops through their listeners (record_pump), the run time is turned into a
+    volume with the flow rate of the pump (PUMP_FLOW_RATES, or the rates measured with calibrate()). Runs are
+    attributed to the time they ended and to the plant of the thread that stopped the pump.
+    """
+
+    def __init__(self, path=DOSE_LEDGER_PATH, flow_rates=None, read_only=False):
+        """
+        Args:
+            path: File the runs are appended to (and loaded from), None for an in-memory ledger (simulations).
+            flow_rates: Pump name -> mL per second, the calibrated rates by default (see load_flow_rates).
+            read_only: Only load the file (reports), it is neither created nor opened for append, so a running
+                controller keeps it to itself. Runs added then stay in memory.
+        """
+        self.path = path
+        self.flow_rates = flow_rates if flow_rates is not None else load_flow_rates()
+        # (plant, pump name) -> _Series
+        self._series = {}
+        # Pump -> 1 or -1 while it runs forward or in reverse
+        self._running = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            self._load(path)
+        elif read_only:
+            return
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'wb') as ledger_file:
+                ledger_file.write(HEADER_FORMAT.pack(MAGIC, VERSION))
+        if not read_only:
+            self._file = open(path, 'ab')
+
+    def _load(self, path):
+        with open(path, 'rb') as ledger_file:
+            data = ledger_file.read()
+        magic, version = HEADER_FORMAT.unpack_from(data, 0) if len(data) >= HEADER_FORMAT.size else (None, None)
+        if magic != MAGIC:
+            raise ValueError("%s is not a dose ledger" % path)
+        if version != VERSION:
+            raise ValueError("%s uses an unsupported dose ledger format (version %d)" % (path, version))
+        offset = HEADER_FORMAT.size
+        # A record cut short by a power loss ends the ledger
+        while offset + RECORD_FORMAT.size <= len(data):
+            end, seconds, ml, pump_id, name_length = RECORD_FORMAT.unpack_from(data, offset)
+            offset += RECORD_FORMAT.size
+            if offset + name_length > len(data):
+                break
+            plant = data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            self._series_of(plant, pump_name_of(pump_id)).add(end, seconds, ml)
+
+    def _series_of(self, plant, pump):
+        series = self._series.get((plant, pump))
+        if series is None:
+            series = self._series[(plant, pump)] = _Series()
+        return series
+
+    def flow_rate(self, pump):
+        """Flow (mL per second) of a pump by name, 0 for a pump without a flow rate."""
+        return self.flow_rates.get(pump, 0.0)
+
+    def add(self, pump, seconds, ml=None, plant=None, end=None):
+        """
+        Add one run of a pump.
+
+        Args:
+            pump: Pump name (see PUMP_NAMES).
+            seconds: Run time.
+            ml: Volume dispensed, seconds * the flow rate of the pump by default.
+            plant: Plant the run was for, by default the plant of the current thread ('' outside plant threads).
+            end: Wall clock time the run ended, now by default.
+        """
+        if ml is None:
+            ml = seconds * self.flow_rate(pump)
+        if plant is None:
+            plant = getattr(threading.current_thread(), 'plant_name', None) or ''
+        if end is None:
+            end = clock.wall_time()
+        with self._lock:
+            self._series_of(plant, pump).add(end, seconds, ml)
+            if self._file is not None:
+                name = plant.encode('utf-8')[:255]
+                self._file.write(RECORD_FORMAT.pack(end, seconds, ml, pump_id_of_name(pump), len(name)) + name)
+                self._file.flush()
+
+    def record_pump(self, pump, running):
+        """Pump listener (see Pump.listeners) adding a run every time a pump stops."""
+        if running:
+            self._running[pump] = running
+        else:
+            seconds = pump.last_run_time
+            sign = self._running.pop(pump, 1)
+            self.add(pump.name, seconds, sign * seconds * self.flow_rate(pump.name))
+
+    def _matching(self, pump, plant):
+        return [series for (series_plant, series_pump), series in list(self._series.items())
+                if (pump is None or series_pump == pump) and (plant is None or series_plant == plant)]
+
+    def volume(self, pump=None, plant=None, start=None, end=None):
+        """
+        Volume (mL) dispensed by the runs that ended between start (included) and end (excluded), wall clock times.
+
+        Args:
+            pump: Pump name, None for all the pumps.
+            plant: Plant name, None for all the plants.
+            start: Beginning of the range, None for the start of the ledger.
+            end: End of the range, None for now.
+        """
+        return sum(series.volume(start, end) for series in self._matching(pump, plant))
+
+    def run_time(self, pump=None, plant=None, start=None, end=None):
+        """Run time (seconds) of the runs that ended in the range, see volume() for the arguments."""
+        return sum(series.run_time(start, end) for series in self._matching(pump, plant))
+
+    def pumps(self):
+        return sorted({pump for _, pump in self._series})
+
+    def plants(self):
+        return sorted({plant for plant, _ in self._series})
+
+    def daily(self, days=7, pump=None, plant=None, now=None):
+        """
+        Return [(start of the day, volume in mL)] for the last `days` local days, oldest first, today included.
+        """
+        today = day_start(clock.wall_time() if now is None else now)
+        starts = [day_start(today - (days - 1 - index) * SECONDS_PER_DAY + SECONDS_PER_DAY / 2)
+                  for index in range(days)]
+        ends = starts[1:] + [None]
+        return [(start, self.volume(pump, plant, start, end)) for start, end in zip(starts, ends)]
+
+    def days_left(self, pump, remaining_ml, window_days=7, plant=None, now=None):
+        """
+        Estimate when a bottle runs dry: remaining_ml divided by the average daily use of the pump over the last
+        window_days days. None if the pump was not used in that time.
+        """
+        now = clock.wall_time() if now is None else now
+        used = self.volume(pump, plant, now - window_days * SECONDS_PER_DAY)
+        if used <= 0:
+            return None
+        return remaining_ml / (used / window_days)
+
+    def report(self, days=7, now=None):
+        """Return a text table of the volume dispensed by each pump for each plant, per day."""
+        daily_starts = [start for start, _ in self.daily(days, now=now)]
+        lines = ['%-12s %-12s ' % ('plant', 'pump') + ' '.join(time.strftime('%m-%d', time.localtime(start)).rjust(8)
+                                                              for start in daily_starts) + '    total']
+        for (plant, pump) in sorted(self._series):
+            volumes = [volume for _, volume in self.daily(days, pump, plant, now)]
+            lines.append('%-12s %-12s ' % (plant or '-', pump) + ' '.join('%8.1f' % volume for volume in volumes)
+                         + ' %8.1f' % self.volume(pump, plant))
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def day_start(timestamp):
+    """Wall clock time of the local midnight starting the day of timestamp."""
+    return time.mktime(time.localtime(timestamp)[:3] + (0, 0, 0, 0, 0, -1))
+
+
+def pump_id_of_name(pump):
+    """Compact pump id stored in the ledger: 1 + position in PUMP_NAMES, 0 for an unnamed pump."""
+    from utilities.pumps import PUMP_NAMES
+    return PUMP_NAMES.index(pump) + 1 if pump in PUMP_NAMES else 0
+
+
+def pump_name_of(pump_id):
+    from utilities.pumps import PUMP_NAMES
+    return PUMP_NAMES[pump_id - 1] if 0 < pump_id <= len(PUMP_NAMES) else ''
+
+
+def measured_flow_rates(path=PUMP_CALIBRATION_PATH):
+    """Return pump name -> mL per second of the pumps measured with calibrate() (without the PUMP_FLOW_RATES)."""
+    try:
+        with open(path) as calibration_file:
+            data = json.load(calibration_file)
+    except FileNotFoundError:
+        return {}
+    if data.get('version') != PUMP_CALIBRATION_VERSION:
+        raise ValueError("Unsupported pump calibration file version %r in %s" % (data.get('version'), path))
+    return data['flow_rates']
+
+
+def load_flow_rates(path=PUMP_CALIBRATION_PATH):
+    """Return pump name -> mL per second: PUMP_FLOW_RATES, overridden by the rates measured with calibrate()."""
+    rates = dict(PUMP_FLOW_RATES)
+    rates.update(measured_flow_rates(path))
+    return rates
+
+
+def save_flow_rates(rates, path=PUMP_CALIBRATION_PATH):
+    atomic_write(path, json.dumps({'version': PUMP_CALIBRATION_VERSION, 'flow_rates': rates}, indent=2))
+
+
+# One ledger per file, shared by the hardware contexts of every plant
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_dose_ledger(path=DOSE_LEDGER_PATH):
+    """Return the shared ledger stored in path, loaded on first use."""
+    with _ledgers_lock:
+        if path not in _ledgers:
+            import atexit
+            _ledgers[path] = DoseLedger(path)
+            atexit.register(_ledgers[path].close)
+        return _ledgers[path]
+
+
+def calibrate(pump_names=None, seconds=10):
+    """
+    Interactive flow rate calibration: run each pump for `seconds` into a measuring cup, type the volume
+    collected, and save the measured rates.
+    """
+    from utilities.hardware import get_hardware
+    pumps = {pump.name: pump for pump in get_hardware().all_pumps}
+    rates = load_flow_rates()
+    measured = {}
+    for name in pump_names or list(pumps):
+        print("Put the outlet of %s in a measuring cup and press enter to run it for %s seconds" % (name, seconds))
+        sys.stdin.readline()
+        pumps[name].start()
+        clock.sleep(seconds)
+        pumps[name].stop()
+        print("Volume collected (mL), empty line to keep %.3f mL/s:" % rates.get(name, 0.0))
+        line = sys.stdin.readline().strip()
+        if line:
+            measured[name] = float(line) / seconds
+            print("%s: %.3f mL/s" % (name, measured[name]))
+    # Keep the rates measured before for the pumps skipped this time
+    saved = measured_flow_rates(PUMP_CALIBRATION_PATH)
+    saved.update(measured)
+    save_flow_rates(saved)
+    print("Flow rates saved to %s" % PUMP_CALIBRATION_PATH)
+
+
+if __name__ == "__main__":
+    # python -m file_operations.dose_ledger [days]         volume dispensed per pump, plant and day
+    # python -m file_operations.dose_ledger calibrate [pump...]  measure the flow rates
+    if len(sys.argv) > 1 and sys.argv[1] == 'calibrate':
+        calibrate(sys.argv[2:])
+    else:
+        print(DoseLedger(read_only=True).report(int(sys.argv[1]) if len(sys.argv) > 1 else 7))
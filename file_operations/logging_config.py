@@ -1,4 +1,171 @@
+import atexit
+import json
 import logging
+import os
+import threading
+
+from file_operations.plant_vals_file_manager import BASE_DIRECTORY
+from user_controlled_constants import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_LEVEL, LOG_RATE_LIMIT_INTERVAL
+from utilities import clock
 
 # Configure the logging settings here
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# setup_logging() replaces the basic configuration above with a non-blocking pipeline: the control code only
+# puts records on a queue (QueueHandler), and a background thread (QueueListener) formats them and writes them
+# to the console and to size-rotated JSON lines files under files_and_logs. A dose loop logging in the middle of
+# a timed pump pulse therefore never waits for the SD card.
+
+# Fields of the log records written to the JSON file when the call sets them, with extra={...} or
+# RateLimitedLogger keyword arguments
+STRUCTURED_FIELDS = ('plant', 'pump', 'sensor', 'ph', 'ec', 'ppm', 'water_level', 'target', 'seconds')
+
+_listener = None
+
+
+class PlantFilter(logging.Filter):
+    """Add the plant of the thread that logs (see plant_tasks.py) to every record that does not name one."""
+
+    def filter(self, record):
+        if getattr(record, 'plant', None) is None:
+            record.plant = getattr(threading.current_thread(), 'plant_name', None)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, thread, message and the structured fields it carries."""
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+def setup_logging(directory=BASE_DIRECTORY, filename=LOG_FILE, max_bytes=LOG_MAX_BYTES,
+                  backup_count=LOG_BACKUP_COUNT, level=LOG_LEVEL, console=True):
+    """
+    Send every log record through a queue to a background writer thread.
+
+    Args:
+        directory: Directory of the log files.
+        filename: Name of the current log file, the rotated ones get .1, .2... appended.
+        max_bytes: Size at which the log file is rotated.
+        backup_count: Number of rotated files kept.
+        level: Lowest level logged.
+        console: Also write the records to the console (stderr), in the usual text format.
+
+    Returns:
+        logging.handlers.QueueListener: The running listener (stopped at exit, or with stop_logging()).
+    """
+    # Loaded here, the handlers module pulls in the socket and pickle libraries the control modules never need
+    import logging.handlers
+    import queue
+    global _listener
+    stop_logging()
+    os.makedirs(directory, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(os.path.join(directory, filename), maxBytes=max_bytes,
+                                                        backupCount=backup_count)
+    file_handler.setFormatter(JSONFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers.append(console_handler)
+
+    # An unbounded queue, putting a record never blocks
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # The plant comes from the thread that logs, it has to be added before the record changes thread
+    queue_handler.addFilter(PlantFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Write the records still queued and stop the writer thread of setup_logging()."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+class RateLimitedLogger:
+    """
+    Log the same message at most once per interval.
+
+    Meant for the status lines of the control loops: a loop cycling every few seconds logs its first line, then
+    one line per interval saying how many similar lines were skipped. Messages are told apart by their key (the
+    message format string by default) and by the plant of the thread logging them.
+    """
+
+    def __init__(self, logger, interval=LOG_RATE_LIMIT_INTERVAL):
+        """
+        Args:
+            logger: logging.Logger the records go to.
+            interval: Shortest time (seconds) between two records with the same key.
+        """
+        self.logger = logger
+        self.interval = interval
+        # key -> (clock time of the last record logged, records skipped since)
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def log(self, level, message, *args, key=None, **fields):
+        """
+        Log message % args with the structured fields (see STRUCTURED_FIELDS), unless the same key was logged
+        less than interval seconds ago.
+
+        Returns:
+            bool: True if the record was logged.
+        """
+        if not self.logger.isEnabledFor(level):
+            return False
+        key = (getattr(threading.current_thread(), 'plant_name', None), message if key is None else key)
+        now = clock.monotonic()
+        with self._lock:
+            last, skipped = self._last.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._last[key] = (last, skipped + 1)
+                return False
+            self._last[key] = (now, 0)
+        if skipped:
+            message += " (%d similar messages skipped)" % skipped
+        self.logger.log(level, message, *args, extra=fields)
+        return True
+
+    def debug(self, message, *args, **fields):
+        return self.log(logging.DEBUG, message, *args, **fields)
+
+    def info(self, message, *args, **fields):
+        return self.log(logging.INFO, message, *args, **fields)
+
+    def warning(self, message, *args, **fields):
+        return self.log(logging.WARNING, message, *args, **fields)
+
+    def error(self, message, *args, **fields):
+        return self.log(logging.ERROR, message, *args, **fields)
@@ -1,24 +1,170 @@
+import collections
+import json
 import os
+import threading
+
+from utilities import clock
 
 BASE_DIRECTORY = "files_and_logs"
 PLANT_HARD_VALUES_STORAGE = "hard_values_storage_txt"
 
+# Version written in every state file, files without one are the original "ppm,level,ppm,level" text
+STATE_FORMAT_VERSION = 2
+
+def atomic_write(path, text):
+    """
+    Replace a file with the given text so that a power cut leaves either the old or the new content: write a
+    temporary file, fsync it and rename it over the old one.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    # Make the rename itself durable
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+PlantState = collections.namedtuple('PlantState', 'target_ppm target_water_level current_ppm current_water_level')
+
+
+class PlantStateStore:
+    """
+    Typed, crash-safe storage of the values each plant needs after a restart.
+
+    - Every commit writes a temporary file, fsyncs it and renames it over the old one, so a power cut leaves
+      either the old or the new values on the SD card, never a half written file.
+    - Values are rounded to what the sensors can resolve and a write that changes nothing is skipped.
+    - Changes to the targets are committed immediately; changes to the current readings alone are batched and
+      committed at most once per min_interval (or by flush()), which spares the SD card a rewrite every cycle.
+    """
+
+    # Resolution kept for ppm and water level values
+    PPM_DECIMALS = 1
+    LEVEL_DECIMALS = 2
+
+    def __init__(self, directory=os.path.join(BASE_DIRECTORY, PLANT_HARD_VALUES_STORAGE), min_interval=None):
+        """
+        Args:
+            directory: Folder holding one state file per plant.
+            min_interval: Minimum time (seconds) between two commits that only change the current readings,
+                STATE_COMMIT_INTERVAL by default.
+        """
+        if min_interval is None:
+            from user_controlled_constants import STATE_COMMIT_INTERVAL
+            min_interval = STATE_COMMIT_INTERVAL
+        self.directory = directory
+        self.min_interval = min_interval
+        # filename -> state on disk, state waiting to be committed, clock time of the last commit
+        self._committed = {}
+        self._pending = {}
+        self._last_commit = {}
+        self.commits = 0
+        self.skipped = 0
+        # Plants running in their own threads share the store
+        self._lock = threading.RLock()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def normalize(self, state):
+        """Return the state as floats rounded to the stored resolution."""
+        return PlantState(round(float(state.target_ppm), self.PPM_DECIMALS),
+                          round(float(state.target_water_level), self.LEVEL_DECIMALS),
+                          round(float(state.current_ppm), self.PPM_DECIMALS),
+                          round(float(state.current_water_level), self.LEVEL_DECIMALS))
+
+    def load(self, filename):
+        """Read a state file from disk, in the current or the original format."""
+        with open(self.path(filename), "r") as file:
+            text = file.read().strip()
+        if text.startswith('{'):
+            data = json.loads(text)
+            if data.get("version", 0) > STATE_FORMAT_VERSION:
+                raise ValueError("%s was written by a newer version (%s)" % (filename, data["version"]))
+            state = PlantState(data["target_ppm"], data["target_water_level"], data["current_ppm"],
+                               data["current_water_level"])
+        else:
+            # Original format: four comma separated values, possibly floats
+            state = PlantState(*[float(value) for value in text.split(',')])
+        state = self.normalize(state)
+        self._committed[filename] = state
+        return state
+
+    def read(self, filename):
+        """Return the latest state of a plant, including changes not committed yet."""
+        with self._lock:
+            if filename in self._pending:
+                return self._pending[filename]
+            if filename in self._committed:
+                return self._committed[filename]
+            return self.load(filename)
+
+    def write(self, filename, state, force=False):
+        """
+        Store a new state for a plant.
+
+        Returns:
+            bool: True if the state was committed to disk now.
+        """
+        state = self.normalize(state)
+        with self._lock:
+            on_disk = self._committed.get(filename)
+            if on_disk is None and os.path.exists(self.path(filename)):
+                try:
+                    on_disk = self.load(filename)
+                except (ValueError, KeyError, TypeError):
+                    on_disk = None
+            if state == on_disk:
+                self._pending.pop(filename, None)
+                self.skipped += 1
+                return False
+            targets_changed = on_disk is None or state[:2] != on_disk[:2]
+            last_commit = self._last_commit.get(filename)
+            if (force or targets_changed or last_commit is None
+                    or clock.monotonic() - last_commit >= self.min_interval):
+                self._commit(filename, state)
+                return True
+            self._pending[filename] = state
+            return False
+
+    def flush(self):
+        """Commit every batched change, call it before shutting down."""
+        with self._lock:
+            for filename, state in list(self._pending.items()):
+                self._commit(filename, state)
+
+    def _commit(self, filename, state):
+        data = dict(state._asdict(), version=STATE_FORMAT_VERSION)
+        atomic_write(self.path(filename), json.dumps(data))
+        self._committed[filename] = state
+        self._pending.pop(filename, None)
+        self._last_commit[filename] = clock.monotonic()
+        self.commits += 1
+
+
+# Store shared by the functions below
+plant_state_store = PlantStateStore()
+
 
 # Function to write target_ppm, target_water_level, current_ppm, and current_water_level to a file
 def write_to_file(filename, target_ppm, target_water_level, current_ppm, current_water_level):
-    file_path = os.path.join(BASE_DIRECTORY, PLANT_HARD_VALUES_STORAGE, filename)
-    with open(file_path, "w") as file:
-        file.write(f"{target_ppm},{target_water_level},{current_ppm},{current_water_level}")
+    return plant_state_store.write(filename, PlantState(target_ppm, target_water_level, current_ppm,
+                                                        current_water_level))
 
 
 # Function to read target_ppm, target_water_level, current_ppm, and current_water_level from a file
 def read_from_file(filename):
-    file_path = os.path.join(BASE_DIRECTORY, PLANT_HARD_VALUES_STORAGE, filename)
-    with open(file_path, "r") as file:
-        data = file.read().split(',')
-        target_ppm = int(data[0])
-        target_water_level = int(data[1])
-        current_ppm = int(data[2])
-        current_water_level = int(data[3])
-
-    return target_ppm, target_water_level, current_ppm, current_water_level
+    return plant_state_store.read(filename)
+
+
+# Function to save every batched change to disk (before shutting down)
+def flush_plant_states():
+    plant_state_store.flush()
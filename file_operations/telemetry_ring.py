@@ -0,0 +1,178 @@
+import collections
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from file_operations.plant_vals_file_manager import BASE_DIRECTORY
+from utilities import clock
+
+TELEMETRY_FILE = os.path.join(BASE_DIRECTORY, "telemetry.ring")
+
+# File layout: a fixed header followed by `capacity` fixed size records used as a circular array.
+# Header: magic, format version, record size, capacity, total number of records ever written
+HEADER_FORMAT = struct.Struct('<4sHHIQ')
+HEADER_SIZE = 64
+MAGIC = b'HTRB'
+VERSION = 1
+# Record: sequence number (1 based, 0 while being written), wall clock timestamp, kind, pump id, event code,
+# and four values (pH, EC, temperature C, water level for frames; duration for pump events)
+RECORD_FORMAT = struct.Struct('<QdBBH4f')
+RECORD_SIZE = 48
+
+# Record kinds
+KIND_FRAME = 1
+KIND_EVENT = 2
+# Event codes
+EVENT_PUMP_START = 1
+EVENT_PUMP_STOP = 2
+
+TelemetryRecord = collections.namedtuple('TelemetryRecord', 'sequence timestamp kind pump event values')
+
+
+class TelemetryRing:
+    """
+    Fixed size, append only history of sensor frames and pump events, stored as a circular array of records in a
+    memory-mapped file.
+
+    Appending is O(1) and the file never grows, so the SD card footprint is capacity * 48 bytes. Readers (the tail
+    tool below, a dashboard...) map the same file read-only and never lock the controller: every record carries
+    its sequence number, cleared while the record is rewritten, so a reader simply drops records that were
+    overwritten or half written while it was looking at them.
+    """
+
+    def __init__(self, path=TELEMETRY_FILE, capacity=None, readonly=False):
+        """
+        Args:
+            path: File holding the ring, None for an in-memory ring (simulations).
+            capacity: Number of records, only used to create a new file (TELEMETRY_RING_CAPACITY by default).
+            readonly: Map an existing file read-only, for readers running next to the controller.
+        """
+        if capacity is None:
+            from user_controlled_constants import TELEMETRY_RING_CAPACITY
+            capacity = TELEMETRY_RING_CAPACITY
+        self.path = path
+        self.readonly = readonly
+        self._file = None
+        # Plants running in their own threads share the ring, appends are serialized
+        self._lock = threading.Lock()
+        if path is None:
+            self.capacity = capacity
+            self._map = mmap.mmap(-1, HEADER_SIZE + capacity * RECORD_SIZE)
+            self._write_header(0)
+            return
+
+        exists = os.path.exists(path)
+        if readonly:
+            self._file = open(path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # An empty file was created but not sized before a power loss, size it again
+            exists = exists and os.path.getsize(path) > 0
+            if not exists:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path, 'wb') as new_file:
+                    new_file.truncate(HEADER_SIZE + capacity * RECORD_SIZE)
+            self._file = open(path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, record_size, file_capacity, count = HEADER_FORMAT.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            # A header still all zeros is a ring created just before a power loss, before its header reached the
+            # card: start it again rather than failing on every start
+            uninitialised = not any(self._map[:HEADER_SIZE])
+            if readonly or (exists and not uninitialised):
+                raise ValueError("%s is not a telemetry ring file" % path)
+            self.capacity = (len(self._map) - HEADER_SIZE) // RECORD_SIZE if exists else capacity
+            self._write_header(0)
+            # The header is what makes the file a ring, put it on the card now
+            self._map.flush()
+        elif version != VERSION or record_size != RECORD_SIZE:
+            raise ValueError("%s uses an unsupported telemetry format (version %d)" % (path, version))
+        else:
+            self.capacity = file_capacity
+
+    def _write_header(self, count):
+        HEADER_FORMAT.pack_into(self._map, 0, MAGIC, VERSION, RECORD_SIZE, self.capacity, count)
+
+    def __len__(self):
+        """Number of records ever written (only the last `capacity` ones are kept)."""
+        return HEADER_FORMAT.unpack_from(self._map, 0)[4]
+
+    def _append(self, kind, pump, event, values, timestamp):
+        if timestamp is None:
+            timestamp = clock.wall_time()
+        with self._lock:
+            count = len(self)
+            offset = HEADER_SIZE + (count % self.capacity) * RECORD_SIZE
+            # Invalidate the slot first, write the body, then publish it with its sequence number and the new count
+            struct.pack_into('<Q', self._map, offset, 0)
+            RECORD_FORMAT.pack_into(self._map, offset, 0, timestamp, kind, pump, event, *values)
+            struct.pack_into('<Q', self._map, offset, count + 1)
+            self._write_header(count + 1)
+
+    def append_frame(self, ph, ec, temp_c, water_level, timestamp=None):
+        """Store one set of sensor readings (None values are stored as NaN)."""
+        values = [float('nan') if value is None else value for value in (ph, ec, temp_c, water_level)]
+        self._append(KIND_FRAME, 0, 0, values, timestamp)
+
+    def append_event(self, event, pump=0, value=0.0, timestamp=None):
+        """Store an actuation event, for example EVENT_PUMP_STOP with the pump id and its run time."""
+        self._append(KIND_EVENT, pump, event, (value, 0.0, 0.0, 0.0), timestamp)
+
+    def record_pump(self, pump, running):
+        """Pump listener (see Pump.listeners) storing every start and stop with the run time."""
+        pump_id = pump_id_of(pump)
+        if running:
+            self.append_event(EVENT_PUMP_START, pump_id)
+        else:
+            self.append_event(EVENT_PUMP_STOP, pump_id, pump.last_run_time)
+
+    def tail(self, n=10):
+        """Return the last n records still in the ring, oldest first."""
+        count = len(self)
+        first = max(0, count - min(n, self.capacity))
+        records = []
+        for sequence in range(first + 1, count + 1):
+            offset = HEADER_SIZE + ((sequence - 1) % self.capacity) * RECORD_SIZE
+            fields = RECORD_FORMAT.unpack_from(self._map, offset)
+            # Skip the record if the writer reused the slot meanwhile
+            if fields[0] == sequence and struct.unpack_from('<Q', self._map, offset)[0] == sequence:
+                records.append(TelemetryRecord(fields[0], fields[1], fields[2], fields[3], fields[4], fields[5:]))
+        return records
+
+    def flush(self):
+        """Ask the OS to write the mapped pages to disk now (it does so on its own otherwise)."""
+        if self._file is not None and not self.readonly:
+            self._map.flush()
+
+    def close(self):
+        self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def pump_id_of(pump):
+    """Compact pump id stored in the ring: 1 + position in PUMP_NAMES, 0 for an unnamed pump."""
+    from utilities.pumps import PUMP_NAMES
+    return PUMP_NAMES.index(pump.name) + 1 if pump.name in PUMP_NAMES else 0
+
+
+def format_record(record):
+    if record.kind == KIND_FRAME:
+        return "%.0f frame pH %.3f EC %.1f temp %.2f C level %.2f in" % ((record.timestamp,) + record.values)
+    from utilities.pumps import PUMP_NAMES
+    pump = PUMP_NAMES[record.pump - 1] if 0 < record.pump <= len(PUMP_NAMES) else str(record.pump)
+    if record.event == EVENT_PUMP_START:
+        return "%.0f %s started" % (record.timestamp, pump)
+    if record.event == EVENT_PUMP_STOP:
+        return "%.0f %s stopped after %.2f s" % (record.timestamp, pump, record.values[0])
+    return "%.0f event %d pump %s value %f" % (record.timestamp, record.event, pump, record.values[0])
+
+
+if __name__ == "__main__":
+    # Print the last records: python -m file_operations.telemetry_ring [number of records]
+    ring = TelemetryRing(readonly=True)
+    for telemetry_record in ring.tail(int(sys.argv[1]) if len(sys.argv) > 1 else 20):
+        print(format_record(telemetry_record))
+    ring.close()
@@ -3,41 +3,32 @@ from Water_level_nutrients_ph_manager.ph_management import *
 from file_operations.logging_config import *
 from file_operations.plant_vals_file_manager import *
 from user_controlled_constants import *
-
-# Pump directions
 from utilities.pumps import *
+# All waits go through the package clock so simulations can run faster than real time
+from utilities import clock, metrics, tracing
+from utilities.clock import sleep
+# Sensors, ADC, motor drivers and pumps are only created the first time they are used, so importing this module
+# (or any control module) never touches the I2C bus
+from utilities.hardware import get_hardware, plant_hardware
+from utilities.AtlasI2C import get_ph_and_ec, get_temp_c
+from utilities.settling import wait_until_settled
+from Water_level_nutrients_ph_manager.plant_tasks import MultiPlantController, console_lock
+from utilities.scheduler import Scheduler
 
-# setup
-ECSensor = AtlasI2C(EC_SENSOR_I2C_ADDRESS)
-PHSensor = AtlasI2C(PH_SENSOR_I2C_ADDRESS)
-adc = Adafruit_ADS1x15.ADS1115(address=ADC_I2C_ADDRESS, busnum=ADC_BUSNUM)
-GAIN = ADC_GAIN
 a, b, c = QUADRATIC_COEFFICIENTS
-driver0 = MotorKit(DRIVER0_I2C_ADDRESS)
-driver1 = MotorKit(DRIVER1_I2C_ADDRESS)
-
-# position of each pump (driver0/driver1) dependent on how its setup physically
-
-# Setup fresh water pump object using constants above
-fresh_waterPump = Pump(WATER_PUMP_POSITION, WATER_PUMP_DIRECTION)
-# Setup nutrient pump objects using constants above
-nutrientPump1 = Pump(NUTRIENT_PUMP1_POSITION, NUTRIENT_PUMP1_DIRECTION)
-nutrientPump2 = Pump(NUTRIENT_PUMP2_POSITION, NUTRIENT_PUMP2_DIRECTION)
-nutrientPump3 = Pump(NUTRIENT_PUMP3_POSITION, NUTRIENT_PUMP3_POSITION)
-nutrientPump4 = Pump(NUTRIENT_PUMP4_POSITION, NUTRIENT_PUMP4_POSITION)
-# pH pump objects using constants above
-pHDownPump = Pump(PH_DOWN_PUMP_POSITION, PH_DOWN_PUMP_POSITION)
-pHUpPump = Pump(PH_UP_PUMP_POSITION, PH_UP_PUMP_POSITION)
 
-NUTRIENT_PUMP_LIST = [nutrientPump1, nutrientPump2, nutrientPump3, nutrientPump4]  # add the nutrient pumps to the list
 
-# List containing the pH Up and pH Down pump objects.
-PH_PUMP_LIST = [pHUpPump, pHDownPump]  # add the pH pumps to the list
-
-# Global list of all pump objects: water, nutrient, and pH pumps.
-ALL_PUMPS = [fresh_waterPump] + [pump for pump in NUTRIENT_PUMP_LIST] + PH_PUMP_LIST
+def ask_target_water_level():
+    """Ask the target water level on the console until it is one the water level sensor can read."""
+    while True:
+        target_water_level = int(input("Input target water level (in inches): "))
+        if 0 < target_water_level <= WATER_LEVEL_MAX_LEVEL:
+            return target_water_level
+        print("The water level sensor reads up to %s inches, input a level between 1 and %s"
+              % (WATER_LEVEL_MAX_LEVEL, WATER_LEVEL_MAX_LEVEL))
 
 
+@tracing.traced()
 def setup_hydroponic_system(FILENAME, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP,
                             target_min_max_ph, ph_dosing_time):
     """
@@ -49,20 +40,25 @@ def setup_hydroponic_system(FILENAME, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIM
         # Log the system startup message
         logging.info("RPI Hydroponic System Startup\nTo start, pumps must be primed")
 
-        # Reverse all pumps to ensure consistent starting state
-        logging.info("Reversing all pumps for 25 seconds")
-        run_pumps_list(ALL_PUMPS, reverse=True)
-        sleep(25)  # Wait for pumps to reset
+        # Plants starting at the same time take turns with the console
+        clock.acquire(console_lock)
+        try:
+            # Reverse all pumps to ensure consistent starting state
+            logging.info("Reversing all pumps for 25 seconds")
+            run_pumps_list(get_hardware().all_pumps, reverse=True)
+            sleep(25)  # Wait for pumps to reset
 
-        # Stop all pumps after reversing
-        stop_pumps_list(ALL_PUMPS)
+            # Stop all pumps after reversing
+            stop_pumps_list(get_hardware().all_pumps)
 
-        # Prime all pumps to prepare for nutrient dosing
-        prime(ALL_PUMPS)
+            # Prime all pumps to prepare for nutrient dosing
+            prime(get_hardware().all_pumps)
 
-        # Get user input for target PPM and water level
-        target_ppm = int(input("\nInput starting target plant ppm value (it will adapt): "))
-        target_water_level = int(input("Input target water level (in inches): "))
+            # Get user input for target PPM and water level
+            target_ppm = int(input("\nInput starting target plant ppm value (it will adapt): "))
+            target_water_level = ask_target_water_level()
+        finally:
+            console_lock.release()
 
         # Save target PPM and water level to the file
         write_to_file(FILENAME, target_ppm, target_water_level, 0, 0)
@@ -79,8 +75,8 @@ def setup_hydroponic_system(FILENAME, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIM
         # Log the completion of the system setup
         logging.info("Startup completed")
 
-        # Wait for 30 seconds to allow PPM to settle
-        sleep(30)
+        # Wait for the PPM to settle, 30 seconds at most
+        wait_until_settled(['ph', 'ec'], 30, SETTLE_DEAD_TIME)
 
         # Update target PPM after ph was balanced
         target_ppm = get_ppm()
@@ -88,34 +84,97 @@ def setup_hydroponic_system(FILENAME, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIM
     else:
         # If the water level is above the threshold, log that the system is already set up
         logging.info("Hydroponic system already set up")
+        check_saved_target_water_level(FILENAME)
+
+
+def check_saved_target_water_level(FILENAME):
+    """
+    Ask the target water level again if the saved one is out of the range of the water level sensor: targets saved
+    before the setup checked them (above WATER_LEVEL_MAX_LEVEL) would make every refill raise (see check_fill_target).
+    """
+    try:
+        target_ppm, target_water_level, current_ppm, current_water_level = read_from_file(FILENAME)
+    except FileNotFoundError:
+        return
+    if 0 < target_water_level <= WATER_LEVEL_MAX_LEVEL:
+        return
+    logging.warning(f"Saved target water level {target_water_level} is out of the range of the water level sensor")
+    clock.acquire(console_lock)
+    try:
+        target_water_level = ask_target_water_level()
+    finally:
+        console_lock.release()
+    write_to_file(FILENAME, target_ppm, target_water_level, current_ppm, current_water_level)
+
+
+@tracing.traced()
+def check_ph(target_min_max_ph, ph_dosing_time):
+    """
+    Record the sensor readings and bring the pH back in range if it drifted out of it.
+    """
+    # Keep a history of the readings, both boards convert at once and the values stay cached for the checks
+    ph, ec = get_ph_and_ec()
+    try:
+        get_hardware().telemetry.append_frame(ph, ec, get_temp_c(), get_water_level(a, b, c))
+    except Exception as error:
+        # The history is a nice to have, the pH must be balanced whatever happens to it
+        logging.error(f"Could not record the telemetry: {error}")
+    balance_ph(target_min_max_ph, ph_dosing_time)  # Keep within range
+
 
+@tracing.traced()
+def check_water_level(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, target_min_max_ph, ph_dosing_time,
+                      NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP):
+    """
+    Refill the reservoir and dose nutrients once the plant drank more than the threshold.
 
+    Returns:
+        bool: True if the water level was adjusted.
+    """
+    # Read the target PPM and water level values from the file specific to the plants file
+    target_ppm, target_water_level, current_ppm, current_water_level = read_from_file(FILENAME)
+
+    # Bring water in from the bucket used by the plant to the main reservoir to check using sensors and dose
+    # nutrients
+    # reverse_pump = on for 3 minutes to bring water in from the bucket to the main reservoir
+
+    # check water level to gauge how much is in the bucket
+    if get_water_level(a, b, c) - target_water_level > WATER_LEVEL_CHANGE_THRESHOLD:
+        # Adjust water level and nutrients if the difference is greater than the threshold
+        adjust_water_level_and_nutrients(FILENAME, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST,
+                                         NUTRIENT_WAIT_TIME_LOOP, target_min_max_ph, ph_dosing_time)
+        return True
+    return False
+
+
+@tracing.traced()
+def save_plant_state(FILENAME):
+    """Update the values of ppm and water level (the store decides when they actually go to disk)."""
+    target_ppm, target_water_level, current_ppm, current_water_level = read_from_file(FILENAME)
+    write_to_file(FILENAME, target_ppm, target_water_level, get_ppm(), get_water_level(a, b, c))
+    hardware = get_hardware()
+    hardware.telemetry.flush()
+    if hardware.traffic_recorder is not None:
+        hardware.traffic_recorder.flush()
+
+
+@tracing.traced()
 def monitor_hydroponic_system(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, WAIT_TIME_BETWEEN_CHECKS, target_min_max_ph,
                               ph_dosing_time, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST,
                               NUTRIENT_WAIT_TIME_LOOP):
     """
-    Continuously monitor the hydroponic system, adjusting water level, dosing nutrients, and balancing pH as needed.
+    Do one monitoring pass: adjust water level and nutrients, or balance pH, then wait WAIT_TIME_BETWEEN_CHECKS.
+
+    run_plant() runs the same checks as separate periodic jobs instead, see schedule_plant().
     """
     try:
-        # Read the target PPM and water level values from the file specific to the plants file
-        target_ppm, target_water_level, current_ppm, current_water_level = read_from_file(FILENAME)
         # Check if the difference between the current water level and the target water level
         # is greater than the defined threshold
-
-        # Bring water in from the bucket used by the plant to the main reservoir to check using sensors and dose
-        # nutrients
-        # reverse_pump = on for 3 minutes to bring water in from the bucket to the main reservoir
-
-        # check water level to gauge how much is in the bucket
-        if get_water_level(a, b, c) - target_water_level > WATER_LEVEL_CHANGE_THRESHOLD:
-            # Adjust water level and nutrients if the difference is greater than the threshold
-            adjust_water_level_and_nutrients(FILENAME, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST,
-                                             NUTRIENT_WAIT_TIME_LOOP, target_min_max_ph, ph_dosing_time)
-        else:
+        if not check_water_level(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, target_min_max_ph, ph_dosing_time,
+                                 NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP):
             # If the difference is within the threshold, balance the pH levels
-            balance_ph(target_min_max_ph, ph_dosing_time)  # Keep within range
-            # update the values of ppm and water level
-            write_to_file(FILENAME, target_ppm, target_water_level, get_ppm(), get_water_level(a, b, c))
+            check_ph(target_min_max_ph, ph_dosing_time)
+            save_plant_state(FILENAME)
             # Sleep for a defined time before checking water level and pH again
             sleep(WAIT_TIME_BETWEEN_CHECKS)
     except Exception as eeee:
@@ -125,35 +184,93 @@ def monitor_hydroponic_system(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, WAIT_TIME_
         sleep(WAIT_TIME_BETWEEN_CHECKS)
 
 
-def main():
-    # CHANGE FROM PLANT_OPTIONS_1, TO OTHER PLANT CHOICE DICTIONARY NAME, SUCH AS (PLANTS_OPTION_2)
-    user_plant_choice = BLUEBERRY_PLANT
-    for plant_selection_dict in user_plant_choice:
-        # Update the parameters based on the selected plant
-        plant_params = user_plant_choice[plant_selection_dict]
-        FILENAME = plant_selection_dict + '.txt'
+def schedule_plant(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, WAIT_TIME_BETWEEN_CHECKS, target_min_max_ph,
+                   ph_dosing_time, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP):
+    """
+    Return a Scheduler running the checks of one plant, each at its own period:
+    pH/EC every PH_CHECK_INTERVAL seconds, water level every WAIT_TIME_BETWEEN_CHECKS seconds and the plant
+    state every STATE_SAVE_INTERVAL seconds.
+    """
+    scheduler = Scheduler()
+    # The water check runs first, it may refill the reservoir which changes the pH
+    scheduler.add('water', lambda: check_water_level(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, target_min_max_ph,
+                                                     ph_dosing_time, NUTRIENT_PPM_SAFETY_MARGIN,
+                                                     NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP),
+                  WAIT_TIME_BETWEEN_CHECKS)
+    scheduler.add('ph', lambda: check_ph(target_min_max_ph, ph_dosing_time), PH_CHECK_INTERVAL)
+    scheduler.add('state', lambda: save_plant_state(FILENAME), STATE_SAVE_INTERVAL, delay=STATE_SAVE_INTERVAL)
+    return scheduler
+
+
+def run_plant(plant_selection_dict, plant_params, stop_event):
+    """
+    Set up one plant, then keep monitoring it until stop_event is set.
 
-        target_min_max_ph = plant_params['ph_settings']['target_min_ph'], plant_params['ph_settings']['target_max_ph']
-        NUTRIENT_PUMP_TIME_LIST = plant_params['nutrient_settings']['nutrient_pump_times']
-        WATER_LEVEL_CHANGE_THRESHOLD = plant_params['water_settings']['level_change_threshold']
-        WAIT_TIME_BETWEEN_CHECKS = plant_params['water_settings']['wait_time_between_checks']
-        NUTRIENT_PPM_SAFETY_MARGIN = plant_params['nutrient_settings']['ppm_safety_margin']
-        NUTRIENT_WAIT_TIME_LOOP = plant_params['nutrient_settings']['wait_time_loop']
-        ph_dosing_time = plant_params['ph_settings']['dosing_time']
+    Runs in a thread of its own (see plant_tasks.py), so several plants are looked after at the same time.
+    """
+    # Update the parameters based on the selected plant
+    FILENAME = plant_selection_dict + '.txt'
+
+    target_min_max_ph = plant_params['ph_settings']['target_min_ph'], plant_params['ph_settings']['target_max_ph']
+    # Pair each nutrient pump with its dosing time, as expected by dose_nutrients
+    NUTRIENT_PUMP_TIME_LIST = list(zip(get_hardware().nutrient_pumps,
+                                       plant_params['nutrient_settings']['nutrient_pump_times']))
+    WATER_LEVEL_CHANGE_THRESHOLD = plant_params['water_settings']['level_change_threshold']
+    WAIT_TIME_BETWEEN_CHECKS = plant_params['water_settings']['wait_time_between_checks']
+    NUTRIENT_PPM_SAFETY_MARGIN = plant_params['nutrient_settings']['ppm_safety_margin']
+    NUTRIENT_WAIT_TIME_LOOP = plant_params['nutrient_settings']['wait_time_loop']
+    ph_dosing_time = plant_params['ph_settings']['dosing_time']
+
+    # Set up the hydroponic system
+    setup_hydroponic_system(FILENAME, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP, target_min_max_ph,
+                            ph_dosing_time)
+
+    # Continuously monitor the hydroponic system, each check at its own period
+    scheduler = schedule_plant(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, WAIT_TIME_BETWEEN_CHECKS, target_min_max_ph,
+                               ph_dosing_time, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST,
+                               NUTRIENT_WAIT_TIME_LOOP)
+    try:
+        scheduler.run(stop_event)
+    finally:
+        for job_name, stats in scheduler.stats().items():
+            logging.info(f"{plant_selection_dict} {job_name} job: {stats}")
 
-        # Set up the hydroponic system
-        setup_hydroponic_system(FILENAME, NUTRIENT_PUMP_TIME_LIST, NUTRIENT_WAIT_TIME_LOOP, target_min_max_ph,
-                                ph_dosing_time)
 
-        # Continuously monitor the hydroponic system
-        monitor_hydroponic_system(FILENAME, WATER_LEVEL_CHANGE_THRESHOLD, WAIT_TIME_BETWEEN_CHECKS, target_min_max_ph,
-                                  ph_dosing_time, NUTRIENT_PPM_SAFETY_MARGIN, NUTRIENT_PUMP_TIME_LIST,
-                                  NUTRIENT_WAIT_TIME_LOOP)
+def main(hardware_for_plant=plant_hardware):
+    """
+    Look after every plant of the chosen dictionary at the same time, each one in its own thread.
+
+    Args:
+        hardware_for_plant: Function returning the hardware context of a plant from its name, None for the plant
+            using the default hardware. By default the reservoirs configured in PLANT_HARDWARE.
+    """
+    # CHANGE FROM PLANT_OPTIONS_1, TO OTHER PLANT CHOICE DICTIONARY NAME, SUCH AS (PLANTS_OPTION_2)
+    user_plant_choice = BLUEBERRY_PLANT
+    controller = MultiPlantController(user_plant_choice, run_plant, hardware_for_plant).start()
+    try:
+        controller.join()
+    except BaseException:
+        # Ctrl-C: the plant threads die with the program, no pump may be left running
+        controller.emergency_stop()
+        raise
+    for plant_name, error in controller.errors().items():
+        logging.error(f"Plant {plant_name} stopped: {error}")
 
 
 if __name__ == "__main__":
+    # Log through the background writer, to the console and to the rotating files in files_and_logs
+    setup_logging()
+    if METRICS_ENABLED:
+        # Prometheus text at http://METRICS_ADDRESS:METRICS_PORT/metrics
+        metrics.start_http_server()
     try:
         main()
     except Exception as e:
         logging.error(f"An error occurred in the main function: {e}")
-        stop_pumps_list(ALL_PUMPS)
+        stop_pumps_list(get_hardware().all_pumps)
+    finally:
+        # Save the readings that were batched to spare the SD card
+        flush_plant_states()
+        if TRACING_ENABLED:
+            # Where the time went, open it in chrome://tracing or https://ui.perfetto.dev
+            tracing.export_chrome_trace()
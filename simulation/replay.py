@@ -0,0 +1,270 @@
+import collections
+import errno
+import os
+
+from file_operations.telemetry_ring import TelemetryRing, pump_id_of
+from user_controlled_constants import I2C_BUSNUM
+from utilities.clock import VirtualClock, set_clock
+from utilities.hardware import HardwareContext, set_hardware
+from utilities.i2c_bus import I2CBus
+from utilities.traffic_log import (load_traffic, TRAFFIC_LOG_PATH, I2C_WRITE, I2C_READ, I2C_ERROR, ADC_READ,
+                                   TEMP_READ, PUMP_START, PUMP_STOP, ERRNO_FORMAT, ADC_FORMAT)
+
+# Replay of a traffic log recorded on the Pi (see utilities/traffic_log.py): the control code runs against devices
+# answering exactly what the real ones answered, on a virtual clock, so a night of field traffic replays in seconds
+# and the same log always gives the same run. The Atlas boards, the ADC channels and the temperature probe each
+# serve their own recorded answers in order; the pumps only record what the control code does with them, to
+# compare with what it did in the field.
+
+
+class ReplayFinished(BaseException):
+    """
+    Raised by a replayed device asked for more than the log recorded.
+
+    Derived from BaseException like KeyboardInterrupt, so it goes through the `except Exception` handlers of the
+    control loops (which would otherwise keep retrying) up to the code driving the replay.
+    """
+
+
+class ReplayI2CTransport:
+    """Raw transport of the replayed I2C bus (set_address/write/read), answering from the recorded traffic."""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.address = None
+
+    def set_address(self, address):
+        self.address = address
+
+    def write(self, data):
+        self.replay.i2c_write(self.address, bytes(data))
+
+    def read(self, num_of_bytes):
+        return self.replay.i2c_read(self.address, num_of_bytes)
+
+    def close(self):
+        pass
+
+
+class ReplayADC:
+    """ADS1115 returning the recorded conversions of each channel."""
+
+    def __init__(self, replay):
+        self.replay = replay
+        self._channel = None
+
+    def read_adc(self, channel, gain=1):
+        return self.replay.adc_read(channel)
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        self._channel = channel
+        return self.replay.adc_read(channel)
+
+    def get_last_result(self):
+        if self._channel is None:
+            raise RuntimeError("get_last_result called without start_adc")
+        return self.replay.adc_read(self._channel)
+
+    def stop_adc(self):
+        self._channel = None
+
+
+class ReplayTemperatureSensor:
+    """1-wire probe returning the recorded lines."""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    def readline(self):
+        return self.replay.temperature_read()
+
+
+class ReplayMotor:
+    """Motor that drives nothing, the pumps report their starts and stops to the replay through listeners."""
+
+    def __init__(self, name=""):
+        self.name = name
+        self.throttle = 0
+
+
+class ReplayHardware(HardwareContext):
+    """HardwareContext whose devices answer from a Replay."""
+
+    def __init__(self, replay, bus_number=I2C_BUSNUM):
+        super().__init__(bus_number)
+        self.replay = replay
+        self.motors = {}
+
+    def _build_i2c_bus(self):
+        return I2CBus(self.bus_number, ReplayI2CTransport(self.replay))
+
+    def _build_temp_sensor(self):
+        return ReplayTemperatureSensor(self.replay)
+
+    def _build_adc(self):
+        return ReplayADC(self.replay)
+
+    def _build_telemetry(self):
+        # Kept in memory, a replay must not fill the history of the real system
+        return TelemetryRing(None)
+
+    def _build_dose_ledger(self):
+        from file_operations.dose_ledger import DoseLedger
+        # In memory, a replay must not add to the consumption of the real pumps
+        return DoseLedger(None)
+
+    def _build_traffic_recorder(self):
+        # Not recorded again unless asked with record_traffic()
+        return None
+
+    def _make_pump(self, position, direction, name):
+        pump = super()._make_pump(position, direction, name)
+        pump.listeners.append(self.replay.pump_changed)
+        return pump
+
+    def motor(self, position):
+        return self.motors.setdefault(position, ReplayMotor(position))
+
+
+class Replay:
+    """
+    Everything needed to run the control code against a traffic log: a virtual clock starting when the recording
+    started and a HardwareContext (self.hardware) of replayed devices. Call install() to make the control code use
+    it, then run the code under test until it raises ReplayFinished:
+
+        replay = Replay('traffic.rec').install()
+        try:
+            while True:
+                main.monitor_hydroponic_system(...)
+        except ReplayFinished:
+            pass
+        finally:
+            replay.uninstall()
+        print(replay.divergences, replay.first_actuation_difference())
+    """
+
+    def __init__(self, log=TRAFFIC_LOG_PATH, follow_timestamps=True):
+        """
+        Args:
+            log: Path of a traffic log, or a TrafficLog already loaded.
+            follow_timestamps: Move the clock forward to the time each answer was recorded at when the control code
+                asks for it earlier, so caches, filters and settle detectors see the recorded timing. Without it the
+                clock only moves when the control code sleeps.
+        """
+        if isinstance(log, (str, os.PathLike)):
+            log = load_traffic(log)
+        self.log = log
+        self.follow_timestamps = follow_timestamps
+        # Time starts with the recording (or its first record if older, a recorder created before the clock was
+        # replaced). No listeners to step, one step per advance is enough.
+        start = min([log.start] + [record.timestamp for record in log.records[:1]])
+        self.clock = VirtualClock(start=start, epoch=log.wall_time + start - log.start, max_step=float('inf'))
+
+        # Answers of each device, served in order: I2C traffic by address, conversions by ADC channel
+        self.i2c = collections.defaultdict(collections.deque)
+        self.adc = collections.defaultdict(collections.deque)
+        self.temperature = collections.deque()
+        # (pump id, PUMP_START or PUMP_STOP) recorded, and done by the replayed control code
+        self.recorded_actuations = []
+        self.actuations = []
+        for record in log.records:
+            if record.kind in (I2C_WRITE, I2C_READ, I2C_ERROR):
+                self.i2c[record.device].append(record)
+            elif record.kind == ADC_READ:
+                self.adc[record.device].append(record)
+            elif record.kind == TEMP_READ:
+                self.temperature.append(record)
+            elif record.kind in (PUMP_START, PUMP_STOP):
+                self.recorded_actuations.append((record.device, record.kind))
+
+        # (clock time, description) of every place the control code did not send what was recorded
+        self.divergences = []
+        # Number of recorded answers served
+        self.served = 0
+
+        self.hardware = ReplayHardware(self)
+        self._previous_clock = None
+        self._previous_hardware = None
+
+    def install(self):
+        """Make the whole package use the virtual clock and the replayed devices."""
+        self._previous_clock = set_clock(self.clock)
+        self._previous_hardware = set_hardware(self.hardware)
+        return self
+
+    def uninstall(self):
+        """Give the package back the clock and hardware it used before install()."""
+        if self._previous_clock is not None:
+            set_clock(self._previous_clock)
+            set_hardware(self._previous_hardware)
+            self._previous_clock = None
+            self._previous_hardware = None
+
+    @property
+    def finished(self):
+        """True once every recorded sensor answer was served."""
+        return not (any(self.i2c.values()) or any(self.adc.values()) or self.temperature)
+
+    def _next(self, queue, device):
+        if not queue:
+            raise ReplayFinished("No more recorded traffic for %s" % device)
+        record = queue.popleft()
+        if self.follow_timestamps and record.timestamp > self.clock.now:
+            self.clock.advance(record.timestamp - self.clock.now)
+        self.served += 1
+        return record
+
+    def _diverged(self, description):
+        self.divergences.append((self.clock.now, description))
+
+    @staticmethod
+    def _raise_error(record):
+        code = ERRNO_FORMAT.unpack(record.payload)[0] or errno.EIO
+        raise IOError(code, os.strerror(code))
+
+    def i2c_write(self, address, data):
+        queue = self.i2c[address]
+        record = self._next(queue, "I2C address 0x%02x" % address)
+        if record.kind == I2C_ERROR:
+            self._raise_error(record)
+        if record.kind != I2C_WRITE:
+            # The control code sends a command the recording did not, keep the answer for the next read
+            queue.appendleft(record)
+            self._diverged("0x%02x: unexpected write %r" % (address, data))
+        elif record.payload != data:
+            self._diverged("0x%02x: wrote %r instead of %r" % (address, data, record.payload))
+
+    def i2c_read(self, address, num_of_bytes):
+        queue = self.i2c[address]
+        record = self._next(queue, "I2C address 0x%02x" % address)
+        # Commands the control code no longer sends are skipped to get to their answer
+        while record.kind == I2C_WRITE:
+            self._diverged("0x%02x: missing write %r" % (address, record.payload))
+            record = self._next(queue, "I2C address 0x%02x" % address)
+        if record.kind == I2C_ERROR:
+            self._raise_error(record)
+        return record.payload.ljust(num_of_bytes, b'\x00')[:num_of_bytes]
+
+    def adc_read(self, channel):
+        record = self._next(self.adc[channel], "ADC channel %d" % channel)
+        return ADC_FORMAT.unpack(record.payload)[0]
+
+    def temperature_read(self):
+        record = self._next(self.temperature, "the temperature probe")
+        return None if record.payload is None else record.payload.decode('ascii')
+
+    def pump_changed(self, pump, running):
+        """Pump listener keeping what the replayed control code does with the pumps."""
+        self.actuations.append((pump_id_of(pump), PUMP_START if running else PUMP_STOP))
+
+    def first_actuation_difference(self):
+        """
+        Return the index of the first pump start or stop that differs from the recording (an extra or a missing
+        one counts), None if the replayed control code drove the pumps exactly as recorded.
+        """
+        for index, (recorded, replayed) in enumerate(zip(self.recorded_actuations, self.actuations)):
+            if recorded != replayed:
+                return index
+        if len(self.recorded_actuations) != len(self.actuations):
+            return min(len(self.recorded_actuations), len(self.actuations))
+        return None
@@ -0,0 +1,185 @@
+import math
+
+
+class Liquid:
+    """
+    Something a pump can push into the reservoir.
+
+    Args:
+        name: Name used in the dispensed volume totals.
+        nutrient_mg_per_ml: Dissolved nutrient salts per mL (raises ppm).
+        acid_mmol_per_ml: Acid per mL, negative for a base (pH down is positive, pH up negative).
+        is_water: True for fresh water, which is mixed in straight away and carries its own pH.
+    """
+
+    def __init__(self, name, nutrient_mg_per_ml=0.0, acid_mmol_per_ml=0.0, is_water=False):
+        self.name = name
+        self.nutrient_mg_per_ml = nutrient_mg_per_ml
+        self.acid_mmol_per_ml = acid_mmol_per_ml
+        self.is_water = is_water
+
+
+# Typical stock solutions: a mildly acidic nutrient concentrate and strong pH up/down
+FRESH_WATER = Liquid('water', is_water=True)
+NUTRIENT_CONCENTRATE = Liquid('nutrient', nutrient_mg_per_ml=150.0, acid_mmol_per_ml=0.05)
+PH_DOWN_SOLUTION = Liquid('ph_down', acid_mmol_per_ml=2.0)
+PH_UP_SOLUTION = Liquid('ph_up', acid_mmol_per_ml=-2.0)
+
+
+class Reservoir:
+    """
+    Simple physical model of the nutrient reservoir.
+
+    - Water level follows the volume (liters_per_inch).
+    - Nutrients are tracked in mg, so ppm (mg/L) rises when water evaporates or is taken up by the plants and
+      falls when fresh water is added. EC is derived on the 500 scale used by get_ppm().
+    - pH moves by added acid / (buffer capacity * volume). The buffer capacity grows with the nutrient content,
+      which is why heavily fed water needs more pH down.
+    - Dosed nutrients and pH solutions are not mixed instantly: they sit in an unmixed pool that blends in with
+      the mix_time_constant, so probes see the gradual change a real bucket shows.
+    - Plants drink water, take up nutrients and slowly push the pH up; the water temperature can swing daily.
+
+    Call step(start, end) to integrate over a period of time (a VirtualClock listener does this), and connect
+    pumps with connect_pump() so their flow is taken into account.
+    """
+
+    def __init__(self, volume_l=20.0, capacity_l=30.0, liters_per_inch=2.0, ppm=0.0, ph=6.5,
+                 source_water_ph=7.2, base_buffer=0.5, nutrient_buffer_per_ppm=0.002, temperature_c=21.0,
+                 temperature_swing_c=0.0, evaporation_l_per_hour=0.01, uptake_l_per_hour=0.05,
+                 nutrient_uptake_ratio=0.8, ph_drift_per_hour=0.02, mix_time_constant=20.0):
+        """
+        Args:
+            volume_l: Starting volume of water in liters.
+            capacity_l: Volume at which the reservoir overflows.
+            liters_per_inch: Liters of water per inch of height measured by the eTape.
+            ppm: Starting nutrient concentration.
+            ph: Starting pH.
+            source_water_ph: pH of the fresh water added by the water pump.
+            base_buffer: Buffer capacity of plain water (mmol/L per pH unit).
+            nutrient_buffer_per_ppm: Extra buffer capacity for each ppm of nutrients.
+            temperature_c: Average water temperature.
+            temperature_swing_c: Amplitude of the daily temperature variation.
+            evaporation_l_per_hour: Water lost to evaporation.
+            uptake_l_per_hour: Water drunk by the plants.
+            nutrient_uptake_ratio: Concentration of nutrients in the water the plants drink, relative to the
+                reservoir (below 1 makes ppm creep up as the plants drink).
+            ph_drift_per_hour: pH rise caused by nutrient uptake.
+            mix_time_constant: Time constant (seconds) for dosed liquids to blend into the reservoir.
+        """
+        self.volume_l = volume_l
+        self.capacity_l = capacity_l
+        self.liters_per_inch = liters_per_inch
+        self.nutrient_mg = ppm * volume_l
+        self.ph = ph
+        self.source_water_ph = source_water_ph
+        self.base_buffer = base_buffer
+        self.nutrient_buffer_per_ppm = nutrient_buffer_per_ppm
+        self.mean_temperature_c = temperature_c
+        self.temperature_swing_c = temperature_swing_c
+        self.evaporation_l_per_hour = evaporation_l_per_hour
+        self.uptake_l_per_hour = uptake_l_per_hour
+        self.nutrient_uptake_ratio = nutrient_uptake_ratio
+        self.ph_drift_per_hour = ph_drift_per_hour
+        self.mix_time_constant = mix_time_constant
+        self.time = 0.0
+        # Dosed but not yet blended in
+        self.unmixed_nutrient_mg = 0.0
+        self.unmixed_acid_mmol = 0.0
+        # (motor, liquid, flow rate in mL/s, forward sign) for every connected pump
+        self.pumps = []
+        # Total mL pushed by each liquid, useful to compare dosing strategies
+        self.dispensed_ml = {}
+
+    @property
+    def ppm(self):
+        if self.volume_l <= 0:
+            return 0.0
+        return self.nutrient_mg / self.volume_l
+
+    @property
+    def ec(self):
+        """EC in uS/cm, the inverse of the 500 scale used by get_ppm()."""
+        return self.ppm / 0.5
+
+    @property
+    def level_inches(self):
+        return self.volume_l / self.liters_per_inch
+
+    @property
+    def temperature_c(self):
+        daily = math.sin(2 * math.pi * self.time / 86400.0)
+        return self.mean_temperature_c + self.temperature_swing_c * daily
+
+    def buffer_capacity(self):
+        """Buffer capacity of the whole reservoir in mmol per pH unit."""
+        return (self.base_buffer + self.nutrient_buffer_per_ppm * self.ppm) * max(self.volume_l, 0.001)
+
+    def connect_pump(self, motor, liquid, flow_ml_per_s, forward_sign=1):
+        """
+        Let a motor push a liquid into the reservoir.
+
+        Args:
+            motor: Anything with a throttle attribute (SimulatedMotor).
+            liquid: Liquid pushed when the motor runs forward.
+            flow_ml_per_s: Flow at full throttle.
+            forward_sign: Sign of the throttle that pumps into the reservoir (the pump direction).
+        """
+        self.pumps.append((motor, liquid, flow_ml_per_s, forward_sign))
+
+    def add_liquid(self, liquid, ml):
+        """Add ml of a liquid to the reservoir right now."""
+        if ml <= 0:
+            return
+        self.dispensed_ml[liquid.name] = self.dispensed_ml.get(liquid.name, 0.0) + ml
+        liters = ml / 1000.0
+        if liquid.is_water:
+            # Fresh water blends by buffer capacity weighted average of the two pH values
+            water_buffer = self.base_buffer * liters
+            total_buffer = self.buffer_capacity() + water_buffer
+            self.ph = (self.ph * self.buffer_capacity() + self.source_water_ph * water_buffer) / total_buffer
+        self.volume_l += liters
+        self.unmixed_nutrient_mg += liquid.nutrient_mg_per_ml * ml
+        self.unmixed_acid_mmol += liquid.acid_mmol_per_ml * ml
+        if self.volume_l > self.capacity_l:
+            # Overflow carries away a share of everything already in the water
+            kept = self.capacity_l / self.volume_l
+            self.nutrient_mg *= kept
+            self.volume_l = self.capacity_l
+
+    def step(self, start, end):
+        """Integrate the reservoir from start to end (seconds)."""
+        dt = end - start
+        if dt <= 0:
+            return
+        self.time = end
+
+        # What was dosed before this step, the liquid pumped during the step gets less time to blend in
+        earlier_nutrient_mg, earlier_acid_mmol = self.unmixed_nutrient_mg, self.unmixed_acid_mmol
+        for motor, liquid, flow_ml_per_s, forward_sign in self.pumps:
+            throttle = motor.throttle or 0
+            if throttle * forward_sign > 0:
+                self.add_liquid(liquid, flow_ml_per_s * abs(throttle) * dt)
+
+        # Water leaves through evaporation (nutrients stay) and through the plants (taking some nutrients)
+        hours = dt / 3600.0
+        uptake_l = min(self.uptake_l_per_hour * hours, self.volume_l)
+        self.nutrient_mg = max(0.0, self.nutrient_mg - uptake_l * self.ppm * self.nutrient_uptake_ratio)
+        self.volume_l = max(0.0, self.volume_l - uptake_l - self.evaporation_l_per_hour * hours)
+        self.ph += self.ph_drift_per_hour * hours
+
+        # Blend in part of what was dosed: a share of the earlier pool, and of the liquid pumped at a constant flow
+        # during the step the share left unmixed at its end is tau * (1 - exp(-dt / tau)) / dt
+        if self.mix_time_constant > 0:
+            mixed = 1 - math.exp(-dt / self.mix_time_constant)
+            pumped_mixed = 1 - self.mix_time_constant * mixed / dt
+        else:
+            mixed = pumped_mixed = 1.0
+        nutrient = (earlier_nutrient_mg * mixed +
+                    (self.unmixed_nutrient_mg - earlier_nutrient_mg) * pumped_mixed)
+        self.nutrient_mg += nutrient
+        self.unmixed_nutrient_mg -= nutrient
+        acid = earlier_acid_mmol * mixed + (self.unmixed_acid_mmol - earlier_acid_mmol) * pumped_mixed
+        self.unmixed_acid_mmol -= acid
+        self.ph -= acid / self.buffer_capacity()
+
+        self.ph = min(14.0, max(0.0, self.ph))
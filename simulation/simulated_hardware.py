@@ -0,0 +1,215 @@
+import random
+
+from file_operations.telemetry_ring import TelemetryRing
+from simulation.reservoir import (Reservoir, FRESH_WATER, NUTRIENT_CONCENTRATE, PH_DOWN_SOLUTION,
+                                  PH_UP_SOLUTION)
+from user_controlled_constants import *
+from utilities.clock import VirtualClock, set_clock
+from utilities.ezo_emulator import EZOpHEmulator, EZOECEmulator
+from utilities.hardware import HardwareContext, set_hardware
+from utilities.i2c_bus import I2CBus
+from utilities.i2c_transport import MemoryI2CTransport
+
+# Flow of the pumps at full throttle (mL/s): peristaltic dosing pumps and the larger fresh water pump
+DOSING_PUMP_FLOW = 1.6
+WATER_PUMP_FLOW = 20.0
+
+
+class SimulatedMotor:
+    """Stand-in for a MotorKit motor: the reservoir reads its throttle to know if liquid is flowing."""
+
+    def __init__(self, name=""):
+        self.name = name
+        self._throttle = 0
+        # Number of times the motor was switched on, handy for benchmarks
+        self.starts = 0
+
+    @property
+    def throttle(self):
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        if value and not self._throttle:
+            self.starts += 1
+        self._throttle = value
+
+
+class SimulatedADC:
+    """
+    Stand-in for the ADS1115 wired to the eTape: channel 1 is the reference (baseline) resistor and channel 0
+    the sensor, whose ratio to the baseline follows the same quadratic get_water_level() inverts.
+    """
+
+    def __init__(self, reservoir, coefficients=QUADRATIC_COEFFICIENTS, baseline=20000, noise=0.0, seed=None):
+        """
+        Args:
+            reservoir: Reservoir whose level is measured.
+            coefficients: (a, b, c) of the eTape curve, ratio = a*level^2 + b*level + c.
+            baseline: Raw value of the baseline channel.
+            noise: Standard deviation (raw ADC counts) of the noise on each conversion.
+            seed: Seed of the noise generator.
+        """
+        self.reservoir = reservoir
+        self.coefficients = coefficients
+        self.baseline = baseline
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.reads = 0
+        # Channel converted in continuous mode, None in single shot mode
+        self.continuous_channel = None
+        self.continuous_gain = 1
+
+    def _noisy(self, value):
+        if self.noise:
+            value += self.random.gauss(0, self.noise)
+        return int(max(-32768, min(32767, round(value))))
+
+    def read_adc(self, channel, gain=1):
+        self.reads += 1
+        if channel == 1:
+            return self._noisy(self.baseline)
+        a, b, c = self.coefficients
+        level = self.reservoir.level_inches
+        return self._noisy(self.baseline * (a * level * level + b * level + c))
+
+    # Continuous conversion mode of the Adafruit ADS1x15 driver: every get_last_result() returns a new conversion
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        self.continuous_channel = channel
+        self.continuous_gain = gain
+        return self.read_adc(channel, gain)
+
+    def get_last_result(self):
+        if self.continuous_channel is None:
+            raise RuntimeError("get_last_result called without start_adc")
+        return self.read_adc(self.continuous_channel, self.continuous_gain)
+
+    def stop_adc(self):
+        self.continuous_channel = None
+
+
+class SimulatedTemperatureSensor:
+    """Stand-in for the 1-wire probe, answering like its sysfs file (thousandths of a degree)."""
+
+    def __init__(self, reservoir):
+        self.reservoir = reservoir
+        self.reads = 0
+
+    def readline(self):
+        self.reads += 1
+        return "%d\n" % round(self.reservoir.temperature_c * 1000)
+
+
+class SimulatedHardware(HardwareContext):
+    """HardwareContext whose devices are the emulated ones of a Simulation."""
+
+    def __init__(self, simulation, bus_number=I2C_BUSNUM):
+        super().__init__(bus_number)
+        self.simulation = simulation
+
+    def _build_i2c_bus(self):
+        return I2CBus(self.bus_number, MemoryI2CTransport(self.simulation.i2c_devices))
+
+    def _build_temp_sensor(self):
+        return SimulatedTemperatureSensor(self.simulation.reservoir)
+
+    def _build_adc(self):
+        return self.simulation.adc
+
+    def _build_water_level_table(self):
+        # The simulated eTape follows the quadratic of its ADC, ignore the calibration of the real reservoir
+        return None
+
+    def _build_telemetry(self):
+        # Kept in memory, simulations must not fill the history of the real system
+        return TelemetryRing(None)
+
+    def _build_dose_ledger(self):
+        from file_operations.dose_ledger import DoseLedger
+        from utilities.pumps import PUMP_NAMES
+        # In memory, simulations must not add to the consumption of the real pumps, and the flows are the simulated
+        # ones rather than the calibration of the real pumps
+        return DoseLedger(None, {name: WATER_PUMP_FLOW if name == 'fresh_water' else DOSING_PUMP_FLOW
+                                 for name in PUMP_NAMES})
+
+    def _build_traffic_recorder(self):
+        # Not recorded unless asked with record_traffic(), simulations must not replace the recording of the real
+        # system
+        return None
+
+    def motor(self, position):
+        return self.simulation.motors[position]
+
+
+class Simulation:
+    """
+    Everything needed to run the control code without the Raspberry Pi: a virtual clock, a reservoir, EZO
+    emulators for the pH and EC boards (as an I2C address -> device dictionary for MemoryI2CTransport), the
+    eTape ADC, the temperature probe and one SimulatedMotor per pump position of user_controlled_constants.py,
+    all gathered in a HardwareContext (self.hardware).
+
+    The reservoir is stepped by the clock, so every sleep of the control code makes simulated time pass.
+    Call install() to make the control code use the simulation.
+    """
+
+    def __init__(self, reservoir=None, sensor_noise=0.0, msb_glitch=True, seed=0, max_step=60.0, clock=None):
+        """
+        Args:
+            reservoir: Reservoir to simulate (a default one is created if None).
+            sensor_noise: Scale of the sensor noise (pH units, 50x that for EC, 100x for ADC counts).
+            msb_glitch: Whether the emulated boards reproduce the Raspberry Pi MSB glitch.
+            seed: Seed for all random generators, so runs are reproducible.
+            max_step: Longest integration step of the reservoir in seconds (pumps and mixing are integrated
+                exactly, so this only needs to be short enough for slow drifts).
+            clock: VirtualClock to run on, to simulate several reservoirs (one per plant) on the same time line.
+                A new one is created if None.
+        """
+        self.clock = clock or VirtualClock(max_step=max_step)
+        self.reservoir = reservoir or Reservoir()
+        self.clock.add_listener(self.reservoir.step)
+
+        self.ph_board = EZOpHEmulator(lambda: self.reservoir.ph, lambda: self.reservoir.temperature_c,
+                                      clock=self.clock.monotonic, noise=sensor_noise, msb_glitch=msb_glitch,
+                                      seed=seed)
+        self.ec_board = EZOECEmulator(lambda: self.reservoir.ec, lambda: self.reservoir.temperature_c,
+                                      clock=self.clock.monotonic, noise=sensor_noise * 50, msb_glitch=msb_glitch,
+                                      seed=seed + 1)
+        self.i2c_devices = {PH_SENSOR_I2C_ADDRESS: self.ph_board, EC_SENSOR_I2C_ADDRESS: self.ec_board}
+        self.adc = SimulatedADC(self.reservoir, noise=sensor_noise * 100, seed=seed + 2)
+
+        # Motor positions are written like 'driver0.motor4' in user_controlled_constants.py
+        self.motors = {}
+        for position, liquid, flow, direction in (
+                (WATER_PUMP_POSITION, FRESH_WATER, WATER_PUMP_FLOW, WATER_PUMP_DIRECTION),
+                (NUTRIENT_PUMP1_POSITION, NUTRIENT_CONCENTRATE, DOSING_PUMP_FLOW, NUTRIENT_PUMP1_DIRECTION),
+                (NUTRIENT_PUMP2_POSITION, NUTRIENT_CONCENTRATE, DOSING_PUMP_FLOW, NUTRIENT_PUMP2_DIRECTION),
+                (NUTRIENT_PUMP3_POSITION, NUTRIENT_CONCENTRATE, DOSING_PUMP_FLOW, NUTRIENT_PUMP3_DIRECTION),
+                (NUTRIENT_PUMP4_POSITION, NUTRIENT_CONCENTRATE, DOSING_PUMP_FLOW, NUTRIENT_PUMP4_DIRECTION),
+                (PH_DOWN_PUMP_POSITION, PH_DOWN_SOLUTION, DOSING_PUMP_FLOW, PH_DOWN_PUMP_DIRECTION),
+                (PH_UP_PUMP_POSITION, PH_UP_SOLUTION, DOSING_PUMP_FLOW, PH_UP_PUMP_DIRECTION)):
+            motor = SimulatedMotor(position)
+            self.motors[position] = motor
+            self.reservoir.connect_pump(motor, liquid, flow, direction)
+
+        self.hardware = SimulatedHardware(self)
+        self._previous_clock = None
+        self._previous_hardware = None
+
+    def install(self):
+        """Make the whole package use the virtual clock and the emulated hardware of this simulation."""
+        self._previous_clock = set_clock(self.clock)
+        self._previous_hardware = set_hardware(self.hardware)
+        return self
+
+    def uninstall(self):
+        """Give the package back the clock and hardware it used before install()."""
+        if self._previous_clock is not None:
+            set_clock(self._previous_clock)
+            set_hardware(self._previous_hardware)
+            self._previous_clock = None
+            self._previous_hardware = None
+
+    def run_for(self, seconds):
+        """Let simulated time pass without the control code doing anything."""
+        self.clock.advance(seconds)
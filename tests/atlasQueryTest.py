@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import sys
+import threading
+
+from simulation.reservoir import Reservoir
+from simulation.simulated_hardware import Simulation
+from utilities import clock
+from utilities.AtlasI2C import get_ph_and_ec, get_ph_and_ec_async, query_many, query_many_async, parse_reading
+from utilities.hardware import HardwareContext, set_hardware, use_hardware
+
+# Run from the repository root: python -m tests.atlasQueryTest
+# Checks of the locking of the Atlas boards on the simulated reservoir, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def simulation():
+    return Simulation(Reservoir(volume_l=20.0, ppm=800.0, ph=6.2), msb_glitch=False).install()
+
+
+def test_repeated_board_rejected():
+    sim = simulation()
+    try:
+        ph_sensor = sim.hardware.ph_sensor
+        for name, run in (('query_many', lambda queries: query_many(queries)),
+                          ('query_many_async', lambda queries: asyncio.run(query_many_async(queries)))):
+            try:
+                run([(ph_sensor, 'R'), (sim.hardware.ec_sensor, 'R'), (ph_sensor, 'R')])
+                rejected = False
+            except ValueError:
+                rejected = True
+            check('%s rejects a board listed twice' % name, rejected)
+            check('%s releases the boards after rejecting' % name, not ph_sensor.lock.locked())
+    finally:
+        sim.uninstall()
+
+
+def test_async_waits_for_lock():
+    # A thread (here the test) holding a board: the coroutines must not send anything until it is released
+    sim = simulation()
+    try:
+        ph_sensor, ec_sensor = sim.hardware.ph_sensor, sim.hardware.ec_sensor
+        sent = []
+        for sensor in (ph_sensor, ec_sensor):
+            original_send = sensor.send
+
+            def send(command, sensor=sensor, original_send=original_send):
+                sent.append((clock.monotonic(), sensor.address))
+                return original_send(command)
+            sensor.send = send
+
+        async def hold_then_release():
+            await clock.async_sleep(2.0)
+            released_at.append(clock.monotonic())
+            ph_sensor.lock.release()
+
+        async def run():
+            return await asyncio.gather(query_many_async([(ph_sensor, 'R'), (ec_sensor, 'R')]),
+                                        ec_sensor.query_async('R'), hold_then_release())
+        released_at = []
+        ph_sensor.lock.acquire()
+        (ph_response, ec_response), ec_alone, _ = asyncio.run(run())
+        ph_sent = [at for at, address in sent if address == ph_sensor.address]
+        check('no command sent to a locked board', ph_sent and min(ph_sent) >= released_at[0],
+              'sent at %s, released at %s' % (sent, released_at))
+        check('the other board keeps answering meanwhile', min(at for at, _ in sent) < released_at[0])
+        check('every response is a reading', all(float(response.rstrip('\0')) > 0
+                                                 for response in (ph_response, ec_response, ec_alone)),
+              str((ph_response, ec_response, ec_alone)))
+        check('boards released after the async queries', not ph_sensor.lock.locked() and not ec_sensor.lock.locked())
+    finally:
+        sim.uninstall()
+
+
+def test_async_ph_and_ec():
+    # The 1-wire temperature is read off the event loop thread, on the reservoir of the calling thread
+    sim = simulation()
+    try:
+        temp_sensor = sim.hardware.temp_sensor
+        original_readline = temp_sensor.readline
+        read_in = []
+
+        def readline():
+            read_in.append(threading.get_ident())
+            return original_readline()
+        temp_sensor.readline = readline
+        ph, ec = get_ph_and_ec()
+        sim.hardware.sensor_cache.invalidate('ph', 'ec', 'temp_c')
+        # The default hardware of another plant would have no temperature probe here
+        previous = set_hardware(HardwareContext())
+        try:
+            with use_hardware(sim.hardware):
+                ph_async, ec_async = asyncio.run(get_ph_and_ec_async())
+        finally:
+            set_hardware(previous)
+        check('async pH and EC read like the blocking ones',
+              ph_async is not None and ec_async is not None and abs(ph_async - ph) < 0.05
+              and abs(ec_async - ec) < 20, str((ph, ec, ph_async, ec_async)))
+        check('async temperature read in a worker thread', len(read_in) == 2 and read_in[1] != read_in[0],
+              str(read_in))
+    finally:
+        sim.uninstall()
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_parse_errors_per_sensor():
+    # The errors of one board must not hide those of the other within the rate limit interval
+    records = Records()
+    logger = logging.getLogger('utilities.AtlasI2C')
+    logger.addHandler(records)
+    try:
+        for response, name in (('Error 99: 255', 'pH'), ('Error 100: 255', 'EC'), ('Error 99: 255', 'pH')):
+            parse_reading(response, name)
+    finally:
+        logger.removeHandler(records)
+    check('parse errors are rate limited per sensor',
+          [message.split()[-2] for message in records.messages] == ['pH', 'EC'], str(records.messages))
+
+
+logging.disable(logging.INFO)
+test_parse_errors_per_sensor()
+test_repeated_board_rejected()
+test_async_waits_for_lock()
+test_async_ph_and_ec()
+sys.exit(1 if failures else 0)
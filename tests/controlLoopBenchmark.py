@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from simulation.reservoir import NUTRIENT_CONCENTRATE, Reservoir
+from simulation.simulated_hardware import Simulation
+from user_controlled_constants import BLUEBERRY_PLANT
+from Water_level_nutrients_ph_manager.nutrient_dosing import NutrientResponseModel, calibrated_rates
+from Water_level_nutrients_ph_manager.ph_controllers import make_ph_controller, PH_CONTROLLERS
+from Water_level_nutrients_ph_manager.ph_management import balance_PH_exact
+from Water_level_nutrients_ph_manager.water_management import fill_water, dose_nutrients
+from file_operations.plant_vals_file_manager import write_to_file
+import main
+
+# Run from the repository root: python -m tests.controlLoopBenchmark [--save-baseline]
+# Runs the control loops on the simulated reservoir and reports, for every controller:
+# - the simulated time to bring the pH to the target (balance_PH_exact), and the pH error once mixed in,
+# - the simulated time to bring the nutrients to the target ppm (dose_nutrients), and the ppm error,
+# - how far the fill overshoots the target level (fill_water),
+# - the I2C transactions and the CPU time of one monitoring pass (monitor_hydroponic_system).
+# The results are compared with the baseline saved in BASELINE_FILE: the script exits with status 1 if a metric
+# got worse than its threshold allows. --save-baseline records the current results as the new baseline.
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controlLoopBaseline.json')
+PLANT = BLUEBERRY_PLANT['plant']
+PH_DOSING_TIME = PLANT['ph_settings']['dosing_time']
+TARGET_MIN_MAX_PH = PLANT['ph_settings']['target_min_ph'], PLANT['ph_settings']['target_max_ph']
+NUTRIENT_WAIT_TIME_LOOP = PLANT['nutrient_settings']['wait_time_loop']
+# Time left to the reservoir after a run so the last doses blend in before measuring the result (seconds)
+SETTLE_TIME = 300
+# Every scenario is run with these seeds, the metrics are averaged
+SEEDS = (0, 1, 2)
+# Monitoring passes timed for the CPU time metric
+MONITOR_PASSES = 50
+# Allowed regression of each metric, by the end of its name: (relative, absolute), a metric fails when
+# value > baseline * (1 + relative) + absolute. Every metric is better lower.
+THRESHOLDS = {
+    'seconds': (0.10, 1.0),
+    'error': (0.25, 0.01),
+    'overshoot_in': (0.10, 0.02),
+    'i2c_per_pass': (0.0, 0.5),
+    'cpu_ms_per_pass': (0.50, 0.5),
+}
+
+
+def simulation(seed, **reservoir_settings):
+    return Simulation(Reservoir(**reservoir_settings), msb_glitch=False, sensor_noise=0.002, seed=seed).install()
+
+
+def average(values):
+    return sum(values) / len(values)
+
+
+def ph_metrics(controller_name):
+    seconds, errors = [], []
+    for seed in SEEDS:
+        for start_ph in (7.0, 5.2):
+            sim = simulation(seed, volume_l=20.0, ppm=800.0, ph=start_ph)
+            try:
+                start = sim.clock.monotonic()
+                balance_PH_exact(TARGET_MIN_MAX_PH, PH_DOSING_TIME, make_ph_controller(controller_name))
+                seconds.append(sim.clock.monotonic() - start)
+                sim.run_for(SETTLE_TIME)
+                errors.append(abs(sim.reservoir.ph - TARGET_MIN_MAX_PH[0]))
+            finally:
+                sim.uninstall()
+    return {'ph.%s.seconds' % controller_name: average(seconds), 'ph.%s.error' % controller_name: average(errors)}
+
+
+def ppm_metrics(name, learned, seed_error=None):
+    """
+    Args:
+        seed_error: Strength of the simulated concentrate over the one the learned model is seeded with, the model
+            starts from a probe pass if None.
+    """
+    target_ppm = 1000.0
+    seconds, errors = [], []
+    # The learned model carries over from one run to the next, as it does between refills
+    model = None
+    for seed in SEEDS:
+        sim = simulation(seed, volume_l=20.0, ppm=400.0, ph=6.0)
+        try:
+            if learned and model is None:
+                initial_rates = None
+                if seed_error is not None:
+                    # A seed that is off, as measured values can be, not the values the simulator runs on
+                    initial_rates = calibrated_rates(sim.hardware.dose_ledger.flow_rates,
+                                                     NUTRIENT_CONCENTRATE.nutrient_mg_per_ml / seed_error,
+                                                     sim.reservoir.liters_per_inch,
+                                                     [pump.name for pump in sim.hardware.nutrient_pumps])
+                model = NutrientResponseModel(initial_rates=initial_rates)
+            pump_info = list(zip(sim.hardware.nutrient_pumps, PLANT['nutrient_settings']['nutrient_pump_times']))
+            start = sim.clock.monotonic()
+            dose_nutrients(target_ppm, pump_info, NUTRIENT_WAIT_TIME_LOOP, model, learned=learned)
+            seconds.append(sim.clock.monotonic() - start)
+            sim.run_for(SETTLE_TIME)
+            errors.append(abs(sim.reservoir.ppm - target_ppm) / target_ppm)
+        finally:
+            sim.uninstall()
+    return {'ppm.%s.seconds' % name: average(seconds), 'ppm.%s.error' % name: average(errors)}
+
+
+def fill_metrics(name, predictive):
+    target_level = 9.0
+    seconds, overshoots = [], []
+    for seed in SEEDS:
+        sim = simulation(seed, volume_l=5.0, ppm=800.0, ph=6.0)
+        try:
+            start = sim.clock.monotonic()
+            fill_water(target_level, predictive)
+            seconds.append(sim.clock.monotonic() - start)
+            overshoots.append(max(0.0, sim.reservoir.level_inches - target_level))
+        finally:
+            sim.uninstall()
+    return {'fill.%s.seconds' % name: average(seconds), 'fill.%s.overshoot_in' % name: average(overshoots)}
+
+
+def monitor_metrics():
+    sim = simulation(0, volume_l=20.0, ppm=800.0, ph=6.0)
+    try:
+        filename = 'benchmark.txt'
+        level = sim.reservoir.level_inches
+        write_to_file(filename, 800, level, 800, level)
+        pump_info = list(zip(sim.hardware.nutrient_pumps, PLANT['nutrient_settings']['nutrient_pump_times']))
+        bus = sim.hardware.i2c_bus
+
+        def transactions():
+            return sum(stats['writes'] + stats['reads'] for stats in bus.stats().values())
+
+        def monitor_pass():
+            main.monitor_hydroponic_system(filename, PLANT['water_settings']['level_change_threshold'],
+                                           PLANT['water_settings']['wait_time_between_checks'], TARGET_MIN_MAX_PH,
+                                           PH_DOSING_TIME, PLANT['nutrient_settings']['ppm_safety_margin'],
+                                           pump_info, NUTRIENT_WAIT_TIME_LOOP)
+        # The first pass builds the devices, it is not timed
+        monitor_pass()
+        before = transactions()
+        cpu_start = time.process_time()
+        for _ in range(MONITOR_PASSES):
+            monitor_pass()
+        cpu = time.process_time() - cpu_start
+        return {'monitor.i2c_per_pass': (transactions() - before) / MONITOR_PASSES,
+                'monitor.cpu_ms_per_pass': cpu * 1000 / MONITOR_PASSES}
+    finally:
+        sim.uninstall()
+
+
+def run_benchmarks():
+    results = {}
+    for controller_name in PH_CONTROLLERS:
+        results.update(ph_metrics(controller_name))
+    results.update(ppm_metrics('fixed', False))
+    results.update(ppm_metrics('learned', True))
+    results.update(ppm_metrics('learned_seeded', True, seed_error=2.0))
+    results.update(fill_metrics('fixed', False))
+    results.update(fill_metrics('predictive', True))
+    results.update(monitor_metrics())
+    return results
+
+
+def threshold(metric):
+    for suffix, allowed in THRESHOLDS.items():
+        if metric.endswith(suffix):
+            return allowed
+    return 0.10, 0.0
+
+
+def compare(results, baseline):
+    """Print every metric next to its baseline, return the names of the metrics that regressed."""
+    regressions = []
+    print('%-34s %12s %12s  %s' % ('metric', 'value', 'baseline', ''))
+    for metric, value in results.items():
+        reference = baseline.get(metric)
+        status = ''
+        if reference is not None:
+            relative, absolute = threshold(metric)
+            if value > reference * (1 + relative) + absolute:
+                status = 'REGRESSION'
+                regressions.append(metric)
+        print('%-34s %12.4f %12s  %s' % (metric, value, '-' if reference is None else '%.4f' % reference, status))
+    return regressions
+
+
+# The control loops log every step, keep the report readable
+logging.disable(logging.INFO)
+# The monitoring pass writes the plant state files, keep them out of the repository
+os.chdir(tempfile.mkdtemp())
+benchmark_results = run_benchmarks()
+if '--save-baseline' in sys.argv:
+    with open(BASELINE_FILE, 'w') as baseline_file:
+        json.dump(benchmark_results, baseline_file, indent=2, sort_keys=True)
+    compare(benchmark_results, {})
+    print('Baseline saved to %s' % BASELINE_FILE)
+    sys.exit(0)
+try:
+    with open(BASELINE_FILE) as baseline_file:
+        saved_baseline = json.load(baseline_file)
+except FileNotFoundError:
+    saved_baseline = {}
+    print('No baseline yet, run with --save-baseline to record one')
+failed = compare(benchmark_results, saved_baseline)
+if failed:
+    print('%d metric(s) regressed: %s' % (len(failed), ', '.join(failed)))
+sys.exit(1 if failed else 0)
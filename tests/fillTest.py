@@ -0,0 +1,128 @@
+import builtins
+import contextlib
+import io
+import logging
+import sys
+import tempfile
+
+from file_operations import plant_vals_file_manager
+from file_operations.plant_vals_file_manager import PlantStateStore, read_from_file, write_to_file
+from simulation.reservoir import Reservoir
+from simulation.simulated_hardware import Simulation
+from user_controlled_constants import QUADRATIC_COEFFICIENTS, WATER_LEVEL_MAX_LEVEL, WATER_PUMP_POSITION
+from utilities.hardware import get_hardware
+from Water_level_nutrients_ph_manager.read_water_sensor import WaterLevelSampler
+from Water_level_nutrients_ph_manager.water_management import fill_water, fill_water_predictive
+import main
+
+# Run from the repository root: python -m tests.fillTest
+# Checks of the water fill on the simulated reservoir, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def simulation():
+    return Simulation(Reservoir(volume_l=10.0, ppm=800.0, ph=6.0), msb_glitch=False, sensor_noise=0.002).install()
+
+
+def test_target_above_sensor_rejected():
+    # The readings stop at WATER_LEVEL_MAX_LEVEL, a higher target would run the pump until the reservoir overflows
+    for name, fill in (('fixed', lambda level: fill_water(level, predictive=False)),
+                       ('predictive', lambda level: fill_water(level, predictive=True)),
+                       ('fill_water_predictive', fill_water_predictive)):
+        sim = simulation()
+        try:
+            try:
+                fill(WATER_LEVEL_MAX_LEVEL + 1)
+                rejected = False
+            except ValueError:
+                rejected = True
+            check('%s fill rejects a target above the sensor' % name,
+                  rejected and sim.motors[WATER_PUMP_POSITION].starts == 0)
+        finally:
+            sim.uninstall()
+
+
+def test_fill_returns_level():
+    # Both fills return the level read once the pump stopped
+    for predictive in (False, True):
+        sim = Simulation(Reservoir(volume_l=5.0, ppm=800.0, ph=6.0), msb_glitch=False, sensor_noise=0.002).install()
+        try:
+            level = fill_water(9.0, predictive)
+            check('%s fill returns the final level' % ('predictive' if predictive else 'fixed'),
+                  level is not None and level >= 9.0 - 0.1 and abs(level - sim.reservoir.level_inches) < 0.1,
+                  '%s returned, reservoir at %.2f in' % (level, sim.reservoir.level_inches))
+        finally:
+            sim.uninstall()
+
+
+def test_oversampled_level():
+    # The oversampled reading works with and without NumPy (lists instead of arrays)
+    sim = Simulation(Reservoir(volume_l=10.0, ppm=800.0, ph=6.0), msb_glitch=False, sensor_noise=0.002).install()
+    try:
+        for reduction in ('median', 'trimmed_mean', 'mean'):
+            sampler = WaterLevelSampler(get_hardware().adc, reduction=reduction)
+            readings = []
+            if sampler.numpy is not None:
+                readings.append(('numpy', sampler.read(*QUADRATIC_COEFFICIENTS)))
+                sampler.numpy = None
+                sampler.buffer = [[0.0] * sampler.samples, [0.0] * sampler.samples]
+            readings.append(('lists', sampler.read(*QUADRATIC_COEFFICIENTS)))
+            for mode, level in readings:
+                check('oversampled %s level on %s' % (reduction, mode),
+                      abs(level - sim.reservoir.level_inches) < 0.1,
+                      '%.2f read, reservoir at %.2f in' % (level, sim.reservoir.level_inches))
+    finally:
+        sim.uninstall()
+
+
+def test_target_prompt():
+    answers = iter(['14', '0', '9'])
+    original_input = builtins.input
+    builtins.input = lambda prompt='': next(answers)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            level = main.ask_target_water_level()
+    finally:
+        builtins.input = original_input
+    check('setup asks again for a level out of the sensor range', level == 9, str(level))
+
+
+def test_saved_target_above_sensor():
+    # A target saved before the setup checked it is asked again, the refills would refuse it forever
+    original_store = plant_vals_file_manager.plant_state_store
+    plant_vals_file_manager.plant_state_store = PlantStateStore(tempfile.mkdtemp())
+    answers = iter(['9'])
+    original_input = builtins.input
+    builtins.input = lambda prompt='': next(answers)
+    try:
+        write_to_file('basil', 800, 14, 750, 8.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.check_saved_target_water_level('basil')
+        saved = read_from_file('basil')
+        main.check_saved_target_water_level('basil')
+        check('a saved target above the sensor is asked again',
+              saved.target_water_level == 9 and saved.target_ppm == 800 and saved.current_water_level == 8.0
+              and read_from_file('basil') == saved, str(saved))
+        main.check_saved_target_water_level('mint')
+    finally:
+        builtins.input = original_input
+        plant_vals_file_manager.plant_state_store = original_store
+
+
+logging.disable(logging.INFO)
+test_target_above_sensor_rejected()
+test_fill_returns_level()
+test_oversampled_level()
+test_target_prompt()
+test_saved_target_above_sensor()
+sys.exit(1 if failures else 0)
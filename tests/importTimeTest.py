@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import sys
+
+# Run from the repository root: python -m tests.importTimeTest
+# Importing the control modules must be quick and must not touch the hardware, so tools, tests and a restarted
+# daemon start straight away. Each module is imported in a fresh interpreter and timed.
+
+# Maximum time (seconds) allowed to import each module
+IMPORT_TIME_BUDGET = 0.25
+MODULES = [
+    'main',
+    'Water_level_nutrients_ph_manager.water_management',
+    'Water_level_nutrients_ph_manager.ph_management',
+    'Water_level_nutrients_ph_manager.read_water_sensor',
+    'Water_level_nutrients_ph_manager.plant_tasks',
+    'utilities.AtlasI2C',
+    'utilities.pumps',
+]
+# Libraries that talk to the hardware, they must only be loaded when a device is first used
+HARDWARE_MODULES = ['Adafruit_ADS1x15', 'adafruit_motorkit', 'Adafruit_GPIO', 'board', 'busio']
+
+CHECK_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+from utilities.hardware import get_hardware
+loaded = [name for name in {hardware_modules!r} if name in sys.modules]
+print(json.dumps([elapsed, get_hardware().built(), loaded]))
+'''
+
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+failures = 0
+for module in MODULES:
+    script = CHECK_SCRIPT.format(module=module, hardware_modules=HARDWARE_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], cwd=repository_root, capture_output=True, text=True)
+    if output.returncode != 0:
+        print('FAIL %s: import error\n%s' % (module, output.stderr))
+        failures += 1
+        continue
+    elapsed, built, loaded = json.loads(output.stdout.strip().splitlines()[-1])
+    problems = []
+    if elapsed > IMPORT_TIME_BUDGET:
+        problems.append('took %.3f s (budget %.3f s)' % (elapsed, IMPORT_TIME_BUDGET))
+    if built:
+        problems.append('built hardware at import time: %s' % built)
+    if loaded:
+        problems.append('loaded hardware libraries: %s' % loaded)
+    if problems:
+        failures += 1
+        print('FAIL %s: %s' % (module, ', '.join(problems)))
+    else:
+        print('ok   %s: %.1f ms' % (module, elapsed * 1000))
+
+sys.exit(1 if failures else 0)
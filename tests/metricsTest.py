@@ -0,0 +1,110 @@
+import logging
+import sys
+import urllib.error
+import urllib.request
+
+from utilities import metrics
+from utilities.metrics import MetricsRegistry, NULL_METRIC
+
+# Run from the repository root: python -m tests.metricsTest
+# Checks of the Prometheus text served on /metrics, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def test_text_format():
+    registry = MetricsRegistry()
+    registry.gauge('reservoir_ph', 'Last pH reading.').set(6.2)
+    starts = registry.counter('pump_starts_total', 'Pump starts.', ['pump'])
+    starts.labels('ph_up').inc()
+    starts.labels('ph_up').inc()
+    starts.labels('say "hi"\\\n').inc()
+    latency = registry.histogram('i2c_seconds', 'I2C transaction time.', ['sensor'], buckets=(0.01, 0.1))
+    for seconds in (0.005, 0.05, 0.05, 2.0):
+        latency.labels('ph').observe(seconds)
+    expected = '\n'.join([
+        '# HELP i2c_seconds I2C transaction time.',
+        '# TYPE i2c_seconds histogram',
+        'i2c_seconds_bucket{sensor="ph",le="0.01"} 1.0',
+        'i2c_seconds_bucket{sensor="ph",le="0.1"} 3.0',
+        'i2c_seconds_bucket{sensor="ph",le="+Inf"} 4.0',
+        'i2c_seconds_sum{sensor="ph"} 2.105',
+        'i2c_seconds_count{sensor="ph"} 4.0',
+        '# HELP pump_starts_total Pump starts.',
+        '# TYPE pump_starts_total counter',
+        'pump_starts_total{pump="ph_up"} 2.0',
+        'pump_starts_total{pump="say \\"hi\\"\\\\\\n"} 1.0',
+        '# HELP reservoir_ph Last pH reading.',
+        '# TYPE reservoir_ph gauge',
+        'reservoir_ph 6.2',
+    ]) + '\n'
+    text = registry.render()
+    check('metrics render as Prometheus text, sorted by name, with cumulative buckets and escaped labels',
+          text == expected, '\n' + text)
+
+
+def test_registration():
+    registry = MetricsRegistry()
+    first = registry.counter('dose_total', 'Doses.', ['pump'])
+    check('a metric registered twice is shared', registry.counter('dose_total', 'Doses.', ['pump']) is first)
+    try:
+        registry.gauge('dose_total', 'Doses.', ['pump'])
+        rejected = False
+    except ValueError:
+        rejected = True
+    check('a name registered with another type is rejected', rejected)
+    try:
+        first.labels('ph_up', 'extra')
+        rejected = False
+    except ValueError:
+        rejected = True
+    check('wrong label values are rejected', rejected)
+
+
+def test_disabled():
+    previous = metrics.enabled
+    metrics.enabled = False
+    try:
+        check('disabled metrics are do-nothing metrics', metrics.counter('unused_total', 'Unused.') is NULL_METRIC
+              and metrics.registry.get('unused_total') is None)
+    finally:
+        metrics.enabled = previous
+
+
+def test_http_server():
+    metrics.registry.gauge('metrics_test_value', 'Value served by the test.').set(3)
+    server = metrics.start_http_server(port=0, address='127.0.0.1')
+    try:
+        address = 'http://127.0.0.1:%d' % server.server_address[1]
+        with urllib.request.urlopen(address + '/metrics') as response:
+            content_type = response.headers['Content-Type']
+            body = response.read().decode('utf-8')
+        check('/metrics serves the registry', body == metrics.registry.render()
+              and 'metrics_test_value 3.0\n' in body and content_type.startswith('text/plain; version=0.0.4'),
+              content_type)
+        try:
+            urllib.request.urlopen(address + '/other')
+            status = 200
+        except urllib.error.HTTPError as error:
+            status = error.code
+        check('other paths are not found', status == 404, str(status))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+logging.disable(logging.ERROR)
+test_text_format()
+test_registration()
+test_disabled()
+test_http_server()
+sys.exit(1 if failures else 0)
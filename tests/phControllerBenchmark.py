@@ -0,0 +1,63 @@
+import logging
+import sys
+
+from simulation.reservoir import Reservoir
+from simulation.simulated_hardware import Simulation
+from user_controlled_constants import BLUEBERRY_PLANT, PH_TOLERANCE
+from Water_level_nutrients_ph_manager.ph_controllers import BangBangController, PIDController, TitrationController
+from Water_level_nutrients_ph_manager.ph_management import run_ph_controller
+
+# Run from the repository root: python -m tests.phControllerBenchmark
+# Compares the pH controllers on the simulated reservoir: number of pulses (balancing cycles), simulated time,
+# pH error once everything dosed is mixed in, and volume of pH up/down used. The bang-bang controller with no
+# tolerance is the original balance_PH_exact loop.
+
+PH_DOSING_TIME = BLUEBERRY_PLANT['plant']['ph_settings']['dosing_time']
+# Time left to the reservoir after the run so the last doses blend in before measuring the final pH (seconds)
+SETTLE_TIME = 300
+# (name, reservoir settings, target pH)
+SCENARIOS = [
+    ('20 L, 800 ppm, pH 7.0 -> 6.0', dict(volume_l=20.0, ppm=800.0, ph=7.0), 6.0),
+    ('20 L, 800 ppm, pH 5.4 -> 6.0', dict(volume_l=20.0, ppm=800.0, ph=5.4), 6.0),
+    ('10 L, 300 ppm, pH 6.6 -> 6.0', dict(volume_l=10.0, ppm=300.0, ph=6.6), 6.0),
+    ('25 L, 1200 ppm, pH 6.4 -> 5.9', dict(volume_l=25.0, ppm=1200.0, ph=6.4), 5.9),
+]
+CONTROLLERS = [
+    ('bang-bang (original)', lambda: BangBangController(), 0.0),
+    ('pid', lambda: PIDController(), PH_TOLERANCE),
+    ('titration', lambda: TitrationController(), PH_TOLERANCE),
+]
+
+
+def run_scenario(reservoir_settings, target_ph, controller, tolerance):
+    simulation = Simulation(Reservoir(**reservoir_settings), msb_glitch=False, sensor_noise=0.002).install()
+    try:
+        start = simulation.clock.monotonic()
+        pulses = run_ph_controller(target_ph, PH_DOSING_TIME, controller, tolerance)
+        elapsed = simulation.clock.monotonic() - start
+        simulation.run_for(SETTLE_TIME)
+        dosed = simulation.reservoir.dispensed_ml
+        return dict(pulses=pulses, time=elapsed, error=simulation.reservoir.ph - target_ph,
+                    ml=dosed.get('ph_up', 0.0) + dosed.get('ph_down', 0.0))
+    finally:
+        simulation.uninstall()
+
+
+# The controllers log every pulse, keep the report readable
+logging.disable(logging.INFO)
+print('%-32s %-22s %7s %9s %10s %8s' % ('scenario', 'controller', 'pulses', 'time (s)', 'pH error', 'mL'))
+baseline_pulses = 0
+controller_pulses = {}
+for scenario_name, reservoir_settings, target in SCENARIOS:
+    for controller_name, make_controller, controller_tolerance in CONTROLLERS:
+        result = run_scenario(reservoir_settings, target, make_controller(), controller_tolerance)
+        controller_pulses[controller_name] = controller_pulses.get(controller_name, 0) + result['pulses']
+        print('%-32s %-22s %7d %9.0f %+10.3f %8.2f' % (scenario_name, controller_name, result['pulses'],
+                                                       result['time'], result['error'], result['ml']))
+
+print()
+baseline = controller_pulses[CONTROLLERS[0][0]]
+for controller_name, pulses in controller_pulses.items():
+    print('%-22s %5d pulses in total, %.0f%% of the original loop' % (controller_name, pulses,
+                                                                      100.0 * pulses / baseline))
+sys.exit(0)
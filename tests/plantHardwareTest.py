@@ -0,0 +1,93 @@
+import sys
+import threading
+
+from Water_level_nutrients_ph_manager.plant_tasks import MultiPlantController
+from user_controlled_constants import ADC_BUSNUM, EC_SENSOR_I2C_ADDRESS
+from utilities.hardware import HardwareContext, get_hardware
+from utilities.pumps import Pump
+
+# Run from the repository root: python -m tests.plantHardwareTest
+# Checks of the hardware given to each plant, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def test_plant_settings():
+    hardware = HardwareContext(settings={'I2C_BUSNUM': 3, 'PH_SENSOR_I2C_ADDRESS': 0x30}, name='tomato')
+    check('plant settings override the constants', hardware.bus_number == 3 and
+          hardware.setting('PH_SENSOR_I2C_ADDRESS') == 0x30 and
+          hardware.setting('EC_SENSOR_I2C_ADDRESS') == EC_SENSOR_I2C_ADDRESS)
+    check('plant files get the plant name', hardware.own_file('/logs/telemetry.ring') == '/logs/telemetry_tomato.ring'
+          and HardwareContext().own_file('/logs/telemetry.ring') == '/logs/telemetry.ring')
+    check('the ADC follows the plant bus unless it has its own',
+          hardware.adc_bus_number == 3 and HardwareContext().adc_bus_number == ADC_BUSNUM and
+          HardwareContext(settings={'I2C_BUSNUM': 3, 'ADC_BUSNUM': 4}).adc_bus_number == 4 and
+          HardwareContext(settings={'ADC_BUSNUM': 4}).adc_bus_number == 4)
+    try:
+        HardwareContext(settings={'PH_SENSOR_ADDRESS': 0x30})
+        rejected = False
+    except ValueError:
+        rejected = True
+    check('unknown plant settings are rejected', rejected)
+
+
+def test_shared_reservoir_rejected():
+    try:
+        MultiPlantController({'basil': {}, 'mint': {}}, lambda *args: None).start()
+        rejected = False
+    except ValueError:
+        rejected = True
+    check('two plants on the default hardware are rejected', rejected)
+
+
+def test_plants_use_their_hardware():
+    own = {'basil': HardwareContext(name='basil'), 'mint': None}
+    used = {}
+    controller = MultiPlantController({'basil': {}, 'mint': {}},
+                                      lambda plant_name, plant_params, stop_event:
+                                      used.__setitem__(plant_name, get_hardware()),
+                                      own.get).start()
+    controller.join()
+    check('each plant thread runs on its own hardware',
+          used.get('basil') is own['basil'] and used.get('mint') is get_hardware(), str(used))
+
+
+class Motor:
+    throttle = 0
+
+
+def test_failed_stop_releases_pump():
+    # A stop that fails (here a listener) must still hand the pump over, or the other plants wait for it forever
+    pump = Pump(Motor(), 1, 'nutrient1')
+
+    def failing_listener(pump, running):
+        if not running:
+            raise OSError(28, 'No space left on device')
+    pump.listeners.append(failing_listener)
+    pump.start()
+    try:
+        pump.stop()
+    except OSError:
+        pass
+    other = threading.Thread(target=pump.start, daemon=True)
+    other.start()
+    other.join(1.0)
+    check('a failed stop releases the pump', not other.is_alive() and pump.owner == other.ident)
+    pump.owner = None
+    pump.lock.release()
+
+
+test_plant_settings()
+test_shared_reservoir_rejected()
+test_plants_use_their_hardware()
+test_failed_stop_releases_pump()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,99 @@
+import logging
+import sys
+import tempfile
+
+from file_operations.plant_vals_file_manager import PlantState, PlantStateStore
+from utilities import clock
+
+# Run from the repository root: python -m tests.plantStateTest
+# Checks of the plant state files, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def on_disk(store, filename):
+    """State of a plant as a restarted controller would read it."""
+    return PlantStateStore(store.directory, min_interval=store.min_interval).load(filename)
+
+
+def test_legacy_file():
+    store = PlantStateStore(tempfile.mkdtemp(), min_interval=60)
+    with open(store.path('basil'), 'w') as legacy_file:
+        legacy_file.write('800,5.5,750.25,4.333\n')
+    state = store.read('basil')
+    check('legacy files are read and rounded', state == PlantState(800.0, 5.5, 750.2, 4.33), str(state))
+    store.write('basil', PlantState(800, 5.5, 750.2, 4.331))
+    with open(store.path('basil')) as legacy_file:
+        kept = legacy_file.read()
+    check('a legacy file is not rewritten for the same values', kept == '800,5.5,750.25,4.333\n' and
+          store.commits == 0, repr(kept))
+    store.write('basil', PlantState(900, 5.5, 750.2, 4.33))
+    check('a legacy file is rewritten in the current format on change',
+          on_disk(store, 'basil') == PlantState(900.0, 5.5, 750.2, 4.33) and store.commits == 1)
+
+
+def test_unchanged_write_skipped():
+    store = PlantStateStore(tempfile.mkdtemp(), min_interval=60)
+    store.write('mint', PlantState(800, 5.5, 700, 5.0))
+    committed = store.write('mint', PlantState(800.0, 5.5, 700.04, 5.001))
+    check('a write changing nothing at the stored resolution is skipped',
+          not committed and store.commits == 1 and store.skipped == 1, '%d commits' % store.commits)
+
+
+def test_batched_readings():
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        store = PlantStateStore(tempfile.mkdtemp(), min_interval=60)
+        store.write('mint', PlantState(800, 5.5, 700, 5.0))
+        clock.sleep(10)
+        committed = store.write('mint', PlantState(800, 5.5, 710, 4.9))
+        check('new readings within min_interval are batched',
+              not committed and on_disk(store, 'mint') == PlantState(800.0, 5.5, 700.0, 5.0))
+        check('batched readings are read back before they are committed',
+              store.read('mint') == PlantState(800.0, 5.5, 710.0, 4.9))
+        committed = store.write('mint', PlantState(900, 5.5, 710, 4.9))
+        check('a target change is committed at once',
+              committed and on_disk(store, 'mint') == PlantState(900.0, 5.5, 710.0, 4.9))
+        store.write('mint', PlantState(900, 5.5, 720, 4.8))
+        clock.sleep(60)
+        committed = store.write('mint', PlantState(900, 5.5, 730, 4.7))
+        check('readings are committed once min_interval passed',
+              committed and on_disk(store, 'mint') == PlantState(900.0, 5.5, 730.0, 4.7))
+    finally:
+        clock.set_clock(previous)
+
+
+def test_flush():
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        store = PlantStateStore(tempfile.mkdtemp(), min_interval=60)
+        store.write('basil', PlantState(800, 5.5, 700, 5.0))
+        store.write('mint', PlantState(900, 6.0, 800, 6.0))
+        store.write('basil', PlantState(800, 5.5, 690, 4.9))
+        store.write('mint', PlantState(900, 6.0, 790, 5.9))
+        batched = store.commits
+        store.flush()
+        check('flush commits every batched change',
+              batched == 2 and store.commits == 4 and on_disk(store, 'basil') == PlantState(800.0, 5.5, 690.0, 4.9)
+              and on_disk(store, 'mint') == PlantState(900.0, 6.0, 790.0, 5.9), '%d commits' % store.commits)
+        store.flush()
+        check('a second flush has nothing to commit', store.commits == 4)
+    finally:
+        clock.set_clock(previous)
+
+
+logging.disable(logging.ERROR)
+test_legacy_file()
+test_unchanged_write_skipped()
+test_batched_readings()
+test_flush()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,105 @@
+import json
+import logging
+import sys
+import threading
+
+from file_operations.logging_config import JSONFormatter, RateLimitedLogger
+from utilities import clock
+
+# Run from the repository root: python -m tests.rateLimitedLoggerTest
+# Checks of the rate limited status lines, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+class ListHandler(logging.Handler):
+    """Keep the records instead of writing them."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_logger(name, interval=60):
+    logger = logging.getLogger('tests.rateLimitedLoggerTest.' + name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = ListHandler()
+    logger.addHandler(handler)
+    return RateLimitedLogger(logger, interval=interval), handler
+
+
+def test_suppression():
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        status_log, handler = make_logger('suppression')
+        logged = [status_log.info("pH %.2f", 6.0 + index / 100) for index in range(5)]
+        check('the same message is logged once per interval', logged == [True, False, False, False, False])
+        clock.sleep(59)
+        check('it stays suppressed until the interval passed', not status_log.info("pH %.2f", 6.1))
+        clock.sleep(1)
+        check('the next line after the interval is logged', status_log.info("pH %.2f", 6.2))
+        messages = [record.getMessage() for record in handler.records]
+        check('it counts the lines skipped', messages == ["pH 6.00", "pH 6.20 (5 similar messages skipped)"],
+              str(messages))
+    finally:
+        clock.set_clock(previous)
+
+
+def test_keys():
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        status_log, handler = make_logger('keys')
+        status_log.warning("Could not read %s", 'pH', key=('read', 'pH'))
+        status_log.warning("Could not read %s", 'EC', key=('read', 'EC'))
+        status_log.warning("Could not read %s", 'pH', key=('read', 'pH'))
+        status_log.info("Level %.1f", 5.0)
+        check('messages are limited by key',
+              [record.getMessage() for record in handler.records] == ["Could not read pH", "Could not read EC",
+                                                                      "Level 5.0"])
+
+        def other_plant():
+            threading.current_thread().plant_name = 'mint'
+            status_log.info("Level %.1f", 6.0)
+        thread = threading.Thread(target=other_plant)
+        thread.start()
+        thread.join()
+        check('each plant has its own limit', handler.records[-1].getMessage() == "Level 6.0")
+    finally:
+        clock.set_clock(previous)
+
+
+def test_disabled_level():
+    status_log, handler = make_logger('disabled')
+    status_log.logger.setLevel(logging.INFO)
+    status_log.debug("Raw reading %d", 1)
+    status_log.logger.setLevel(logging.DEBUG)
+    check('a line below the logger level does not start the interval', status_log.debug("Raw reading %d", 2)
+          and [record.getMessage() for record in handler.records] == ["Raw reading 2"])
+
+
+def test_structured_fields():
+    status_log, handler = make_logger('fields')
+    status_log.info("pH %.2f", 6.1, ph=6.1, pump='ph_down')
+    data = json.loads(JSONFormatter().format(handler.records[0]))
+    check('structured fields reach the JSON file',
+          data['message'] == "pH 6.10" and data['ph'] == 6.1 and data['pump'] == 'ph_down', str(data))
+
+
+test_suppression()
+test_keys()
+test_disabled_level()
+test_structured_fields()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,84 @@
+import logging
+import sys
+import threading
+
+from utilities import clock
+from utilities.scheduler import Scheduler
+
+# Run from the repository root: python -m tests.schedulerTest
+# Checks of the periodic job scheduler on a virtual clock, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def test_independent_periods():
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        scheduler = Scheduler()
+        runs = {'ph': 0, 'water': 0}
+        stop_event = threading.Event()
+
+        def count(name):
+            runs[name] += 1
+            if clock.monotonic() >= 100:
+                stop_event.set()
+        scheduler.add('ph', lambda: count('ph'), 10)
+        scheduler.add('water', lambda: count('water'), 30)
+        scheduler.run(stop_event)
+        check('each job runs at its own period', runs == {'ph': 11, 'water': 4}, str(runs))
+    finally:
+        clock.set_clock(previous)
+
+
+def test_overrunning_job_stops():
+    # A job running longer than its period (the pH job waiting for the readings to settle) is due again as soon as
+    # it returns: the scheduler must still see the stop event
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        scheduler = Scheduler()
+        stop_event = threading.Event()
+        runs = []
+
+        def slow_job():
+            runs.append(clock.monotonic())
+            clock.sleep(40)
+            stop_event.set()
+        job = scheduler.add('ph', slow_job, 30)
+        scheduler.run(stop_event)
+        check('an overrunning job stops once the stop event is set', len(runs) == 1, '%d runs' % len(runs))
+        check('the overrun is counted', job.overruns == 1, str(job.stats()))
+    finally:
+        clock.set_clock(previous)
+
+
+def test_stop_between_jobs():
+    previous = clock.set_clock(clock.VirtualClock())
+    try:
+        scheduler = Scheduler()
+        stop_event = threading.Event()
+        ran = []
+        scheduler.add('first', lambda: (ran.append('first'), stop_event.set()), 10)
+        scheduler.add('second', lambda: ran.append('second'), 10)
+        scheduler.run_pending(stop_event)
+        check('jobs due after the stop event are left for later', ran == ['first'], str(ran))
+        stop_event.clear()
+        scheduler.run_pending(stop_event)
+        check('jobs left are run on the next call', ran == ['first', 'second'], str(ran))
+    finally:
+        clock.set_clock(previous)
+
+
+logging.disable(logging.ERROR)
+test_independent_periods()
+test_overrunning_job_stops()
+test_stop_between_jobs()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,104 @@
+import logging
+import sys
+
+from simulation.reservoir import Reservoir
+from simulation.simulated_hardware import Simulation
+from user_controlled_constants import SETTLE_DEAD_TIME, SETTLE_READ_INTERVAL, SETTLE_WINDOW
+from utilities.AtlasI2C import get_ph, invalidate_readings
+from utilities.settling import fit_window, wait_until_settled
+
+# Run from the repository root: python -m tests.settlingTest
+# Checks of the settle detector on a slowly mixing simulated reservoir, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def simulation(mix_time_constant=60.0):
+    return Simulation(Reservoir(volume_l=20.0, ppm=800.0, ph=7.0, mix_time_constant=mix_time_constant),
+                      msb_glitch=False, sensor_noise=0.002).install()
+
+
+def dose_ph_down(sim, seconds):
+    """Run the pH down pump, return the pH read before."""
+    before = get_ph()
+    pump = sim.hardware.ph_down_pump
+    pump.start()
+    sim.clock.sleep(seconds)
+    pump.stop()
+    invalidate_readings()
+    return before
+
+
+def test_small_dose_never_settles():
+    # A short pulse mixing in slowly moves the pH too little to show a slope: it used to look settled at once
+    sim = simulation()
+    try:
+        before = dose_ph_down(sim, 0.1)
+        settled = wait_until_settled(['ph'], 10, SETTLE_DEAD_TIME, baselines={'ph': before})
+        check('small slow dose is not reported settled', not settled)
+    finally:
+        sim.uninstall()
+
+
+def test_large_dose_settles_when_mixed():
+    sim = simulation()
+    try:
+        before = dose_ph_down(sim, 2.0)
+        start = sim.clock.monotonic()
+        settled = wait_until_settled(['ph'], 600, SETTLE_DEAD_TIME, baselines={'ph': before})
+        elapsed = sim.clock.monotonic() - start
+        ph_when_settled = sim.reservoir.ph
+        sim.run_for(600)
+        check('large slow dose settles before the timeout', settled and elapsed < 600, '%.1f s' % elapsed)
+        check('large slow dose settles once mixed in', abs(ph_when_settled - sim.reservoir.ph) < 0.05,
+              'settled at pH %.3f, mixed pH %.3f' % (ph_when_settled, sim.reservoir.ph))
+    finally:
+        sim.uninstall()
+
+
+def test_dead_time():
+    # Nothing dosed: the readings are steady from the start, but the dead time is still waited
+    sim = simulation()
+    try:
+        start = sim.clock.monotonic()
+        settled = wait_until_settled(['ph', 'ec'], 30, SETTLE_DEAD_TIME)
+        elapsed = sim.clock.monotonic() - start
+        check('steady readings settle after the dead time', settled and SETTLE_DEAD_TIME <= elapsed < 30,
+              '%.1f s' % elapsed)
+    finally:
+        sim.uninstall()
+
+
+def test_settles_within_short_timeout():
+    # The pH loop waits LOOP_SLEEP_TIME (10 s) at most: a settled reservoir must release before it, although a
+    # window of SETTLE_WINDOW readings at SETTLE_READ_INTERVAL takes longer than that
+    for names in (['ph'], ['ec'], ['ph', 'ec']):
+        sim = simulation()
+        try:
+            start = sim.clock.monotonic()
+            settled = wait_until_settled(names, 10, SETTLE_DEAD_TIME)
+            elapsed = sim.clock.monotonic() - start
+            check('settled %s releases before a 10 s timeout' % '/'.join(names), settled and elapsed < 10,
+                  '%.1f s' % elapsed)
+        finally:
+            sim.uninstall()
+    window, interval = fit_window(10, 0.9, SETTLE_READ_INTERVAL, SETTLE_WINDOW)
+    check('window fits in half of the timeout', window >= 3 and window * (0.9 + interval) <= 5.0,
+          '%d readings every %.2f s' % (window, 0.9 + interval))
+
+
+logging.disable(logging.INFO)
+test_small_dose_never_settles()
+test_large_dose_settles_when_mixed()
+test_dead_time()
+test_settles_within_short_timeout()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,111 @@
+import logging
+import os
+import sys
+import tempfile
+
+from file_operations.telemetry_ring import (TelemetryRing, EVENT_PUMP_START, EVENT_PUMP_STOP, HEADER_SIZE, KIND_EVENT,
+                                            KIND_FRAME, RECORD_SIZE)
+from utilities.pumps import Pump
+
+# Run from the repository root: python -m tests.telemetryRingTest
+# Checks of the telemetry ring buffer and of the pump listeners, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def ring_path():
+    return os.path.join(tempfile.mkdtemp(), 'telemetry.ring')
+
+
+def test_wrap_around():
+    ring = TelemetryRing(None, capacity=4)
+    for index in range(10):
+        ring.append_frame(6.0 + index / 10, 1000.0 + index, 20.0, 5.0, timestamp=1000.0 + index)
+    records = ring.tail(10)
+    check('ring counts every record', len(ring) == 10, str(len(ring)))
+    check('ring keeps the last capacity records, oldest first',
+          [record.sequence for record in records] == [7, 8, 9, 10]
+          and [record.values[1] for record in records] == [1006.0, 1007.0, 1008.0, 1009.0],
+          str(records))
+    check('tail returns the last n records', [record.sequence for record in ring.tail(2)] == [9, 10])
+    ring.close()
+
+
+def test_reopen():
+    path = ring_path()
+    ring = TelemetryRing(path, capacity=8)
+    ring.append_frame(6.1, 1200.0, 21.5, 7.25, timestamp=1000.0)
+    ring.append_event(EVENT_PUMP_STOP, 3, 2.5, timestamp=1001.0)
+    ring.flush()
+    ring.close()
+    reopened = TelemetryRing(path, capacity=100)
+    check('reopened ring keeps its capacity', reopened.capacity == 8, str(reopened.capacity))
+    frame, event = reopened.tail(10)
+    check('reopened ring reads the records back',
+          frame.kind == KIND_FRAME and abs(frame.values[0] - 6.1) < 1e-5 and frame.values[3] == 7.25
+          and event.kind == KIND_EVENT and event.pump == 3 and event.event == EVENT_PUMP_STOP
+          and event.values[0] == 2.5, str((frame, event)))
+    reopened.append_frame(6.2, 1210.0, 21.5, 7.2)
+    reader = TelemetryRing(path, readonly=True)
+    check('a reader sees the appends of the writer', len(reader) == 3 and reader.tail(1)[0].values[1] == 1210.0)
+    reader.close()
+    reopened.close()
+
+
+def test_uninitialised_file():
+    # A ring created right before a power loss may reach the card without its header
+    path = ring_path()
+    with open(path, 'wb') as ring_file:
+        ring_file.truncate(HEADER_SIZE + 16 * RECORD_SIZE)
+    ring = TelemetryRing(path)
+    ring.append_frame(6.0, 1000.0, 20.0, 5.0)
+    check('zeroed ring file starts again', ring.capacity == 16 and len(ring) == 1, str(ring.capacity))
+    ring.close()
+    with open(path, 'r+b') as ring_file:
+        ring_file.write(b'JUNK')
+    try:
+        TelemetryRing(path)
+        rejected = False
+    except ValueError:
+        rejected = True
+    check('a file that is not a ring is rejected', rejected)
+
+
+class Motor:
+    throttle = 0
+
+
+def test_failing_listener():
+    # A listener failing (full SD card) is logged, the pump keeps working and the other listeners still run
+    ring = TelemetryRing(None, capacity=8)
+    pump = Pump(Motor(), 1, 'nutrient1')
+
+    def failing_listener(pump, running):
+        raise OSError(28, 'No space left on device')
+    pump.listeners.append(failing_listener)
+    pump.listeners.append(ring.record_pump)
+    pump.start()
+    started = pump.started_at is not None and pump.motor.throttle == 1
+    pump.stop()
+    events = [record.event for record in ring.tail(10)]
+    check('pump runs despite a failing listener', started and pump.started_at is None and pump.motor.throttle == 0
+          and not pump.lock.locked())
+    check('other listeners still see the run', events == [EVENT_PUMP_START, EVENT_PUMP_STOP], str(events))
+    ring.close()
+
+
+logging.disable(logging.ERROR)
+test_wrap_around()
+test_reopen()
+test_uninitialised_file()
+test_failing_listener()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+from utilities import clock, tracing
+from utilities.tracing import Tracer
+
+# Run from the repository root: python -m tests.tracingTest
+# Checks of the phase tracing and of its Chrome trace export, the script exits with status 1 if one fails.
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def spans(trace):
+    return [event for event in trace['traceEvents'] if event['ph'] == 'X']
+
+
+def test_chrome_trace():
+    previous_clock = clock.set_clock(clock.VirtualClock(start=10.0))
+    previous_tracer, previous_enabled = tracing.tracer, tracing.enabled
+    tracing.tracer, tracing.enabled = Tracer(), True
+    try:
+        @tracing.traced()
+        def fill_water():
+            with tracing.span('wait_settled', category='settle', target=9.5):
+                clock.sleep(2.5)
+            clock.sleep(0.5)
+
+        fill_water()
+        try:
+            with tracing.span('dose'):
+                raise IOError(121, 'Remote I/O error')
+        except IOError:
+            pass
+        path = tracing.export_chrome_trace(os.path.join(tempfile.mkdtemp(), 'trace.json'))
+        with open(path) as trace_file:
+            trace = json.load(trace_file)
+        events = spans(trace)
+        inner, outer, failed = events
+        check('spans are exported as complete events in microseconds',
+              inner == {'name': 'wait_settled', 'cat': 'settle', 'ph': 'X', 'pid': os.getpid(),
+                        'tid': threading.get_ident(), 'ts': 10e6, 'dur': 2.5e6, 'args': {'target': 9.5}}
+              and outer['name'] == 'fill_water' and outer['cat'] == 'phase' and outer['ts'] == 10e6
+              and outer['dur'] == 3e6 and 'args' not in outer, str(events))
+        check('a span ended by an error names it', failed['args'] == {'error': 'OSError'}, str(failed))
+        names = [event for event in trace['traceEvents'] if event['ph'] == 'M']
+        check('threads are named', names == [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                                              'tid': threading.get_ident(),
+                                              'args': {'name': threading.current_thread().name}}], str(names))
+        check('the trace is displayed in milliseconds', trace['displayTimeUnit'] == 'ms')
+    finally:
+        clock.set_clock(previous_clock)
+        tracing.tracer, tracing.enabled = previous_tracer, previous_enabled
+
+
+def test_bounded_buffer():
+    tracer = Tracer(capacity=3)
+    for index in range(5):
+        tracer.record('pass %d' % index, 'phase', index, 0.5)
+    check('the oldest spans are dropped', [event['name'] for event in spans(tracer.chrome_trace())]
+          == ['pass 2', 'pass 3', 'pass 4'])
+
+
+def test_disabled():
+    previous_tracer, previous_enabled = tracing.tracer, tracing.enabled
+    tracing.tracer, tracing.enabled = Tracer(), False
+    try:
+        traced_function = tracing.traced()(lambda: 'result')
+        with tracing.span('ignored'):
+            pass
+        check('disabled tracing records nothing', traced_function() == 'result' and not tracing.tracer.events)
+    finally:
+        tracing.tracer, tracing.enabled = previous_tracer, previous_enabled
+
+
+logging.disable(logging.ERROR)
+test_chrome_trace()
+test_bounded_buffer()
+test_disabled()
+sys.exit(1 if failures else 0)
@@ -0,0 +1,74 @@
+import logging
+import os
+import sys
+import tempfile
+
+from simulation.replay import Replay, ReplayFinished
+from simulation.reservoir import Reservoir
+from simulation.simulated_hardware import Simulation
+from user_controlled_constants import BLUEBERRY_PLANT
+from utilities.AtlasI2C import invalidate_readings
+from utilities.traffic_log import TrafficRecorder, load_traffic
+import main
+
+# Run from the repository root: python -m tests.trafficReplayTest
+# Checks that traffic recorded on the simulated reservoir replays into the same run, the script exits with status 1
+# if one fails.
+
+PH_SETTINGS = BLUEBERRY_PLANT['plant']['ph_settings']
+TARGET_MIN_MAX_PH = PH_SETTINGS['target_min_ph'], PH_SETTINGS['target_max_ph']
+# Monitoring passes recorded, and simulated time between them (seconds)
+PASSES = 5
+PASS_INTERVAL = 60
+
+failures = 0
+
+
+def check(name, condition, detail=''):
+    global failures
+    if condition:
+        print('ok   %s' % name)
+    else:
+        failures += 1
+        print('FAIL %s%s' % (name, ': ' + detail if detail else ''))
+
+
+def test_record_and_replay():
+    path = os.path.join(tempfile.mkdtemp(), 'traffic.rec')
+    # pH out of range, so the passes drive the pumps as well as read the sensors
+    sim = Simulation(Reservoir(volume_l=20.0, ppm=800.0, ph=7.0), msb_glitch=False, sensor_noise=0.002,
+                     seed=0).install()
+    recorder = TrafficRecorder(path)
+    sim.hardware.record_traffic(recorder)
+    try:
+        for _ in range(PASSES):
+            main.check_ph(TARGET_MIN_MAX_PH, PH_SETTINGS['dosing_time'])
+            sim.run_for(PASS_INTERVAL)
+    finally:
+        recorder.close()
+        sim.uninstall()
+    traffic = load_traffic(path)
+    check('the recording reads back', len(traffic.records) == recorder.count > 0,
+          '%d of %d records' % (len(traffic.records), recorder.count))
+
+    # The cached readings of the recording must not answer in place of the replayed boards
+    invalidate_readings()
+    replay = Replay(traffic).install()
+    try:
+        while True:
+            main.check_ph(TARGET_MIN_MAX_PH, PH_SETTINGS['dosing_time'])
+    except ReplayFinished:
+        pass
+    finally:
+        replay.uninstall()
+    check('the replay sends what was recorded', not replay.divergences, str(replay.divergences[:3]))
+    check('the replay drives the pumps as recorded', replay.recorded_actuations
+          and replay.first_actuation_difference() is None,
+          '%d recorded, %d replayed, first difference %s' % (len(replay.recorded_actuations),
+                                                              len(replay.actuations),
+                                                              replay.first_actuation_difference()))
+
+
+logging.disable(logging.ERROR)
+test_record_and_replay()
+sys.exit(1 if failures else 0)
@@ -22,23 +22,203 @@ W1_DEVICE_PATH = '/sys/bus/w1/devices/'
 W1_DEVICE_NAME = '28-3c09f6495e17'
 W1_TEMP_PATH = W1_DEVICE_PATH + W1_DEVICE_NAME + '/temperature'
 
+# I2C bus shared by the Atlas boards, the ADC and both motor drivers (1 on recent Raspberry Pis)
+I2C_BUSNUM = 1
+
 # I2C addresses for ECSensor and PHSensor
 EC_SENSOR_I2C_ADDRESS = 100
 PH_SENSOR_I2C_ADDRESS = 99
 
+# Plants of the plant dictionary with a reservoir of their own: plant name -> the settings above that differ for
+# the devices of that reservoir, among I2C_BUSNUM, EC_SENSOR_I2C_ADDRESS, PH_SENSOR_I2C_ADDRESS, W1_TEMP_PATH,
+# ADC_I2C_ADDRESS, ADC_BUSNUM, DRIVER0_I2C_ADDRESS and DRIVER1_I2C_ADDRESS (the pumps sit at the same positions on
+# its driver boards, the ADC on its I2C_BUSNUM unless ADC_BUSNUM is given too). Its telemetry and water level
+# calibration files get the plant name as a suffix. Only one plant may be left out, the one using the devices
+# configured above, for example:
+# PLANT_HARDWARE = {'tomato': {'I2C_BUSNUM': 3, 'W1_TEMP_PATH': W1_DEVICE_PATH + '28-3c01d607e1a2/temperature'}}
+PLANT_HARDWARE = {}
+
+# Poll the status byte of the Atlas boards until a reading is ready instead of always waiting the worst case
+# timeout (1.5 seconds for readings), set to False to go back to fixed waits
+ATLAS_ADAPTIVE_READS = True
+
+# How long (in seconds) a pH/EC reading is reused before the boards are queried again, pumps always discard it
+SENSOR_CACHE_TTL = 2.0
+# The 1-wire temperature changes slowly and takes close to a second to read, so it is kept longer
+TEMPERATURE_CACHE_TTL = 30.0
+
+# Streaming filter each new pH, EC and temperature reading goes through before the control loops see it:
+# {'kind': 'kalman', ...} or {'kind': 'ema', ...} (see utilities/signal_filters.py), None to use the raw readings.
+# noise: standard deviation of the sensor noise, drift: how fast the value may wander (per square root of a
+# second, kalman only), alpha: weight of each new reading (ema only), jump: largest change a pump run may cause,
+# mix_time: seconds a dose takes to mix in
+SENSOR_FILTERS = {
+    'ph': {'kind': 'kalman', 'noise': 0.02, 'drift': 0.002, 'jump': 0.5, 'mix_time': 20.0},
+    'ec': {'kind': 'kalman', 'noise': 10.0, 'drift': 1.0, 'jump': 1000.0, 'mix_time': 20.0},
+    'temp_c': {'kind': 'kalman', 'noise': 0.1, 'drift': 0.005, 'jump': 2.0, 'mix_time': 60.0},
+}
+
+# Wait after a pump run until the pH/EC readings stopped moving instead of always waiting the whole
+# LOOP_SLEEP_TIME, NUTRIENT_WAIT_TIME_LOOP or settling time (which become the longest wait)
+SETTLE_DETECTION = True
+# Seconds between two readings while waiting, and number of readings a decision is made from (both are shortened
+# for a wait whose timeout is too short for a full window to take at most half of it)
+SETTLE_READ_INTERVAL = 0.5
+SETTLE_WINDOW = 8
+# A signal settled once the slope of its last readings (units per second) and their spread around that slope
+# (standard deviation) are both below these, and, after a dose, once the readings moved more than min_change from
+# the reading before the dose (a dose mixing in slowly starts with a slope small enough to look settled)
+SETTLE_THRESHOLDS = {
+    'ph': {'max_slope': 0.0005, 'max_std': 0.01, 'min_change': 0.03},
+    'ec': {'max_slope': 0.5, 'max_std': 5.0, 'min_change': 15.0},
+}
+# Shortest wait (seconds) after a dose or a fill before the readings can be taken as settled, the time the added
+# liquid takes to reach the probes
+SETTLE_DEAD_TIME = 5.0
+
 # ADC configuration
 ADC_I2C_ADDRESS = 0x48
 ADC_BUSNUM = 1
 ADC_GAIN = 1
 
+# Read the water level from a burst of samples in ADS1115 continuous mode instead of a single conversion per
+# channel. Works without numpy, with numpy installed the samples are converted faster. Set to True to enable.
+WATER_LEVEL_OVERSAMPLING = False
+# Conversions per channel for each water level reading and ADS1115 conversion rate (8, 16, 32, 64, 128, 250, 475
+# or 860 per second): a reading takes about 2 * WATER_LEVEL_SAMPLES / WATER_LEVEL_DATA_RATE seconds
+WATER_LEVEL_SAMPLES = 16
+WATER_LEVEL_DATA_RATE = 860
+# How the samples are combined: 'median', 'trimmed_mean' (drops WATER_LEVEL_TRIM of the samples at each end) or
+# 'mean'
+WATER_LEVEL_FILTER = 'median'
+WATER_LEVEL_TRIM = 0.25
+
 # Coefficients for quadratic equation to convert reading to water level (a, b, c)
 # We calculated this using excel and measuring the output of the e-tape for each inch
 QUADRATIC_COEFFICIENTS = [-0.0034, -0.0103, 0.9816]
 
+# Water level calibration (python -m Water_level_nutrients_ph_manager.water_level_calibration), saved in
+# files_and_logs. Until one is saved, the levels come from QUADRATIC_COEFFICIENTS between 0 and
+# WATER_LEVEL_MAX_LEVEL inches (the length of the eTape)
+WATER_LEVEL_CALIBRATION_FILE = "water_level_calibration.json"
+WATER_LEVEL_MAX_LEVEL = 12
+# Entries of the ratio -> inches lookup table
+WATER_LEVEL_TABLE_SIZE = 1024
+
 # Motor driver I2C addresses
 DRIVER0_I2C_ADDRESS = 0x60
 DRIVER1_I2C_ADDRESS = 0x61
 
+# Number of sensor frames and pump events kept in files_and_logs/telemetry.ring (48 bytes each, the oldest are
+# overwritten once it is full)
+TELEMETRY_RING_CAPACITY = 100000
+
+# Flow of each pump (mL per second) used to turn run times into dispensed volumes (see file_operations/dose_ledger.py).
+# Measure them with: python -m file_operations.dose_ledger calibrate, the measured rates are saved to
+# files_and_logs/PUMP_CALIBRATION_FILE and override these
+PUMP_FLOW_RATES = {
+    'fresh_water': 20.0,
+    'nutrient1': 1.6,
+    'nutrient2': 1.6,
+    'nutrient3': 1.6,
+    'nutrient4': 1.6,
+    'ph_up': 1.6,
+    'ph_down': 1.6,
+}
+PUMP_CALIBRATION_FILE = "pump_calibration.json"
+# Every pump run is appended to files_and_logs/DOSE_LEDGER_FILE (about 20 bytes each)
+DOSE_LEDGER_FILE = "dose_ledger.bin"
+
+# Minimum time (in seconds) between two saves of a plant file when only the current ppm/water level changed,
+# target changes are always saved straight away
+STATE_COMMIT_INTERVAL = 3600
+
+# Log file (JSON lines) written in files_and_logs by the background log writer, rotated once it reaches
+# LOG_MAX_BYTES with LOG_BACKUP_COUNT older files kept, and lowest level logged
+LOG_FILE = "controller.log"
+LOG_MAX_BYTES = 1000000
+LOG_BACKUP_COUNT = 5
+LOG_LEVEL = 'INFO'
+# The status lines of the dosing loops are logged at most once per this many seconds (each kind of line)
+LOG_RATE_LIMIT_INTERVAL = 10
+
+# Keep counters and histograms of the I2C latency, pump run times and control loops (see utilities/metrics.py),
+# served as Prometheus text at http://METRICS_ADDRESS:METRICS_PORT/metrics while main.py runs
+METRICS_ENABLED = True
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Record the phases of the control loops and every I2C transaction as spans (see utilities/tracing.py), the last
+# TRACE_BUFFER_SIZE of them are written to files_and_logs/TRACE_FILE (Chrome trace format) when main.py exits
+TRACING_ENABLED = True
+TRACE_BUFFER_SIZE = 100000
+TRACE_FILE = "trace.json"
+
+# Record the raw traffic of the sensors and pumps (Atlas I2C transactions, ADC conversions, temperature reads, pump
+# starts and stops) to files_and_logs/TRAFFIC_LOG_FILE, to replay it later at a desk (see utilities/traffic_log.py)
+TRAFFIC_RECORDING = False
+TRAFFIC_LOG_FILE = "traffic.rec"
+
+# How the pH up/down pulses are sized: 'bang_bang' (the fixed PH_UP_SLEEP_TIME/PH_DOWN_SLEEP_TIME pulses of the
+# plant), 'pid', or 'titration' (learns how much one second of each pump moves the pH and sizes each pulse from it)
+PH_CONTROLLER = 'titration'
+# pH balancing stops once the pH is this close to its target (or crossed it)
+PH_TOLERANCE = 0.05
+
+# Learn how many ppm each nutrient pump adds per second and size each dosing pass to reach the target at once,
+# set to False to go back to running the pumps for their fixed nutrient_pump_times until the target is reached
+NUTRIENT_LEARNED_DOSING = True
+# Learned dosing stops once the ppm is within this many ppm under its target
+NUTRIENT_PPM_TOLERANCE = 10
+# Nutrients (mg) in one mL of the nutrient concentrate (g/L on the label) and liters of water per inch of the eTape,
+# measured on your reservoir. With the flow of the pumps measured by python -m file_operations.dose_ledger calibrate,
+# they give the ppm each pump adds per second, so learned dosing skips its probe pass. Leave them at None unless
+# measured: the learned rates start from a probe pass instead.
+NUTRIENT_STOCK_CONCENTRATION = None
+RESERVOIR_LITERS_PER_INCH = None
+
+# Run the nutrient pumps of a dosing pass at the same time instead of one after the other, within the current and
+# power budgets below and the exclusion groups (see Water_level_nutrients_ph_manager/parallel_dosing.py). It pays
+# off with learned dosing (fewer long passes); with fixed doses each pass is shorter but the passes are not fewer,
+# and the reading after a short pass lags more, so the target gets overshot further.
+NUTRIENT_PARALLEL_DOSING = True
+# Current drawn by each pump while it runs (amps)
+PUMP_CURRENTS = {
+    'fresh_water': 1.5,
+    'nutrient1': 0.4,
+    'nutrient2': 0.4,
+    'nutrient3': 0.4,
+    'nutrient4': 0.4,
+    'ph_up': 0.4,
+    'ph_down': 0.4,
+}
+# Largest current one motor driver board may deliver to its pumps at once (amps)
+DRIVER_CURRENT_BUDGET = 1.2
+# Largest power the pump power supply may deliver at once (watts), and its voltage
+PUMP_SUPPLY_POWER_BUDGET = 24.0
+PUMP_SUPPLY_VOLTAGE = 12.0
+# Pumps that must never run at the same time, for example the A and B parts of a two part nutrient, which
+# precipitate when they meet concentrated. The pumps of a group run in the order of the plant recipe, at least
+# NUTRIENT_EXCLUSION_GAP seconds apart.
+NUTRIENT_EXCLUSION_GROUPS = [('nutrient1', 'nutrient2')]
+NUTRIENT_EXCLUSION_GAP = 2.0
+
+# Stop the fresh water pump at the time the level is predicted to reach its target (estimated from the rise of the
+# level since the pump started) instead of checking the level every 5 seconds
+FILL_PREDICTIVE = True
+# Shortest and longest time (in seconds) between two water level checks while filling, the checks get closer as
+# the level nears its target
+FILL_MIN_POLL_INTERVAL = 0.5
+FILL_MAX_POLL_INTERVAL = 15
+# Filling is done once the level is within this many inches under its target
+FILL_LEVEL_TOLERANCE = 0.05
+
+# How often (in seconds) the pH and EC are sampled and the pH corrected, independently of the water level checks
+# (wait_time_between_checks of each plant)
+PH_CHECK_INTERVAL = 30
+# How often (in seconds) the current ppm and water level of each plant are handed to the state file store
+STATE_SAVE_INTERVAL = 300
+
 # Indicates the minimum water level in inches for the system to recognize a completed setup 
 SKIP_SYSTEM_SETUP_WATER_LEVEL = 1.5
 
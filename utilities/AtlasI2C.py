@@ -1,10 +1,19 @@
 #!/usr/bin/python
 
-import io
 import sys
-import fcntl
-import time
 import copy
+import logging
+import threading
+
+from utilities import clock, metrics, tracing
+from utilities.i2c_bus import get_i2c_bus
+
+I2C_LATENCY = metrics.histogram('atlas_i2c_latency_seconds',
+                                'Time between sending a command to an Atlas board and reading its response.',
+                                ['address', 'command'])
+I2C_STATUS = metrics.counter('atlas_i2c_status_total',
+                             'Responses of the Atlas boards that were not a success, by status code.',
+                             ['address', 'code'])
 
 
 class AtlasI2C:
@@ -20,27 +29,38 @@ class AtlasI2C:
     DEFAULT_ADDRESS = 98
     LONG_TIMEOUT_COMMANDS = ("R", "CAL")
     SLEEP_COMMANDS = ("SLEEP", )
+    # time between two status reads in adaptive mode
+    POLL_INTERVAL = 0.05
 
-    def __init__(self, address=None, moduletype = "", name = "", bus=None):
+    def __init__(self, address=None, moduletype = "", name = "", bus=None, transport=None, adaptive=False):
         '''
-        open two file streams, one for reading and one for writing
+        open the transport used to talk to the board, by default the
+        shared manager of the bus (see utilities/i2c_bus.py)
         the specific I2C channel is selected with bus
         it is usually 1, except for older revisions where its 0
-        wb and rb indicate binary read and write
+        pass another transport (in-memory emulator, recorder) to run
+        without the real hardware
+        adaptive polls the status byte until the response is ready instead
+        of always waiting the worst case timeout
         '''
         self._address = address or self.DEFAULT_ADDRESS
         self.bus = bus or self.DEFAULT_BUS
         self._long_timeout = self.LONG_TIMEOUT
         self._short_timeout = self.SHORT_TIMEOUT
-        self.file_read = io.open(file="/dev/i2c-{}".format(self.bus), 
-                                 mode="rb", 
-                                 buffering=0)
-        self.file_write = io.open(file="/dev/i2c-{}".format(self.bus),
-                                  mode="wb", 
-                                  buffering=0)
+        self.transport = transport or get_i2c_bus(self.bus).device(self._address)
         self.set_i2c_address(self._address)
         self._name = name
         self._module = moduletype
+        self.adaptive = adaptive
+        # clock time at which the response to the last command sent is ready
+        self._ready_at = None
+        self._sent_at = None
+        self._sent_command = None
+        self._response = None
+        self._latency_stats = {}
+        # held for a whole command (send, wait and read) so plants
+        # sharing the board do not mix up their commands
+        self.lock = threading.Lock()
 
 	
     @property
@@ -67,12 +87,8 @@ class AtlasI2C:
     def set_i2c_address(self, addr):
         '''
         set the I2C communications to the slave specified by the address
-        the commands for I2C dev using the ioctl functions are specified in
-        the i2c-dev.h file from i2c-tools
         '''
-        I2C_SLAVE = 0x703
-        fcntl.ioctl(self.file_read, I2C_SLAVE, addr)
-        fcntl.ioctl(self.file_write, I2C_SLAVE, addr)
+        self.transport.set_address(addr)
         self._address = addr
 
     def write(self, cmd):
@@ -80,7 +96,7 @@ class AtlasI2C:
         appends the null character and sends the string over I2C
         '''
         cmd += "\00"
-        self.file_write.write(cmd.encode('latin-1'))
+        self.transport.write(cmd.encode('latin-1'))
 
     def handle_raspi_glitch(self, response):
         '''
@@ -130,11 +146,22 @@ class AtlasI2C:
         '''
         reads a specified number of bytes from I2C, then parses and displays the result
         '''
+        error_code, result = self.read_with_status(num_of_bytes)
+        return result
+
+    def read_with_status(self, num_of_bytes=31):
+        '''
+        same as read, but also returns the status byte of the response
+        (as a string, '1' for success, '254' while still processing)
+        '''
         
-        raw_data = self.file_read.read(num_of_bytes)
+        raw_data = self.transport.read(num_of_bytes)
         response = self.get_response(raw_data=raw_data)
         #print(response)
         is_valid, error_code = self.response_valid(response=response)
+        if not is_valid:
+            # 254 is "still processing" (polled in adaptive mode), 2 a syntax error, 255 no data
+            I2C_STATUS.labels(hex(self._address), error_code).inc()
 
         if is_valid:
             char_list = self.handle_raspi_glitch(response[1:])
@@ -143,7 +170,7 @@ class AtlasI2C:
         else:
             result = "Error " + self.get_device_info() + ": " + error_code
 
-        return result
+        return error_code, result
 
     def get_command_timeout(self, command):
         timeout = None
@@ -154,22 +181,127 @@ class AtlasI2C:
 
         return timeout
 
-    def query(self, command):
+    def send(self, command):
         '''
-        write a command to the board, wait the correct timeout, 
-        and read the response
+        write a command to the board without waiting for the answer
+        returns the clock time at which the response will be ready,
+        or None for commands that have no response (sleep)
         '''
         self.write(command)
         current_timeout = self.get_command_timeout(command=command)
+        self._sent_command = command.split(',')[0].upper()
+        self._sent_at = clock.monotonic()
         if not current_timeout:
-            return "sleep mode"
+            self._ready_at = None
         else:
-            time.sleep(current_timeout)
-            return self.read()
+            self._ready_at = self._sent_at + current_timeout
+        return self._ready_at
+
+    def _collect_steps(self):
+        '''
+        generator yielding how long to wait before each read of the
+        response, the final response is left in self._response
+        in fixed mode it waits the whole timeout and reads once, in
+        adaptive mode it polls the status byte until the board stops
+        answering 254 (still processing) or the deadline passes
+        '''
+        stats = self._latency_stats.get(self._sent_command)
+        if not self.adaptive:
+            yield self._ready_at - clock.monotonic()
+            error_code, self._response = self.read_with_status()
+            polls = 1
+        else:
+            # start polling at the fastest answer seen so far for this command
+            first_poll = stats["min"] if stats else self.POLL_INTERVAL
+            deadline = self._ready_at + (self._ready_at - self._sent_at)
+            yield self._sent_at + first_poll - clock.monotonic()
+            polls = 0
+            while True:
+                error_code, self._response = self.read_with_status()
+                polls += 1
+                if error_code != '254' or clock.monotonic() >= deadline:
+                    break
+                yield self.POLL_INTERVAL
+
+        latency = clock.monotonic() - self._sent_at
+        I2C_LATENCY.labels(hex(self._address), self._sent_command).observe(latency)
+        if stats is None:
+            stats = {"count": 0, "total": 0.0, "min": latency, "max": latency, "polls": 0, "timeouts": 0}
+            self._latency_stats[self._sent_command] = stats
+        stats["count"] += 1
+        stats["total"] += latency
+        stats["min"] = min(stats["min"], latency)
+        stats["max"] = max(stats["max"], latency)
+        stats["polls"] += polls
+        if error_code == '254':
+            stats["timeouts"] += 1
+        self._ready_at = None
+
+    def collect(self):
+        '''
+        wait until the response to the last command sent is ready, 
+        and read it
+        '''
+        if self._ready_at is None:
+            return "sleep mode"
+        for wait in self._collect_steps():
+            clock.sleep(wait)
+        return self._response
+
+    async def collect_async(self):
+        '''
+        same as collect, but lets other coroutines run while the board
+        is processing the command
+        '''
+        if self._ready_at is None:
+            return "sleep mode"
+        for wait in self._collect_steps():
+            await clock.async_sleep(wait)
+        return self._response
+
+    def latency_stats(self):
+        '''
+        per command statistics of the time between sending a command and
+        reading its response: count, mean, min, max (seconds), average
+        number of reads per response and number of deadline timeouts
+        '''
+        report = {}
+        for command, stats in self._latency_stats.items():
+            report[command] = dict(stats,
+                                   mean=stats["total"] / stats["count"],
+                                   polls=stats["polls"] / stats["count"])
+        return report
+
+    def query(self, command):
+        '''
+        write a command to the board, wait the correct timeout, 
+        and read the response
+        '''
+        with tracing.span('atlas query', 'sensor', address=hex(self._address), command=command):
+            clock.acquire(self.lock)
+            try:
+                self.send(command)
+                return self.collect()
+            finally:
+                self.lock.release()
+
+    async def query_async(self, command):
+        '''
+        asyncio version of query, boards at different addresses can
+        process their commands at the same time
+        the board is locked like in query, so a coroutine and a thread
+        can not send their commands to it in between each other
+        '''
+        with tracing.span('atlas query', 'sensor', address=hex(self._address), command=command):
+            await clock.acquire_async(self.lock)
+            try:
+                self.send(command)
+                return await self.collect_async()
+            finally:
+                self.lock.release()
 
     def close(self):
-        self.file_read.close()
-        self.file_write.close()
+        self.transport.close()
 
     def list_i2c_devices(self):
         '''
@@ -189,22 +321,77 @@ class AtlasI2C:
 
         return i2c_devices
 
+
+def _locking_order(queries):
+    '''
+    boards of a query_many list, in the order they are locked: always
+    by address so two threads can not each hold the board the other
+    one is waiting for
+    a board processes one command at a time and only remembers the last
+    one sent, so it can not appear twice in the list
+    '''
+    sensors = [sensor for sensor, command in queries]
+    if len(set(sensors)) != len(sensors):
+        raise ValueError("query_many got several commands for the same board: " +
+                         ", ".join(sorted(set(hex(sensor.address) for sensor in sensors
+                                              if sensors.count(sensor) > 1))))
+    return sorted(sensors, key=lambda sensor: sensor.address)
+
+
+def query_many(queries):
+    '''
+    send commands to several boards and collect all the responses
+    queries is a list of (AtlasI2C, command) pairs with one command per
+    board, the boards convert at the same time so the whole list costs
+    about the slowest command instead of the sum of all of them
+    '''
+    sensors = _locking_order(queries)
+    with tracing.span('atlas query_many', 'sensor', addresses=[hex(sensor.address) for sensor in sensors]):
+        for sensor in sensors:
+            clock.acquire(sensor.lock)
+        try:
+            for sensor, command in queries:
+                sensor.send(command)
+            return [sensor.collect() for sensor, command in queries]
+        finally:
+            for sensor in sensors:
+                sensor.lock.release()
+
+
+async def query_many_async(queries):
+    '''
+    asyncio version of query_many
+    '''
+    import asyncio
+    sensors = _locking_order(queries)
+    with tracing.span('atlas query_many', 'sensor', addresses=[hex(sensor.address) for sensor in sensors]):
+        locked = []
+        try:
+            for sensor in sensors:
+                await clock.acquire_async(sensor.lock)
+                locked.append(sensor)
+            for sensor, command in queries:
+                sensor.send(command)
+            return await asyncio.gather(*[sensor.collect_async() for sensor, command in queries])
+        finally:
+            for sensor in locked:
+                sensor.lock.release()
+
+from file_operations.logging_config import RateLimitedLogger
 from user_controlled_constants import *
-from main import PHSensor, ECSensor
+from utilities.hardware import get_hardware, use_hardware
+
+# A board answering garbage keeps doing it, log it once every LOG_RATE_LIMIT_INTERVAL seconds
+error_log = RateLimitedLogger(logging.getLogger(__name__))
 
 
 def read_temp_file():
     """Read temperature file and return its content."""
-    try:
-        with open(W1_TEMP_PATH, 'r') as temp_file:
-            return temp_file.readline()
-    except FileNotFoundError:
-        print("Error: Temperature file not found.")
-        return None
+    return get_hardware().temp_sensor.readline()
 
 
-def get_temp_c():
-    """Return temperature in Celsius."""
+def read_temp_c():
+    """Read the temperature sensor (in Celsius), bypassing the cache."""
     temp_data = read_temp_file()
     if temp_data is not None:
         return int(temp_data) / 1000
@@ -212,6 +399,25 @@ def get_temp_c():
         return None
 
 
+def filtered(name, reading):
+    """Pass a new reading of a signal through its streaming filter (see SENSOR_FILTERS) and return the estimate."""
+    return get_hardware().sensor_filters.update(name, reading)
+
+
+def get_estimate(name):
+    """
+    Return (estimate, standard deviation) of the last filtered reading of 'ph', 'ec' or 'temp_c', the standard
+    deviation tells how much the estimate can be trusted. (None, None) if the signal is not filtered.
+    """
+    return get_hardware().sensor_filters.estimate(name)
+
+
+def get_temp_c():
+    """Return temperature in Celsius."""
+    return get_hardware().sensor_cache.get("temp_c", lambda: filtered("temp_c", read_temp_c()),
+                                           ttl=TEMPERATURE_CACHE_TTL)
+
+
 def get_temp_f():
     """Return temperature in Fahrenheit."""
     temp_c = get_temp_c()
@@ -221,32 +427,116 @@ def get_temp_f():
         return None
 
 
-def get_ph():
-    """Return pH value."""
+def parse_reading(response, name):
+    """Convert a board response to a float, None if it is an error message."""
+    try:
+        return float(response.rstrip('\0'))
+    except ValueError:
+        # Limited per sensor, so the errors of one board do not hide those of the other
+        error_log.error("Error: Unable to parse %s value.", name, key=name, sensor=name)
+        return None
+
+
+def read_ph():
+    """Query the pH board (temperature compensated), bypassing the cache."""
     temp_c = get_temp_c()
     if temp_c is not None:
-        try:
-            return float(PHSensor.query('RT,' + str(temp_c)).rstrip('\0'))
-        except ValueError:
-            print("Error: Unable to parse pH value.")
-            return None
+        return parse_reading(get_hardware().ph_sensor.query('RT,' + str(temp_c)), SIGNAL_LABELS['ph'])
     else:
         return None
 
 
-def get_ec():
-    """Return EC value."""
+def read_ec():
+    """Query the EC board (temperature compensated), bypassing the cache."""
     temp_c = get_temp_c()
     if temp_c is not None:
-        try:
-            return float(ECSensor.query('RT,' + str(temp_c)).rstrip('\0'))
-        except ValueError:
-            print("Error: Unable to parse EC value.")
-            return None
+        return parse_reading(get_hardware().ec_sensor.query('RT,' + str(temp_c)), SIGNAL_LABELS['ec'])
     else:
         return None
 
 
+def get_ph():
+    """Return pH value (filtered)."""
+    return get_hardware().sensor_cache.get("ph", lambda: filtered("ph", read_ph()))
+
+
+def get_ec():
+    """Return EC value (filtered)."""
+    return get_hardware().sensor_cache.get("ec", lambda: filtered("ec", read_ec()))
+
+
+# The signals read from the Atlas boards, with the name used for them in the messages
+SIGNAL_LABELS = {'ph': 'pH', 'ec': 'EC'}
+
+
+def signal_queries(names, temp_c):
+    """Return the temperature compensated [(board, command)] queries reading the signals ('ph' and/or 'ec')."""
+    hardware = get_hardware()
+    sensors = {'ph': hardware.ph_sensor, 'ec': hardware.ec_sensor}
+    command = 'RT,' + str(temp_c)
+    return [(sensors[name], command) for name in names]
+
+
+def store_readings(names, responses):
+    """
+    Parse the responses to signal_queries and pass each reading through its filter into the cache.
+
+    Returns:
+        list: (raw reading, filtered estimate) of each signal, None for a response that does not parse.
+    """
+    hardware = get_hardware()
+    readings = []
+    for name, response in zip(names, responses):
+        reading = parse_reading(response, SIGNAL_LABELS[name])
+        estimate = filtered(name, reading)
+        hardware.sensor_cache.put(name, estimate)
+        readings.append((reading, estimate))
+    return readings
+
+
+def _cached_ph_and_ec():
+    """Return the cached (pH, EC) if both are fresh, else None."""
+    cache = get_hardware().sensor_cache
+    if cache.fresh("ph") and cache.fresh("ec"):
+        return get_ph(), get_ec()
+    return None
+
+
+def get_ph_and_ec():
+    """
+    Return (pH, EC) with both boards converting at the same time.
+
+    Costs one reading instead of two back to back get_ph()/get_ec() calls.
+    """
+    cached = _cached_ph_and_ec()
+    if cached is not None:
+        return cached
+    temp_c = get_temp_c()
+    if temp_c is None:
+        return None, None
+    responses = query_many(signal_queries(('ph', 'ec'), temp_c))
+    return tuple(estimate for _, estimate in store_readings(('ph', 'ec'), responses))
+
+
+async def get_ph_and_ec_async():
+    """asyncio version of get_ph_and_ec, the 1-wire temperature is read in a worker thread."""
+    import asyncio
+    cached = _cached_ph_and_ec()
+    if cached is not None:
+        return cached
+    hardware = get_hardware()
+
+    def read_temperature():
+        # The worker thread must read the probe of the same reservoir
+        with use_hardware(hardware):
+            return get_temp_c()
+    temp_c = await asyncio.get_running_loop().run_in_executor(None, read_temperature)
+    if temp_c is None:
+        return None, None
+    responses = await query_many_async(signal_queries(('ph', 'ec'), temp_c))
+    return tuple(estimate for _, estimate in store_readings(('ph', 'ec'), responses))
+
+
 def get_ppm():
     """Return PPM value."""
     ec = get_ec()
@@ -254,3 +544,10 @@ def get_ppm():
         return ec * 0.5
     else:
         return None
+
+
+def invalidate_readings():
+    """Forget the cached pH and EC readings, call it after a pump changed the water."""
+    get_hardware().sensor_cache.invalidate("ph", "ec")
+    # The next readings may move a lot, the filters must follow them instead of smoothing the change away
+    get_hardware().sensor_filters.disturb("ph", "ec")
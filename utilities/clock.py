@@ -0,0 +1,182 @@
+import threading
+import time
+
+# Every wait in the control code goes through the sleep() function of this module instead of time.sleep, so the
+# whole system can be driven by a virtual clock (see simulation/) and replay days of operation in seconds.
+
+
+class SystemClock:
+    """Real time: sleeps actually block, time comes from the OS."""
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    async def async_sleep(self, seconds):
+        # asyncio is imported on first use only, it takes longer to import than the rest of the package
+        import asyncio
+        await asyncio.sleep(max(seconds, 0))
+
+    def add_participant(self):
+        """Nothing to do in real time, see VirtualClock.add_participant."""
+
+    def remove_participant(self):
+        """Nothing to do in real time, see VirtualClock.add_participant."""
+
+
+class VirtualClock:
+    """
+    Simulated time: sleep() returns immediately and moves the clock forward instead.
+
+    Listeners registered with add_listener(callback) are called as callback(start, end) for every step the clock
+    moves, which is how the reservoir simulator integrates its physics over the time the control code "waited".
+    Long sleeps are cut into steps of at most max_step seconds so listeners see a smooth progression.
+
+    Several threads (one per plant) can share a virtual clock: each of them calls add_participant() when it
+    starts, and time then only moves forward once every participant is sleeping, up to the earliest wake up time.
+    This keeps the threads in step exactly as if they were sleeping in real time.
+    """
+
+    def __init__(self, start=0.0, epoch=None, max_step=1.0):
+        """
+        Args:
+            start: Initial value of monotonic() in seconds.
+            epoch: Wall clock time (seconds since the epoch) matching the start, default is the current time.
+            max_step: Longest step (seconds) passed to listeners in one go.
+        """
+        self.now = start
+        self.start = start
+        self.epoch = time.time() if epoch is None else epoch
+        self.max_step = max_step
+        self.listeners = []
+        self._condition = threading.Condition()
+        self._participants = 0
+        # Wake up times of the participants currently sleeping
+        self._sleepers = []
+
+    def add_listener(self, callback):
+        """Call callback(start, end) every time the clock moves forward."""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.epoch + (self.now - self.start)
+
+    def advance(self, seconds):
+        """Move the clock forward by the given number of seconds."""
+        end = self.now + seconds
+        while self.now < end:
+            step_end = min(end, self.now + self.max_step)
+            for listener in self.listeners:
+                listener(self.now, step_end)
+            self.now = step_end
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if not self._participants:
+            self.advance(seconds)
+            return
+        with self._condition:
+            wake = self.now + seconds
+            self._sleepers.append(wake)
+            self._advance_if_all_asleep()
+            while self.now < wake:
+                self._condition.wait()
+            self._sleepers.remove(wake)
+
+    def add_participant(self):
+        """Register the calling thread as one of the threads time has to wait for."""
+        with self._condition:
+            self._participants += 1
+
+    def remove_participant(self):
+        """Unregister a thread registered with add_participant(), for example when it finishes."""
+        with self._condition:
+            self._participants -= 1
+            self._advance_if_all_asleep()
+
+    def _advance_if_all_asleep(self):
+        if self._sleepers and len(self._sleepers) >= self._participants:
+            earliest = min(self._sleepers)
+            if earliest > self.now:
+                self.advance(earliest - self.now)
+            self._condition.notify_all()
+
+    async def async_sleep(self, seconds):
+        # Let the other coroutines run first, so coroutines waiting at the same time share the advance
+        # instead of adding up their waits
+        import asyncio
+        deadline = self.now + seconds
+        await asyncio.sleep(0)
+        if deadline > self.now:
+            self.advance(deadline - self.now)
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    """Return the clock currently used by the whole package."""
+    return _clock
+
+
+def set_clock(clock):
+    """
+    Replace the clock used by the whole package (for example with a VirtualClock for simulations).
+
+    Returns:
+        The previous clock, so it can be restored.
+    """
+    global _clock
+    previous = _clock
+    _clock = clock
+    return previous
+
+
+def sleep(seconds):
+    """Wait for the given number of seconds on the current clock."""
+    _clock.sleep(seconds)
+
+
+async def async_sleep(seconds):
+    """Wait for the given number of seconds on the current clock, without blocking other coroutines."""
+    await _clock.async_sleep(seconds)
+
+
+def monotonic():
+    """Seconds elapsed on the current clock, only useful to measure durations."""
+    return _clock.monotonic()
+
+
+def wall_time():
+    """Current time (seconds since the epoch) on the current clock."""
+    return _clock.time()
+
+
+def acquire(lock, poll_interval=0.05):
+    """
+    Acquire a lock shared between threads, waiting on the current clock.
+
+    Waiting with clock sleeps instead of blocking lets a virtual clock keep running while a thread waits for a
+    pump or a board held by another plant.
+    """
+    while not lock.acquire(blocking=False):
+        sleep(poll_interval)
+
+
+async def acquire_async(lock, poll_interval=0.05):
+    """Same as acquire, but lets other coroutines run while the lock is held elsewhere."""
+    while not lock.acquire(blocking=False):
+        await async_sleep(poll_interval)
@@ -0,0 +1,263 @@
+import random
+import time
+
+# Status codes sent as the first byte of every EZO response
+EZO_SUCCESS = 1
+EZO_SYNTAX_ERROR = 2
+EZO_STILL_PROCESSING = 254
+EZO_NO_DATA = 255
+
+
+class EZOEmulator:
+    """
+    Emulate the I2C side of an Atlas Scientific EZO circuit.
+
+    The emulator is fed the "true" value of the water (value_source) and the real water temperature
+    (temperature_source) and answers commands exactly like the board does: the command is processed for a few
+    hundred milliseconds, reads done before that return status 254 (still processing), a finished reading is
+    returned once as status 1 followed by the ASCII value and null padding, and any further read returns 255
+    (no data). The Raspberry Pi MSB glitch (high bit set on data characters) can be reproduced too, so the
+    clean-up code in AtlasI2C gets exercised.
+    """
+
+    # Firmware information returned by the "I" command
+    DEVICE_TYPE = ""
+    FIRMWARE = "2.16"
+    # Processing time (seconds) for readings, calibration and every other command
+    READING_TIME = 0.9
+    CALIBRATION_TIME = 0.9
+    COMMAND_TIME = 0.3
+
+    def __init__(self, value_source, temperature_source=None, clock=time.monotonic, noise=0.0,
+                 msb_glitch=False, seed=None):
+        """
+        Args:
+            value_source: Function returning the true value the probe is sitting in.
+            temperature_source: Function returning the real water temperature in Celsius (default 25).
+            clock: Function returning the current time in seconds, used for processing delays.
+            noise: Standard deviation of the gaussian noise added to every reading.
+            msb_glitch: Whether to set the MSB on data characters like a glitchy Raspberry Pi bus.
+            seed: Seed for the noise and glitch random generator, to make runs reproducible.
+        """
+        self.value_source = value_source
+        self.temperature_source = temperature_source or (lambda: 25.0)
+        self.clock = clock
+        self.noise = noise
+        self.msb_glitch = msb_glitch
+        self.random = random.Random(seed)
+        self.compensation_temperature = 25.0
+        self.sleeping = False
+        self.ready_at = None
+        self.pending = None
+        # Counters, handy to check how many commands/reads the control code issued
+        self.commands_received = 0
+        self.reads_received = 0
+
+    def on_write(self, data):
+        """Receive a null terminated command from the bus and start processing it."""
+        self.commands_received += 1
+        command = data.rstrip(b'\x00').decode('latin-1')
+        if self.sleeping:
+            # Any command wakes the board up, it is then processed normally
+            self.sleeping = False
+        if command.upper() == "SLEEP":
+            self.sleeping = True
+            self.pending = None
+            self.ready_at = None
+            return
+        status, payload, processing_time = self.process(command)
+        self.pending = (status, payload)
+        self.ready_at = self.clock() + processing_time
+
+    def on_read(self, num_of_bytes):
+        """Return the response the board would put on the bus for a read of num_of_bytes."""
+        self.reads_received += 1
+        if self.pending is None or self.sleeping:
+            return self._pad(bytes([EZO_NO_DATA]), num_of_bytes)
+        if self.clock() < self.ready_at:
+            return self._pad(bytes([EZO_STILL_PROCESSING]), num_of_bytes)
+        status, payload = self.pending
+        self.pending = None
+        body = bytearray(payload.encode('latin-1'))
+        if self.msb_glitch:
+            for i in range(len(body)):
+                if self.random.random() < 0.5:
+                    body[i] |= 0x80
+        return self._pad(bytes([status]) + bytes(body), num_of_bytes)
+
+    @staticmethod
+    def _pad(response, num_of_bytes):
+        return (response + b'\x00' * num_of_bytes)[:num_of_bytes]
+
+    def process(self, command):
+        """
+        Handle one command.
+
+        Returns:
+            tuple: (status byte, response text, processing time in seconds).
+        """
+        parts = command.split(',')
+        name = parts[0].upper()
+        args = parts[1:]
+        try:
+            if name == "R" and not args:
+                return EZO_SUCCESS, self.format_reading(self.reading()), self.READING_TIME
+            if name == "RT" and len(args) == 1:
+                self.compensation_temperature = float(args[0])
+                return EZO_SUCCESS, self.format_reading(self.reading()), self.READING_TIME
+            if name == "T" and args == ["?"]:
+                return EZO_SUCCESS, "?T,%.2f" % self.compensation_temperature, self.COMMAND_TIME
+            if name == "T" and len(args) == 1:
+                self.compensation_temperature = float(args[0])
+                return EZO_SUCCESS, "", self.COMMAND_TIME
+            if name == "CAL" and args:
+                return self.calibrate(args)
+            if name == "I" and not args:
+                return EZO_SUCCESS, "?I,%s,%s" % (self.DEVICE_TYPE, self.FIRMWARE), self.COMMAND_TIME
+            if name == "STATUS" and not args:
+                return EZO_SUCCESS, "?Status,P,5.038", self.COMMAND_TIME
+        except ValueError:
+            pass
+        return EZO_SYNTAX_ERROR, "", self.COMMAND_TIME
+
+    def reading(self):
+        """Return what the probe currently measures, including noise and calibration."""
+        value = self.measure()
+        if self.noise:
+            value += self.random.gauss(0, self.noise)
+        return value
+
+    def measure(self):
+        raise NotImplementedError
+
+    def calibrate(self, args):
+        raise NotImplementedError
+
+    def format_reading(self, value):
+        raise NotImplementedError
+
+
+class EZOpHEmulator(EZOEmulator):
+    """
+    EZO-pH circuit.
+
+    The probe has an offset and a slope error which the usual three point calibration removes
+    (CAL,mid,7.00 / CAL,low,4.00 / CAL,high,10.00). Temperature compensation follows the Nernst equation, so a
+    wrong RT temperature skews readings away from 7.
+    """
+
+    DEVICE_TYPE = "pH"
+
+    def __init__(self, value_source, temperature_source=None, probe_offset=0.0, probe_slope=1.0, **kwargs):
+        """
+        Args:
+            value_source: Function returning the true pH of the water.
+            temperature_source: Function returning the real water temperature in Celsius.
+            probe_offset: pH error of the uncalibrated probe at pH 7.
+            probe_slope: Slope of the uncalibrated probe relative to an ideal one.
+        """
+        super().__init__(value_source, temperature_source, **kwargs)
+        self.probe_offset = probe_offset
+        self.probe_slope = probe_slope
+        self.cal_points = {}
+
+    def raw_reading(self):
+        # What the uncalibrated board would say with the compensation temperature it was given
+        true_ph = self.value_source()
+        nernst = (self.temperature_source() + 273.15) / (self.compensation_temperature + 273.15)
+        return 7.0 + self.probe_offset + (true_ph - 7.0) * self.probe_slope * nernst
+
+    def measure(self):
+        raw = self.raw_reading()
+        if 'mid' not in self.cal_points:
+            return raw
+        raw_mid, ref_mid = self.cal_points['mid']
+        side = 'low' if raw < raw_mid else 'high'
+        if side in self.cal_points:
+            raw_point, ref_point = self.cal_points[side]
+            slope = (ref_point - ref_mid) / (raw_point - raw_mid)
+        else:
+            slope = 1.0
+        return ref_mid + (raw - raw_mid) * slope
+
+    def calibrate(self, args):
+        point = args[0].lower()
+        if point == "?":
+            return EZO_SUCCESS, "?CAL,%d" % len(self.cal_points), self.COMMAND_TIME
+        if point == "clear":
+            self.cal_points = {}
+            return EZO_SUCCESS, "", self.COMMAND_TIME
+        if point in ("mid", "low", "high") and len(args) == 2:
+            if point == "mid":
+                # Calibrating the midpoint clears the other points, like the real firmware
+                self.cal_points = {}
+            self.cal_points[point] = (self.raw_reading(), float(args[1]))
+            return EZO_SUCCESS, "", self.CALIBRATION_TIME
+        return EZO_SYNTAX_ERROR, "", self.COMMAND_TIME
+
+    def format_reading(self, value):
+        return "%.3f" % value
+
+
+class EZOECEmulator(EZOEmulator):
+    """
+    EZO-EC circuit, configured to output EC only (microsiemens, compensated to 25 C).
+
+    The probe has a gain error removed by CAL,<value> (or CAL,low/CAL,high) and a zero offset removed by
+    CAL,dry. Conductivity rises roughly 2 % per degree, so readings drift when RT is given the wrong temperature.
+    """
+
+    DEVICE_TYPE = "EC"
+    READING_TIME = 0.6
+    CALIBRATION_TIME = 0.6
+    TEMPERATURE_COEFFICIENT = 0.02
+
+    def __init__(self, value_source, temperature_source=None, probe_gain=1.0, probe_zero=0.0, **kwargs):
+        """
+        Args:
+            value_source: Function returning the true EC of the water at 25 C in uS/cm.
+            temperature_source: Function returning the real water temperature in Celsius.
+            probe_gain: Gain error of the uncalibrated probe.
+            probe_zero: Reading of the uncalibrated probe in dry air.
+        """
+        super().__init__(value_source, temperature_source, **kwargs)
+        self.probe_gain = probe_gain
+        self.probe_zero = probe_zero
+        self.zero = 0.0
+        self.gain = 1.0
+        self.cal_count = 0
+
+    def raw_reading(self, dry=False):
+        true_ec = 0.0 if dry else self.value_source()
+        actual = true_ec * (1 + self.TEMPERATURE_COEFFICIENT * (self.temperature_source() - 25))
+        compensated = actual / (1 + self.TEMPERATURE_COEFFICIENT * (self.compensation_temperature - 25))
+        return compensated * self.probe_gain + self.probe_zero
+
+    def measure(self):
+        return max(0.0, (self.raw_reading() - self.zero) * self.gain)
+
+    def calibrate(self, args):
+        point = args[0].lower()
+        if point == "?":
+            return EZO_SUCCESS, "?CAL,%d" % self.cal_count, self.COMMAND_TIME
+        if point == "clear":
+            self.zero, self.gain, self.cal_count = 0.0, 1.0, 0
+            return EZO_SUCCESS, "", self.COMMAND_TIME
+        if point == "dry" and len(args) == 1:
+            self.zero = self.raw_reading(dry=True)
+            self.cal_count = 1
+            return EZO_SUCCESS, "", self.CALIBRATION_TIME
+        if point in ("low", "high") and len(args) == 2:
+            args = args[1:]
+        if len(args) == 1:
+            self.gain = float(args[0]) / (self.raw_reading() - self.zero)
+            self.cal_count = min(self.cal_count + 1, 2)
+            return EZO_SUCCESS, "", self.CALIBRATION_TIME
+        return EZO_SYNTAX_ERROR, "", self.COMMAND_TIME
+
+    def format_reading(self, value):
+        if value < 10:
+            return "%.2f" % value
+        if value < 1000:
+            return "%.1f" % value
+        return "%d" % round(value)
@@ -0,0 +1,364 @@
+import contextlib
+import logging
+import os
+import threading
+
+from file_operations.logging_config import RateLimitedLogger
+from user_controlled_constants import *
+
+# Nothing in this module touches the hardware (or imports the Adafruit libraries) until a device is actually
+# used: each device is built the first time one of the HardwareContext properties is read. Importing the control
+# modules is therefore instant and safe on any machine, and simulations swap the whole context with set_hardware().
+
+# Devices whose traffic is recorded while a traffic recorder is set (see utilities/traffic_log.py), pumps are
+# recorded through their listeners
+RECORDED_DEVICES = ('ph_sensor', 'ec_sensor', 'adc', 'temp_sensor')
+
+# Settings of user_controlled_constants.py a reservoir of its own can change (see PLANT_HARDWARE)
+PLANT_HARDWARE_SETTINGS = ('I2C_BUSNUM', 'EC_SENSOR_I2C_ADDRESS', 'PH_SENSOR_I2C_ADDRESS', 'W1_TEMP_PATH',
+                           'ADC_I2C_ADDRESS', 'ADC_BUSNUM', 'DRIVER0_I2C_ADDRESS', 'DRIVER1_I2C_ADDRESS')
+
+# A missing probe stays missing, log it once every LOG_RATE_LIMIT_INTERVAL seconds
+error_log = RateLimitedLogger(logging.getLogger(__name__))
+
+
+class W1TemperatureSensor:
+    """The 1-wire temperature probe, read through its sysfs file."""
+
+    def __init__(self, path=W1_TEMP_PATH):
+        self.path = path
+
+    def readline(self):
+        """Return the raw reading (thousandths of a degree Celsius) as text, None if the probe is missing."""
+        try:
+            with open(self.path, 'r') as temp_file:
+                return temp_file.readline()
+        except FileNotFoundError:
+            error_log.error("Error: Temperature file %s not found.", self.path, key='temperature_file',
+                            sensor='temp_c')
+            return None
+
+
+class HardwareContext:
+    """
+    All the devices of one hydroponic system, created lazily.
+
+    Subclasses (see simulation/simulated_hardware.py) override the _build_<name> methods or motor() to provide
+    emulated devices instead.
+    """
+
+    def __init__(self, bus_number=I2C_BUSNUM, settings=None, name=None):
+        """
+        Args:
+            bus_number: I2C bus shared by the Atlas boards, the ADC and the motor drivers.
+            settings: Setting name -> value of the PLANT_HARDWARE_SETTINGS that differ for this reservoir.
+            name: Name of the plant this reservoir belongs to, None for the default hardware. Its files (telemetry,
+                water level calibration) get the name as a suffix.
+        """
+        self.settings = dict(settings or {})
+        unknown = set(self.settings) - set(PLANT_HARDWARE_SETTINGS)
+        if unknown:
+            raise ValueError("Unknown hardware settings %s, use %s" % (', '.join(sorted(unknown)),
+                                                                       ', '.join(PLANT_HARDWARE_SETTINGS)))
+        self.name = name
+        self.bus_number = self.settings.get('I2C_BUSNUM', bus_number)
+        self._built = {}
+        self._lock = threading.RLock()
+
+    def _lazy(self, name):
+        with self._lock:
+            if name not in self._built:
+                device = getattr(self, '_build_' + name)()
+                if name in RECORDED_DEVICES and self.traffic_recorder is not None:
+                    from utilities.traffic_log import record_device
+                    device = record_device(name, device, self.traffic_recorder)
+                self._built[name] = device
+            return self._built[name]
+
+    def built(self):
+        """Return the names of the devices created so far."""
+        return list(self._built)
+
+    def setting(self, name):
+        """Return a setting of user_controlled_constants.py, as changed for this reservoir."""
+        return self.settings.get(name, globals()[name])
+
+    @property
+    def adc_bus_number(self):
+        """I2C bus of the ADC: ADC_BUSNUM, or the bus of the reservoir if it set I2C_BUSNUM but no ADC_BUSNUM."""
+        if 'I2C_BUSNUM' in self.settings and 'ADC_BUSNUM' not in self.settings:
+            return self.bus_number
+        return self.setting('ADC_BUSNUM')
+
+    def own_file(self, path):
+        """Return the path of a file of this reservoir: path itself for the default hardware, path_<name> else."""
+        if self.name is None:
+            return path
+        root, extension = os.path.splitext(path)
+        return '%s_%s%s' % (root, self.name, extension)
+
+    def record_traffic(self, recorder):
+        """
+        Record the traffic of the devices and pumps built from now on with a TrafficRecorder (see
+        utilities/traffic_log.py), whatever TRAFFIC_RECORDING says.
+        """
+        with self._lock:
+            self._built['traffic_recorder'] = recorder
+
+    # Devices
+
+    @property
+    def i2c_bus(self):
+        return self._lazy('i2c_bus')
+
+    @property
+    def ph_sensor(self):
+        return self._lazy('ph_sensor')
+
+    @property
+    def ec_sensor(self):
+        return self._lazy('ec_sensor')
+
+    @property
+    def temp_sensor(self):
+        return self._lazy('temp_sensor')
+
+    @property
+    def adc(self):
+        return self._lazy('adc')
+
+    @property
+    def water_level_sampler(self):
+        return self._lazy('water_level_sampler')
+
+    @property
+    def water_level_table(self):
+        return self._lazy('water_level_table')
+
+    @property
+    def sensor_cache(self):
+        return self._lazy('sensor_cache')
+
+    @property
+    def sensor_filters(self):
+        return self._lazy('sensor_filters')
+
+    @property
+    def telemetry(self):
+        return self._lazy('telemetry')
+
+    @property
+    def dose_ledger(self):
+        return self._lazy('dose_ledger')
+
+    @property
+    def traffic_recorder(self):
+        return self._lazy('traffic_recorder')
+
+    @property
+    def ph_controller(self):
+        return self._lazy('ph_controller')
+
+    @property
+    def nutrient_model(self):
+        return self._lazy('nutrient_model')
+
+    def motor(self, position):
+        """Return the motor at a position written like 'driver0.motor4'."""
+        driver_name, motor_name = position.split('.')
+        return getattr(self._lazy(driver_name), motor_name)
+
+    # Pumps
+
+    @property
+    def fresh_water_pump(self):
+        return self._lazy('fresh_water_pump')
+
+    @property
+    def nutrient_pumps(self):
+        return self._lazy('nutrient_pumps')
+
+    @property
+    def ph_up_pump(self):
+        return self._lazy('ph_up_pump')
+
+    @property
+    def ph_down_pump(self):
+        return self._lazy('ph_down_pump')
+
+    @property
+    def all_pumps(self):
+        """Water, nutrient, and pH pumps."""
+        return [self.fresh_water_pump] + self.nutrient_pumps + [self.ph_up_pump, self.ph_down_pump]
+
+    def _build_i2c_bus(self):
+        from utilities.i2c_bus import get_i2c_bus
+        return get_i2c_bus(self.bus_number)
+
+    def _build_ph_sensor(self):
+        from utilities.AtlasI2C import AtlasI2C
+        address = self.setting('PH_SENSOR_I2C_ADDRESS')
+        return AtlasI2C(address, bus=self.bus_number, adaptive=ATLAS_ADAPTIVE_READS,
+                        transport=self.i2c_bus.device(address))
+
+    def _build_ec_sensor(self):
+        from utilities.AtlasI2C import AtlasI2C
+        address = self.setting('EC_SENSOR_I2C_ADDRESS')
+        return AtlasI2C(address, bus=self.bus_number, adaptive=ATLAS_ADAPTIVE_READS,
+                        transport=self.i2c_bus.device(address))
+
+    def _build_temp_sensor(self):
+        return W1TemperatureSensor(self.setting('W1_TEMP_PATH'))
+
+    def _build_adc(self):
+        import Adafruit_ADS1x15
+        from utilities.i2c_bus import GPIOI2CAdapter, get_i2c_bus
+        # The adapter decides the bus, Adafruit_ADS1x15 only passes busnum on to it
+        bus_number = self.adc_bus_number
+        bus = self.i2c_bus if bus_number == self.bus_number else get_i2c_bus(bus_number)
+        return Adafruit_ADS1x15.ADS1115(address=self.setting('ADC_I2C_ADDRESS'), busnum=bus_number,
+                                        i2c=GPIOI2CAdapter(bus))
+
+    def _build_water_level_sampler(self):
+        from Water_level_nutrients_ph_manager.read_water_sensor import WaterLevelSampler
+        return WaterLevelSampler(self.adc)
+
+    def _build_water_level_table(self):
+        from Water_level_nutrients_ph_manager.water_level_calibration import WaterLevelCalibration, CALIBRATION_PATH
+        # None until the reservoir is calibrated, the quadratic curve is used meanwhile
+        calibration = WaterLevelCalibration.load(self.own_file(CALIBRATION_PATH))
+        return calibration.table if calibration is not None else None
+
+    def _build_driver0(self):
+        from adafruit_motorkit import MotorKit
+        from utilities.i2c_bus import BusioI2CAdapter
+        return MotorKit(self.setting('DRIVER0_I2C_ADDRESS'), i2c=BusioI2CAdapter(self.i2c_bus))
+
+    def _build_driver1(self):
+        from adafruit_motorkit import MotorKit
+        from utilities.i2c_bus import BusioI2CAdapter
+        return MotorKit(self.setting('DRIVER1_I2C_ADDRESS'), i2c=BusioI2CAdapter(self.i2c_bus))
+
+    def _build_sensor_cache(self):
+        from utilities.sensor_cache import SensorCache
+        # Last readings of every sensor, reused while younger than SENSOR_CACHE_TTL seconds
+        return SensorCache(SENSOR_CACHE_TTL)
+
+    def _build_sensor_filters(self):
+        from utilities.signal_filters import SignalFilters
+        return SignalFilters(SENSOR_FILTERS)
+
+    def _build_telemetry(self):
+        from file_operations.telemetry_ring import TelemetryRing, TELEMETRY_FILE
+        return TelemetryRing(self.own_file(TELEMETRY_FILE))
+
+    def _build_dose_ledger(self):
+        from file_operations.dose_ledger import get_dose_ledger
+        return get_dose_ledger()
+
+    def _build_traffic_recorder(self):
+        if not TRAFFIC_RECORDING:
+            return None
+        from utilities.traffic_log import get_traffic_recorder
+        return get_traffic_recorder()
+
+    def _build_ph_controller(self):
+        from Water_level_nutrients_ph_manager.ph_controllers import make_ph_controller
+        # What it learns about the reservoir is kept for the next balancing runs
+        return make_ph_controller(PH_CONTROLLER)
+
+    def _build_nutrient_model(self):
+        from file_operations.dose_ledger import measured_flow_rates
+        from Water_level_nutrients_ph_manager.nutrient_dosing import NutrientResponseModel, calibrated_rates
+        # Learned ppm response of the nutrient pumps of this reservoir, kept for the next dosing runs, starting from
+        # what the measured flows give when the concentrate and the reservoir were measured too
+        initial_rates = None
+        if NUTRIENT_STOCK_CONCENTRATION and RESERVOIR_LITERS_PER_INCH:
+            initial_rates = calibrated_rates(measured_flow_rates(), NUTRIENT_STOCK_CONCENTRATION,
+                                             RESERVOIR_LITERS_PER_INCH,
+                                             ('nutrient1', 'nutrient2', 'nutrient3', 'nutrient4'))
+        return NutrientResponseModel(initial_rates=initial_rates)
+
+    def _make_pump(self, position, direction, name):
+        from utilities.pumps import Pump
+        pump = Pump(self.motor(position), direction, name)
+        pump.listeners.append(self._pump_changed)
+        pump.listeners.append(self.dose_ledger.record_pump)
+        if self.traffic_recorder is not None:
+            pump.listeners.append(self.traffic_recorder.record_pump)
+        return pump
+
+    def _pump_changed(self, pump, running):
+        # Every start and stop of every pump ends up in the telemetry history
+        self.telemetry.record_pump(pump, running)
+
+    def _build_fresh_water_pump(self):
+        return self._make_pump(WATER_PUMP_POSITION, WATER_PUMP_DIRECTION, 'fresh_water')
+
+    def _build_nutrient_pumps(self):
+        return [self._make_pump(NUTRIENT_PUMP1_POSITION, NUTRIENT_PUMP1_DIRECTION, 'nutrient1'),
+                self._make_pump(NUTRIENT_PUMP2_POSITION, NUTRIENT_PUMP2_DIRECTION, 'nutrient2'),
+                self._make_pump(NUTRIENT_PUMP3_POSITION, NUTRIENT_PUMP3_DIRECTION, 'nutrient3'),
+                self._make_pump(NUTRIENT_PUMP4_POSITION, NUTRIENT_PUMP4_DIRECTION, 'nutrient4')]
+
+    def _build_ph_up_pump(self):
+        return self._make_pump(PH_UP_PUMP_POSITION, PH_UP_PUMP_DIRECTION, 'ph_up')
+
+    def _build_ph_down_pump(self):
+        return self._make_pump(PH_DOWN_PUMP_POSITION, PH_DOWN_PUMP_DIRECTION, 'ph_down')
+
+
+_hardware = None
+_hardware_lock = threading.Lock()
+# Context used by the current thread only, when a plant thread drives its own reservoir (see use_hardware)
+_thread_hardware = threading.local()
+
+
+def get_hardware():
+    """Return the hardware context used by the control code (the real Raspberry Pi one by default)."""
+    global _hardware
+    hardware = getattr(_thread_hardware, 'hardware', None)
+    if hardware is not None:
+        return hardware
+    if _hardware is None:
+        with _hardware_lock:
+            if _hardware is None:
+                _hardware = HardwareContext()
+    return _hardware
+
+
+def set_hardware(hardware):
+    """
+    Replace the hardware context used by the control code.
+
+    Returns:
+        The previous context (possibly None), so it can be restored.
+    """
+    global _hardware
+    previous = _hardware
+    _hardware = hardware
+    return previous
+
+
+def plant_hardware(plant_name):
+    """
+    Return the hardware context of a plant with a reservoir of its own (see PLANT_HARDWARE), None for the plant
+    using the default hardware.
+    """
+    if plant_name not in PLANT_HARDWARE:
+        return None
+    return HardwareContext(settings=PLANT_HARDWARE[plant_name], name=plant_name)
+
+
+@contextlib.contextmanager
+def use_hardware(hardware):
+    """
+    Make the control code running in the current thread use another hardware context, for example the devices
+    of the reservoir of one plant while other plants run in other threads.
+    """
+    previous = getattr(_thread_hardware, 'hardware', None)
+    _thread_hardware.hardware = hardware
+    try:
+        yield hardware
+    finally:
+        _thread_hardware.hardware = previous
@@ -0,0 +1,205 @@
+import threading
+
+from utilities import tracing
+from utilities.i2c_transport import I2CDevFile
+
+
+class I2CBus:
+    """
+    Shared manager for one I2C bus.
+
+    It owns a single transport (one file descriptor on /dev/i2c-N on the Pi) for every device on the bus, only
+    re-selects the slave address when the device changes, and serializes transactions with a lock so the Atlas
+    boards, the ADS1115 and both motor drivers can be used from several threads safely. Per-device counters show
+    how much traffic each device generates.
+    """
+
+    def __init__(self, bus, transport=None):
+        """
+        Args:
+            bus: I2C bus number.
+            transport: Raw transport to use (set_address/write/read), by default an I2CDevFile on the bus.
+        """
+        self.bus = bus
+        self.transport = transport or I2CDevFile(bus)
+        # Re-entrant so adapters can hold the bus across a write + read and still use write()/read()
+        self.lock = threading.RLock()
+        self._current_address = None
+        self._stats = {}
+
+    def _device_stats(self, address):
+        stats = self._stats.get(address)
+        if stats is None:
+            stats = {"writes": 0, "reads": 0, "bytes_written": 0, "bytes_read": 0, "address_switches": 0,
+                     "errors": 0}
+            self._stats[address] = stats
+        return stats
+
+    def _select(self, address, stats):
+        # Skip the ioctl when the bus already points at this device
+        if address != self._current_address:
+            self._current_address = None
+            self.transport.set_address(address)
+            self._current_address = address
+            stats["address_switches"] += 1
+
+    def write(self, address, data):
+        """Send raw bytes to the device at address."""
+        with self.lock, tracing.span('i2c write', 'i2c', address=hex(address), bytes=len(data)):
+            stats = self._device_stats(address)
+            try:
+                self._select(address, stats)
+                self.transport.write(data)
+            except IOError:
+                stats["errors"] += 1
+                raise
+            stats["writes"] += 1
+            stats["bytes_written"] += len(data)
+
+    def read(self, address, num_of_bytes):
+        """Read raw bytes from the device at address."""
+        with self.lock, tracing.span('i2c read', 'i2c', address=hex(address), bytes=num_of_bytes):
+            stats = self._device_stats(address)
+            try:
+                self._select(address, stats)
+                data = self.transport.read(num_of_bytes)
+            except IOError:
+                stats["errors"] += 1
+                raise
+            stats["reads"] += 1
+            stats["bytes_read"] += len(data)
+            return data
+
+    def write_then_read(self, address, data, num_of_bytes):
+        """Write then read without letting another device use the bus in between (register reads)."""
+        with self.lock:
+            self.write(address, data)
+            return self.read(address, num_of_bytes)
+
+    def device(self, address):
+        """Return a transport for a single device, to pass to AtlasI2C(transport=...)."""
+        return I2CDeviceTransport(self, address)
+
+    def stats(self):
+        """Return {address: counters} for every device that used the bus."""
+        with self.lock:
+            return {address: dict(stats) for address, stats in self._stats.items()}
+
+    def close(self):
+        with self.lock:
+            self.transport.close()
+
+
+class I2CDeviceTransport:
+    """Transport interface (set_address/write/read/close) for one device of a shared I2CBus."""
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+    def set_address(self, address):
+        # Nothing to do on the bus, the address is selected (if needed) on the next transaction
+        self.address = address
+
+    def write(self, data):
+        self.bus.write(self.address, data)
+
+    def read(self, num_of_bytes):
+        return self.bus.read(self.address, num_of_bytes)
+
+    def close(self):
+        # The bus is shared, it is closed by its owner
+        pass
+
+
+class GPIOI2CAdapter:
+    """
+    Stand-in for the Adafruit_GPIO.I2C module, so Adafruit_ADS1x15 goes through the shared bus:
+    Adafruit_ADS1x15.ADS1115(address=..., i2c=GPIOI2CAdapter(bus)).
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def get_i2c_device(self, address, **kwargs):
+        return GPIOI2CDevice(self.bus, address)
+
+
+class GPIOI2CDevice:
+    """The subset of Adafruit_GPIO.I2C.Device used by Adafruit_ADS1x15."""
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+    def writeList(self, register, data):
+        self.bus.write(self.address, bytes([register]) + bytes(data))
+
+    def readList(self, register, length):
+        return bytearray(self.bus.write_then_read(self.address, bytes([register]), length))
+
+    def write8(self, register, value):
+        self.writeList(register, [value & 0xFF])
+
+    def readU8(self, register):
+        return self.readList(register, 1)[0]
+
+
+class BusioI2CAdapter:
+    """
+    Stand-in for busio.I2C, so the CircuitPython MotorKit drivers go through the shared bus:
+    MotorKit(address=..., i2c=BusioI2CAdapter(bus)).
+
+    try_lock()/unlock() map to the bus lock, which keeps the drivers from interleaving with the other devices.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def try_lock(self):
+        return self.bus.lock.acquire(blocking=False)
+
+    def unlock(self):
+        self.bus.lock.release()
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        self.bus.write(address, bytes(buffer[start:end]))
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        end = len(buffer) if end is None else end
+        buffer[start:end] = self.bus.read(address, end - start)
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0,
+                              in_end=None):
+        in_end = len(buffer_in) if in_end is None else in_end
+        buffer_in[in_start:in_end] = self.bus.write_then_read(address, bytes(buffer_out[out_start:out_end]),
+                                                              in_end - in_start)
+
+    def scan(self):
+        found = []
+        for address in range(0x08, 0x78):
+            try:
+                self.bus.read(address, 1)
+                found.append(address)
+            except IOError:
+                pass
+        return found
+
+
+# One shared manager per bus number, created on first use
+_buses = {}
+_buses_lock = threading.Lock()
+
+
+def get_i2c_bus(bus):
+    """Return the shared I2CBus for a bus number, opening it the first time."""
+    with _buses_lock:
+        if bus not in _buses:
+            _buses[bus] = I2CBus(bus)
+        return _buses[bus]
+
+
+def set_i2c_bus(bus, manager):
+    """Use the given I2CBus (for example one over a MemoryI2CTransport) for a bus number."""
+    with _buses_lock:
+        _buses[bus] = manager
@@ -0,0 +1,158 @@
+import errno
+import fcntl
+import io
+import os
+import time
+
+# ioctl request number used to select the slave device on an i2c-dev file (from i2c-dev.h in i2c-tools)
+I2C_SLAVE = 0x703
+
+
+class I2CDevTransport:
+    """
+    Talk to a real I2C bus through the Linux i2c-dev interface (/dev/i2c-N).
+
+    This is what AtlasI2C always did: two unbuffered file streams, one for reading and one for writing,
+    both pointed at the current slave address with an ioctl.
+    """
+
+    def __init__(self, bus):
+        """
+        Args:
+            bus: I2C bus number (usually 1, older Raspberry Pi revisions use 0).
+        """
+        self.bus = bus
+        self.address = None
+        self.file_read = io.open(file="/dev/i2c-{}".format(bus), mode="rb", buffering=0)
+        self.file_write = io.open(file="/dev/i2c-{}".format(bus), mode="wb", buffering=0)
+
+    def set_address(self, address):
+        """Point both file streams at the slave device with the given address."""
+        fcntl.ioctl(self.file_read, I2C_SLAVE, address)
+        fcntl.ioctl(self.file_write, I2C_SLAVE, address)
+        self.address = address
+
+    def write(self, data):
+        """Send raw bytes to the current slave device."""
+        self.file_write.write(data)
+
+    def read(self, num_of_bytes):
+        """Read raw bytes from the current slave device."""
+        return self.file_read.read(num_of_bytes)
+
+    def close(self):
+        self.file_read.close()
+        self.file_write.close()
+
+
+class I2CDevFile:
+    """
+    Single read/write file descriptor on /dev/i2c-N.
+
+    Used by the shared bus manager (utilities/i2c_bus.py), which owns one of these per bus for all the devices.
+    """
+
+    def __init__(self, bus):
+        """
+        Args:
+            bus: I2C bus number (usually 1, older Raspberry Pi revisions use 0).
+        """
+        self.bus = bus
+        self.address = None
+        self.fd = os.open("/dev/i2c-{}".format(bus), os.O_RDWR)
+
+    def set_address(self, address):
+        fcntl.ioctl(self.fd, I2C_SLAVE, address)
+        self.address = address
+
+    def write(self, data):
+        os.write(self.fd, bytes(data))
+
+    def read(self, num_of_bytes):
+        return os.read(self.fd, num_of_bytes)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MemoryI2CTransport:
+    """
+    In-memory I2C bus: every address maps to an emulated device instead of real hardware.
+
+    Devices only need two methods, on_write(data) and on_read(num_of_bytes), so the EZO emulators in
+    utilities/ezo_emulator.py (or any other fake) can be plugged in. Several transports can share the same
+    devices dictionary, just like several AtlasI2C objects share /dev/i2c-1 on the Pi.
+    """
+
+    def __init__(self, devices=None):
+        """
+        Args:
+            devices: Dictionary mapping I2C address -> emulated device.
+        """
+        self.devices = devices if devices is not None else {}
+        self.address = None
+
+    def attach(self, address, device):
+        """Add an emulated device to the bus at the given address."""
+        self.devices[address] = device
+
+    def set_address(self, address):
+        self.address = address
+
+    def _current_device(self):
+        # Same error the kernel gives when nothing acknowledges the address
+        device = self.devices.get(self.address)
+        if device is None:
+            raise IOError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        return device
+
+    def write(self, data):
+        self._current_device().on_write(bytes(data))
+
+    def read(self, num_of_bytes):
+        return self._current_device().on_read(num_of_bytes)
+
+    def close(self):
+        pass
+
+
+class RecordingI2CTransport:
+    """
+    Wrap another transport and keep a copy of all traffic that goes through it.
+
+    Each record is a tuple (timestamp, operation, address, data) where operation is 'w' or 'r'.
+    Useful to check exactly which commands the control code sent, and how many bus transactions it took.
+    """
+
+    def __init__(self, transport, clock=time.monotonic):
+        """
+        Args:
+            transport: The transport that actually carries the traffic.
+            clock: Function returning the current time in seconds, used to timestamp records.
+        """
+        self.transport = transport
+        self.clock = clock
+        self.records = []
+
+    @property
+    def address(self):
+        return self.transport.address
+
+    def set_address(self, address):
+        self.transport.set_address(address)
+
+    def write(self, data):
+        self.transport.write(data)
+        self.records.append((self.clock(), 'w', self.transport.address, bytes(data)))
+
+    def read(self, num_of_bytes):
+        data = self.transport.read(num_of_bytes)
+        self.records.append((self.clock(), 'r', self.transport.address, bytes(data)))
+        return data
+
+    def clear(self):
+        """Forget everything recorded so far."""
+        self.records = []
+
+    def close(self):
+        self.transport.close()
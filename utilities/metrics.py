@@ -0,0 +1,279 @@
+import bisect
+import threading
+
+from user_controlled_constants import METRICS_ENABLED, METRICS_ADDRESS, METRICS_PORT
+
+# Instrumentation of the controller: counters, gauges and histograms kept in memory and served as Prometheus
+# text on a local HTTP port (start_http_server). The instrumented modules declare their metrics once at import:
+#
+#     PUMP_STARTS = metrics.counter('pump_starts_total', 'Pump starts.', ['pump'])
+#     PUMP_STARTS.labels('ph_up').inc()
+#
+# With METRICS_ENABLED off, the module level functions hand out a shared do-nothing metric instead, so every
+# instrumentation call costs one empty method call and nothing is stored.
+
+# Upper bounds (seconds) of the histogram buckets, from a single I2C transfer to a long dosing run
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0, 900.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join('%s="%s"' % (name, value) for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    """Base class of the metrics: a name, a help text, label names, and one child per set of label values."""
+
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # Metrics without labels are used directly, metric.inc() instead of metric.labels().inc()
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """Return the child of the given label values (in the order of labelnames), created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s takes the labels %s, got %r" % (self.name, self.labelnames, values))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Yield (name suffix, label values, extra labels, value) for the text exposition."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(self.labelnames, values, extra),
+                                        _format_value(value)))
+        return '\n'.join(lines)
+
+
+class _Value:
+    """Child of a counter or a gauge."""
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class Counter(Metric):
+    """A value that only goes up (pump starts, errors, seconds of pump run time)."""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield '', values, (), child.value
+
+
+class Gauge(Metric):
+    """A value that goes up and down (pump running or not, last reading)."""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount=1.0):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield '', values, (), child.value
+
+
+class _HistogramValue:
+    """Child of a histogram: one count per bucket (not cumulative), the sum and the count of the observations."""
+
+    def __init__(self, lock, buckets):
+        self._lock = lock
+        self._buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Histogram(Metric):
+    """Distribution of durations (I2C transaction latency, control loop iteration time) over fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self._lock, self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.bucket_counts):
+                cumulative += count
+                yield '_bucket', values, (('le', _format_value(bound)),), cumulative
+            yield '_sum', values, (), child.sum
+            yield '_count', values, (), child.count
+
+
+class NullMetric:
+    """Stands for every metric while the metrics are disabled, every call does nothing."""
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount=1.0):
+        pass
+
+    def dec(self, amount=1.0):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class MetricsRegistry:
+    """All the metrics of the process, by name."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, help_text, labelnames, **options):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, help_text, labelnames, **options)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+                raise ValueError("Metric %s is already registered with another type or other labels" % name)
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._get(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._get(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return ''.join(metric.render() + '\n' for metric in metrics)
+
+
+registry = MetricsRegistry()
+enabled = METRICS_ENABLED
+
+
+def counter(name, help_text, labelnames=()):
+    """Return the counter registered under name (created on first use), a do-nothing one if disabled."""
+    return registry.counter(name, help_text, labelnames) if enabled else NULL_METRIC
+
+
+def gauge(name, help_text, labelnames=()):
+    """Return the gauge registered under name (created on first use), a do-nothing one if disabled."""
+    return registry.gauge(name, help_text, labelnames) if enabled else NULL_METRIC
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Return the histogram registered under name (created on first use), a do-nothing one if disabled."""
+    return registry.histogram(name, help_text, labelnames, buckets) if enabled else NULL_METRIC
+
+
+def start_http_server(port=METRICS_PORT, address=METRICS_ADDRESS):
+    """
+    Serve registry.render() at http://address:port/metrics from a background thread.
+
+    Returns:
+        The server (call shutdown() to stop it).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the controller log
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
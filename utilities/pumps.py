@@ -1,31 +1,112 @@
 # Import components from the main module: motor drivers and nutrient pump times.
+import logging
 import sys
+import threading
+
+from file_operations.logging_config import RateLimitedLogger
+from utilities import clock, metrics
+
+# Names given to the pumps of a HardwareContext, their position in this tuple is used as a compact pump id
+PUMP_NAMES = ('fresh_water', 'nutrient1', 'nutrient2', 'nutrient3', 'nutrient4', 'ph_up', 'ph_down')
+
+PUMP_STARTS = metrics.counter('pump_starts_total', 'Number of times each pump was started.', ['pump'])
+PUMP_ON_SECONDS = metrics.counter('pump_on_seconds_total', 'Time each pump ran, counted when it stops.', ['pump'])
+PUMP_RUNNING = metrics.gauge('pump_running', 'Whether each pump is running (1) or stopped (0).', ['pump'])
+
+# A listener failing on every start or stop (full SD card) is logged once every LOG_RATE_LIMIT_INTERVAL seconds
+error_log = RateLimitedLogger(logging.getLogger(__name__))
 
 
 # Import the MotorKit class from the Adafruit Motor HAT library.
 class Pump:
-    def __init__(self, motor, direction):
+    def __init__(self, motor, direction, name=""):
         """
         Initialize a new Pump object.
 
         Args:
             motor: Motor object from the MotorKit.
             direction: Integer representing the motor direction (1 or -1).
+            name: Name of the pump (see PUMP_NAMES), used to record what it does.
         """
         self.motor = motor
         self.direction = direction
+        self.name = name
+        # Clock time the pump was started at, None while it is stopped
+        self.started_at = None
+        # 1 while it runs forward, -1 in reverse, 0 while it is stopped
+        self.running = 0
+        # Run time (seconds) of the last run, set when the pump stops
+        self.last_run_time = None
+        # Functions called as listener(pump, running) every time the pump starts or stops, running is 1 when it
+        # starts forward, -1 in reverse and 0 when it stops (the throttle is not read back from the driver board);
+        # when stopping pump.last_run_time holds the run time. Changing direction while running is reported as a
+        # stop then a start. A listener raising is logged, the pump goes on.
+        self.listeners = []
+        # Plants running in their own threads (see plant_tasks.py) may share pumps: a pump is owned by the
+        # thread that started it until that thread stops it, other threads wait for it in start()
+        self.lock = threading.Lock()
+        self.owner = None
+
+    def _acquire(self):
+        if self.owner != threading.get_ident():
+            clock.acquire(self.lock)
+            self.owner = threading.get_ident()
+
+    def _release(self):
+        if self.owner == threading.get_ident():
+            self.owner = None
+            self.lock.release()
+
+    def _changed(self, running):
+        if running == self.running:
+            return
+        if running and self.running:
+            # Switched direction without stopping: the run in the other direction ends here
+            self._changed(0)
+        self.running = running
+        # The state of the pump is updated first, whatever the listeners do
+        now = clock.monotonic()
+        if running:
+            PUMP_STARTS.labels(self.name).inc()
+            self.started_at = now
+        else:
+            self.last_run_time = now - self.started_at
+            PUMP_ON_SECONDS.labels(self.name).inc(self.last_run_time)
+            self.started_at = None
+        PUMP_RUNNING.labels(self.name).set(1 if running else 0)
+        for listener in self.listeners:
+            try:
+                listener(self, running)
+            except Exception as error:
+                # Recording a pump run must never stop the pump control
+                name = getattr(listener, '__qualname__', repr(listener))
+                error_log.error("Pump listener %s failed for %s: %s", name, self.name, error,
+                                key=('pump listener', name), pump=self.name)
 
     def start(self):
         """Start the pump by setting the motor throttle to its direction."""
+        self._acquire()
         self.motor.throttle = self.direction
+        self._changed(1)
 
     def stop(self):
-        """Stop the pump by setting the motor throttle to zero."""
-        self.motor.throttle = 0
+        """
+        Stop the pump by setting the motor throttle to zero.
+
+        Any thread can stop a pump (emergency stop), but only the thread that started it hands it over to the
+        other ones, even if stopping failed, so the other plants are never locked out.
+        """
+        try:
+            self.motor.throttle = 0
+            self._changed(0)
+        finally:
+            self._release()
 
     def startReverse(self):
         """Start the pump in reverse by setting the motor throttle to the opposite of its direction."""
+        self._acquire()
         self.motor.throttle = -self.direction
+        self._changed(-1)
 
 
 # Prime pumps with the user's help
@@ -61,4 +142,4 @@ def run_pumps_list(pumps_list, reverse=False):
 def stop_pumps_list(pumps_list):
     """Stop all pumps in the given list."""
     for pump in pumps_list:
-        pump.stop(pump)
+        pump.stop()
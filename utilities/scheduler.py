@@ -0,0 +1,155 @@
+import heapq
+import logging
+import threading
+
+from utilities import clock, metrics
+
+JOB_RUN_TIME = metrics.histogram('control_loop_seconds', 'Run time of each periodic control job.', ['plant', 'job'])
+JOB_MISSED = metrics.counter('control_loop_missed_total', 'Releases of each periodic job skipped because it ran late.',
+                             ['plant', 'job'])
+JOB_ERRORS = metrics.counter('control_loop_errors_total', 'Runs of each periodic job that raised an error.',
+                             ['plant', 'job'])
+
+
+class PeriodicJob:
+    """
+    A function run every `period` seconds by a Scheduler, with timing statistics.
+
+    Each run is released at a fixed point of the job's time grid (start + n * period), so a slow run does not
+    shift the following ones. The next release is the deadline of a run: releases that go by before the job
+    gets to run are counted as missed and skipped instead of being run back to back to catch up.
+    """
+
+    def __init__(self, name, function, period, due):
+        """
+        Args:
+            name: Name used in the logs and the statistics.
+            function: Called without arguments at every release.
+            period: Time between two releases (seconds).
+            due: Clock time of the first release.
+        """
+        self.name = name
+        self.function = function
+        self.period = period
+        self.due = due
+        self.runs = 0
+        # Releases skipped because the job could not start before the next one
+        self.missed = 0
+        # Runs that took longer than the period
+        self.overruns = 0
+        self.errors = 0
+        # Delay between the release and the actual start of the runs (seconds)
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_run_time = 0.0
+        self.max_run_time = 0.0
+
+    def run(self, now):
+        """Run the job released at self.due, now being the current clock time, and schedule the next release."""
+        # Plant running the job (see plant_tasks.py), for the metrics
+        plant = getattr(threading.current_thread(), 'plant_name', '')
+        late_periods = int((now - self.due) // self.period)
+        if late_periods > 0:
+            self.missed += late_periods
+            JOB_MISSED.labels(plant, self.name).inc(late_periods)
+            self.due += late_periods * self.period
+        jitter = now - self.due
+        self.total_jitter += jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        try:
+            self.function()
+        except Exception as error:
+            self.errors += 1
+            JOB_ERRORS.labels(plant, self.name).inc()
+            logging.error(f"Job {self.name} failed: {error}")
+        run_time = clock.monotonic() - now
+        JOB_RUN_TIME.labels(plant, self.name).observe(run_time)
+        self.total_run_time += run_time
+        self.max_run_time = max(self.max_run_time, run_time)
+        if run_time > self.period:
+            self.overruns += 1
+        self.runs += 1
+        self.due += self.period
+
+    def stats(self):
+        """Return the timing statistics of the job as a dictionary."""
+        return dict(period=self.period, runs=self.runs, missed=self.missed, overruns=self.overruns,
+                    errors=self.errors, mean_jitter=self.total_jitter / self.runs if self.runs else 0.0,
+                    max_jitter=self.max_jitter, mean_run_time=self.total_run_time / self.runs if self.runs else 0.0,
+                    max_run_time=self.max_run_time)
+
+
+class Scheduler:
+    """
+    Run periodic jobs on the package clock, each at its own period.
+
+    Jobs run one at a time in the thread calling run(), earliest release first; between two releases the
+    scheduler sleeps, so a fast job (pH sampling) no longer waits for the long sleep of a slow one (water
+    level checks).
+    """
+
+    def __init__(self, max_sleep=1.0):
+        """
+        Args:
+            max_sleep: Longest sleep between two checks of the stop event (seconds).
+        """
+        self.max_sleep = max_sleep
+        self.jobs = []
+        # (release time, order added, job) of every job, earliest release first
+        self._queue = []
+
+    def add(self, name, function, period, delay=0.0):
+        """
+        Add a job to the scheduler.
+
+        Args:
+            name: Name of the job.
+            function: Called without arguments every period.
+            period: Time between two runs (seconds).
+            delay: Time from now to the first run (seconds).
+
+        Returns:
+            PeriodicJob: The new job.
+        """
+        job = PeriodicJob(name, function, period, clock.monotonic() + delay)
+        self.jobs.append(job)
+        heapq.heappush(self._queue, (job.due, len(self.jobs), job))
+        return job
+
+    def run_pending(self, stop_event=None):
+        """
+        Run every job whose release time has come, each at most once, so a job running longer than its period
+        can not keep the caller from checking its stop event.
+
+        Args:
+            stop_event: threading.Event checked between two jobs, the jobs left are run on the next call.
+
+        Returns:
+            float: Time until the next release (seconds), None if there are no jobs.
+        """
+        now = clock.monotonic()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue))
+        for index, (release, order, job) in enumerate(due):
+            if stop_event is not None and stop_event.is_set():
+                for entry in due[index:]:
+                    heapq.heappush(self._queue, entry)
+                break
+            job.run(clock.monotonic())
+            heapq.heappush(self._queue, (job.due, order, job))
+        if not self._queue:
+            return None
+        return self._queue[0][0] - clock.monotonic()
+
+    def run(self, stop_event):
+        """Run the jobs until stop_event (threading.Event) is set."""
+        while not stop_event.is_set():
+            wait = self.run_pending(stop_event)
+            if wait is None:
+                wait = self.max_sleep
+            clock.sleep(min(max(wait, 0.0), self.max_sleep))
+
+    def stats(self):
+        """Return job name -> timing statistics."""
+        return {job.name: job.stats() for job in self.jobs}
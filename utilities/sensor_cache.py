@@ -0,0 +1,63 @@
+from utilities import clock
+
+
+class SensorCache:
+    """
+    Keep the last value of each sensor with the time it was read, and hand it back while it is fresh.
+
+    The control loops ask for the same reading several times in a row (to test a condition, then to print it),
+    and every fresh pH/EC reading is a second long I2C transaction, so short-lived snapshots save a lot of bus
+    time. Call invalidate() after running a pump so the next reading reflects the change.
+    """
+
+    def __init__(self, ttl):
+        """
+        Args:
+            ttl: Default time (seconds) a reading stays valid.
+        """
+        self.ttl = ttl
+        # name -> (clock time of the reading, value)
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, read_function, ttl=None):
+        """
+        Return the cached value of a sensor, or read it with read_function if it is missing or too old.
+
+        Failed readings (None) are not cached, so the next call tries the sensor again.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        entry = self._values.get(name)
+        if entry is not None and clock.monotonic() - entry[0] <= ttl:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = read_function()
+        self.put(name, value)
+        return value
+
+    def fresh(self, name, ttl=None):
+        """Return True if the sensor has a value younger than the ttl."""
+        ttl = self.ttl if ttl is None else ttl
+        entry = self._values.get(name)
+        return entry is not None and clock.monotonic() - entry[0] <= ttl
+
+    def put(self, name, value):
+        """Store a reading taken somewhere else (for example by a combined pH and EC query)."""
+        if value is None:
+            self._values.pop(name, None)
+        else:
+            self._values[name] = (clock.monotonic(), value)
+
+    def invalidate(self, *names):
+        """Forget the given sensors, or all of them if no name is given."""
+        if not names:
+            self._values.clear()
+        for name in names:
+            self._values.pop(name, None)
+
+    def snapshot(self):
+        """Return {name: (age in seconds, value)} for every cached reading."""
+        now = clock.monotonic()
+        return {name: (now - timestamp, value) for name, (timestamp, value) in self._values.items()}
@@ -0,0 +1,144 @@
+import collections
+import math
+
+from user_controlled_constants import SETTLE_DETECTION, SETTLE_READ_INTERVAL, SETTLE_WINDOW, SETTLE_THRESHOLDS
+from utilities import clock, tracing
+from utilities.AtlasI2C import get_temp_c, query_many, signal_queries, store_readings
+
+# After a pump run the control code used to sleep a fixed time (the worst case) before measuring again. A settle
+# detector watches the readings instead and releases as soon as they stopped moving: the slope of a straight line
+# fitted to the last readings and their spread around it must both be below thresholds. The fixed time becomes
+# a timeout, so a slow reservoir waits as long as before and a well mixed one stops paying the worst case.
+# Right after a dose the readings have not started moving yet, or move too slowly to show a slope: the detector
+# only releases once the dead time passed and the readings moved out of the noise band around the reading taken
+# before the dose. A dose too small to leave the noise band waits the whole timeout.
+# A full window of readings must fit well inside the timeout or the detector could never release early: the
+# interval, then the window, are shortened until the window takes at most WINDOW_SHARE of the timeout.
+
+# Largest share of the timeout a full window of readings may take
+WINDOW_SHARE = 0.5
+
+
+class SettleDetector:
+    """Decide whether a signal settled from its last `window` readings."""
+
+    def __init__(self, max_slope, max_std, window=SETTLE_WINDOW, min_change=0.0, baseline=None):
+        """
+        Args:
+            max_slope: Largest slope (signal units per second) of a settled signal.
+            max_std: Largest spread (standard deviation, signal units) of the readings around the fitted line.
+            window: Number of readings the decision is made from (at least 3).
+            min_change: Change from baseline (signal units) the readings must show before they can be settled.
+            baseline: Reading taken before the dose, None if nothing was dosed (no change required).
+        """
+        if window < 3:
+            raise ValueError("A settle detector needs a window of at least 3 readings")
+        self.max_slope = max_slope
+        self.max_std = max_std
+        self.min_change = min_change
+        self.baseline = baseline
+        self.samples = collections.deque(maxlen=window)
+
+    def add(self, time, value):
+        """Add a reading taken at clock time `time`, return True if the signal settled."""
+        self.samples.append((time, value))
+        return self.settled()
+
+    def trend(self):
+        """Return (slope, standard deviation) of the readings around their least squares line, None if too few."""
+        count = len(self.samples)
+        if count < 3:
+            return None
+        mean_time = sum(time for time, _ in self.samples) / count
+        mean_value = sum(value for _, value in self.samples) / count
+        spread = sum((time - mean_time) ** 2 for time, _ in self.samples)
+        if spread <= 0:
+            return None
+        slope = sum((time - mean_time) * (value - mean_value) for time, value in self.samples) / spread
+        residuals = sum((value - mean_value - slope * (time - mean_time)) ** 2 for time, value in self.samples)
+        return slope, math.sqrt(residuals / (count - 2))
+
+    def moved(self):
+        """Return True if the mean of the readings left the noise band around the baseline."""
+        if self.baseline is None:
+            return True
+        mean_value = sum(value for _, value in self.samples) / len(self.samples)
+        return abs(mean_value - self.baseline) > self.min_change
+
+    def settled(self):
+        if len(self.samples) < self.samples.maxlen or not self.moved():
+            return False
+        trend = self.trend()
+        return trend is not None and abs(trend[0]) <= self.max_slope and trend[1] <= self.max_std
+
+
+def read_signals(names):
+    """
+    Take a new raw reading of each signal ('ph' and/or 'ec'), both boards converting together when both are
+    asked. The readings still go through the filters and the cache, but the raw values are returned: a filter
+    trusting its estimate lags behind a slow change, which would look settled.
+    """
+    temp_c = get_temp_c()
+    if temp_c is None:
+        return {name: None for name in names}
+    responses = query_many(signal_queries(names, temp_c))
+    return {name: reading for name, (reading, _) in zip(names, store_readings(names, responses))}
+
+
+def fit_window(timeout, read_time, interval=SETTLE_READ_INTERVAL, window=SETTLE_WINDOW):
+    """
+    Return (window, interval) so that window readings taking read_time seconds each, interval seconds apart, last
+    at most WINDOW_SHARE of the timeout (the window never goes below 3 readings).
+    """
+    budget = timeout * WINDOW_SHARE
+    interval = min(interval, max(0.0, budget / window - read_time))
+    cycle = read_time + interval
+    if cycle > 0:
+        window = max(3, min(window, int(budget / cycle)))
+    return window, interval
+
+
+@tracing.traced(category='wait')
+def wait_until_settled(names, timeout, min_time=0.0, interval=SETTLE_READ_INTERVAL, baselines=None):
+    """
+    Wait until the readings of the given signals stopped moving, at most `timeout` seconds.
+
+    Without SETTLE_DETECTION, this is sleep(timeout).
+
+    Args:
+        names: Signals to watch, 'ph' and/or 'ec' (see SETTLE_THRESHOLDS).
+        timeout: Longest wait (seconds), the fixed wait the detector replaces.
+        min_time: Shortest wait (seconds), SETTLE_DEAD_TIME after a dose or a fill.
+        interval: Time (seconds) between the end of a reading and the start of the next one, shortened (and then
+            the window) if a full window would not fit in the timeout (see fit_window).
+        baselines: Signal name -> reading taken before the dose, the readings of these signals must move more than
+            their min_change away from it before they count as settled.
+
+    Returns:
+        bool: True if every signal settled, False if the timeout was reached first.
+    """
+    if not SETTLE_DETECTION:
+        clock.sleep(timeout)
+        return False
+    baselines = baselines or {}
+    detectors = None
+    start = clock.monotonic()
+    while True:
+        read_start = clock.monotonic()
+        readings = read_signals(list(names))
+        now = clock.monotonic()
+        if detectors is None:
+            # The first reading tells how long one takes, size the window from it
+            window, interval = fit_window(timeout, now - read_start, interval)
+            detectors = {name: SettleDetector(window=window, baseline=baselines.get(name), **SETTLE_THRESHOLDS[name])
+                         for name in names}
+        # A failed reading (None) says nothing, the detector waits for more
+        settled = all([detector.add(now, readings[name]) if readings[name] is not None else False
+                       for name, detector in detectors.items()])
+        elapsed = now - start
+        if settled and elapsed >= min_time:
+            return True
+        if elapsed + interval >= timeout:
+            clock.sleep(max(0.0, timeout - elapsed))
+            return False
+        clock.sleep(interval)
@@ -0,0 +1,211 @@
+import math
+
+from utilities import clock
+
+# Streaming filters for the pH, EC and temperature readings. Every new reading of a sensor goes through the
+# filter of its signal (see get_ph/get_ec/get_temp_c in AtlasI2C.py), and the control loops act on the filtered
+# estimate instead of a single noisy sample. Each filter keeps a constant amount of state (an estimate, its
+# variance and the time of the last reading) whatever the number of readings.
+#
+# Pumps change the water on purpose, which the filters must follow instead of smoothing away: disturb() tells a
+# filter the real value is about to move by up to `jump`. The move shows up as the dose mixes in, so the filter
+# opens up over the mix_time that follows (exponentially, like the mixing itself) rather than all at once.
+
+
+class StreamingFilter:
+    """Base class of the filters, subclasses implement _update()."""
+
+    def __init__(self, jump=0.0, mix_time=20.0):
+        """
+        Args:
+            jump: Largest change (signal units) a pump run is expected to cause.
+            mix_time: Time constant (seconds) of the mixing of a dose into the reservoir.
+        """
+        self.jump = jump
+        self.mix_time = mix_time
+        self.reset()
+
+    def reset(self):
+        """Forget every reading."""
+        self.value = None
+        self.variance = None
+        self.count = 0
+        self._updated_at = None
+        # Variance of the disturbances announced by disturb() that did not show up yet
+        self._pending_disturbance = 0.0
+
+    @property
+    def std(self):
+        """Standard deviation of the estimate (signal units), None before the first reading."""
+        return None if self.variance is None else math.sqrt(self.variance)
+
+    def disturb(self):
+        """Announce that a pump changed the water, the next readings may move by up to `jump`."""
+        self._pending_disturbance += self.jump * self.jump
+
+    def _released_disturbance(self, elapsed):
+        """Return the variance of the disturbances that mixed in during `elapsed` seconds, and forget it."""
+        if not self._pending_disturbance:
+            return 0.0
+        share = 1.0 if self.mix_time <= 0 else 1 - math.exp(-elapsed / self.mix_time)
+        released = self._pending_disturbance * share
+        self._pending_disturbance -= released
+        return released
+
+    def update(self, reading, now=None):
+        """
+        Add a reading and return the new estimate.
+
+        Args:
+            reading: The raw sensor value.
+            now: Clock time of the reading (clock.monotonic() if None).
+        """
+        now = clock.monotonic() if now is None else now
+        if self.value is None:
+            self._pending_disturbance = 0.0
+            self.value = float(reading)
+            self._first(reading)
+        else:
+            self._update(float(reading), max(0.0, now - self._updated_at))
+        self._updated_at = now
+        self.count += 1
+        return self.value
+
+    def _first(self, reading):
+        raise NotImplementedError
+
+    def _update(self, reading, elapsed):
+        raise NotImplementedError
+
+
+class EMAFilter(StreamingFilter):
+    """
+    Exponential moving average: each reading moves the estimate by alpha of its distance to it.
+
+    The confidence comes from an exponentially weighted variance of the readings around the estimate. After a
+    disturbance the weight of the new readings is raised for a while so the average catches up with the change.
+    """
+
+    def __init__(self, alpha=0.3, noise=0.0, jump=0.0, mix_time=20.0):
+        """
+        Args:
+            alpha: Weight of each new reading (1 keeps only the last reading).
+            noise: Standard deviation of the sensor noise, the starting spread of the readings.
+            jump: Largest change a pump run is expected to cause.
+            mix_time: Time constant (seconds) of the mixing of a dose.
+        """
+        self.alpha = alpha
+        self.noise = noise
+        super().__init__(jump, mix_time)
+
+    def _first(self, reading):
+        self._spread = self.noise * self.noise
+        self.variance = self._spread
+
+    def _update(self, reading, elapsed):
+        residual = reading - self.value
+        disturbance = self._released_disturbance(elapsed)
+        # Trust the reading more while a disturbance is larger than the usual spread of the readings
+        alpha = max(self.alpha, disturbance / (disturbance + self._spread)) if disturbance else self.alpha
+        self.value += alpha * residual
+        self._spread = (1 - self.alpha) * (self._spread + self.alpha * residual * residual)
+        # Variance of an exponential average of readings spread that much
+        self.variance = self._spread * alpha / (2 - alpha)
+
+
+class KalmanFilter(StreamingFilter):
+    """
+    One dimensional Kalman filter for a value that drifts slowly (a random walk) measured by a noisy sensor.
+
+    The variance of the estimate grows with the time between readings (drift) and with the disturbances of the
+    pumps, and shrinks with every reading, so readings are averaged while nothing happens and followed closely
+    right after a dose. A reading farther than `gate` standard deviations from the estimate is taken as a real
+    change nothing announced (a refill by hand, a sensor moved): the filter restarts from it.
+    """
+
+    def __init__(self, noise, drift, jump=0.0, mix_time=20.0, gate=6.0):
+        """
+        Args:
+            noise: Standard deviation of the sensor noise (signal units).
+            drift: How fast the real value may wander, standard deviation per square root of a second.
+            jump: Largest change a pump run is expected to cause.
+            mix_time: Time constant (seconds) of the mixing of a dose.
+            gate: Distance (in standard deviations) past which a reading restarts the filter, None to never.
+        """
+        self.noise = noise
+        self.drift = drift
+        self.gate = gate
+        super().__init__(jump, mix_time)
+
+    def _first(self, reading):
+        self.variance = self.noise * self.noise
+
+    def _update(self, reading, elapsed):
+        measurement_variance = self.noise * self.noise
+        # Predict: the value may have drifted and the doses mixed in since the last reading
+        variance = self.variance + self.drift * self.drift * elapsed + self._released_disturbance(elapsed)
+        residual = reading - self.value
+        if self.gate is not None and residual * residual > self.gate * self.gate * (variance + measurement_variance):
+            self.value = reading
+            self.variance = measurement_variance
+            return
+        # Correct: weigh the reading against the prediction
+        gain = variance / (variance + measurement_variance)
+        self.value += gain * residual
+        self.variance = (1 - gain) * variance
+
+
+# Filter kinds accepted in SENSOR_FILTERS of user_controlled_constants.py
+FILTER_KINDS = {
+    'ema': EMAFilter,
+    'kalman': KalmanFilter,
+}
+
+
+def make_filter(settings):
+    """Return a new filter from a {'kind': ..., <arguments of the filter>} dictionary, None for no filtering."""
+    if not settings:
+        return None
+    settings = dict(settings)
+    kind = settings.pop('kind')
+    try:
+        return FILTER_KINDS[kind](**settings)
+    except KeyError:
+        raise ValueError("Unknown sensor filter %r, use one of %s" % (kind, ', '.join(FILTER_KINDS)))
+
+
+class SignalFilters:
+    """The filters of all the signals of one reservoir, by signal name ('ph', 'ec', 'temp_c')."""
+
+    def __init__(self, settings):
+        """
+        Args:
+            settings: {signal name: filter settings (see make_filter), None to pass the readings through}.
+        """
+        self.filters = {name: make_filter(signal_settings) for name, signal_settings in settings.items()}
+
+    def update(self, name, reading):
+        """Filter a new reading of a signal and return the estimate (the reading itself if not filtered)."""
+        signal_filter = self.filters.get(name)
+        if signal_filter is None or reading is None:
+            return reading
+        return signal_filter.update(reading)
+
+    def estimate(self, name):
+        """Return (estimate, standard deviation) of a signal, (None, None) before its first filtered reading."""
+        signal_filter = self.filters.get(name)
+        if signal_filter is None:
+            return None, None
+        return signal_filter.value, signal_filter.std
+
+    def disturb(self, *names):
+        """Announce that a pump changed the given signals."""
+        for name in names:
+            signal_filter = self.filters.get(name)
+            if signal_filter is not None:
+                signal_filter.disturb()
+
+    def reset(self):
+        for signal_filter in self.filters.values():
+            if signal_filter is not None:
+                signal_filter.reset()
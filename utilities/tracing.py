@@ -0,0 +1,127 @@
+import collections
+import functools
+import json
+import os
+import threading
+
+from file_operations.plant_vals_file_manager import BASE_DIRECTORY, atomic_write
+from user_controlled_constants import TRACING_ENABLED, TRACE_BUFFER_SIZE, TRACE_FILE
+from utilities import clock
+
+# Phase level tracing: the control code wraps its phases (fill_water, dose_nutrients, the settle waits...) and
+# every I2C transaction in spans. A finished span is one event in a bounded in-memory buffer, the oldest events
+# are dropped once it is full. export_chrome_trace() writes the buffer as Chrome trace-event JSON, to open in
+# chrome://tracing or https://ui.perfetto.dev and see where the time of a refill cycle goes, one row per plant
+# thread. Times come from the package clock, so simulated runs are traced in simulated time.
+
+
+class Tracer:
+    """Bounded buffer of finished spans."""
+
+    def __init__(self, capacity=TRACE_BUFFER_SIZE):
+        """
+        Args:
+            capacity: Number of spans kept, the oldest ones are dropped first.
+        """
+        self.events = collections.deque(maxlen=capacity)
+        # thread id -> thread name, for the row names of the trace
+        self._threads = {}
+
+    def record(self, name, category, start, duration, args=None):
+        """Add a finished span (start and duration in clock seconds)."""
+        thread = threading.current_thread()
+        self._threads.setdefault(thread.ident, thread.name)
+        # deque.append is atomic, spans of several threads can be recorded without a lock
+        self.events.append((name, category, start, duration, thread.ident, args))
+
+    def clear(self):
+        self.events.clear()
+
+    def chrome_trace(self):
+        """Return the spans as a Chrome trace-event dictionary ({'traceEvents': [...]})."""
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in list(self._threads.items())]
+        for name, category, start, duration, tid, args in list(self.events):
+            event = {'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round(start * 1e6, 3), 'dur': round(duration * 1e6, 3)}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path=os.path.join(BASE_DIRECTORY, TRACE_FILE)):
+        """Write the spans to path as Chrome trace-event JSON and return the path."""
+        atomic_write(path, json.dumps(self.chrome_trace()))
+        return path
+
+
+class Span:
+    """Context manager timing one span, recorded when it ends (with the error type if it raised)."""
+
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = clock.monotonic()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is not None:
+            self.args = dict(self.args or {}, error=error_type.__name__)
+        self.tracer.record(self.name, self.category, self.start, clock.monotonic() - self.start, self.args)
+        return False
+
+
+class NullSpan:
+    """Stands for every span while tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+tracer = Tracer()
+enabled = TRACING_ENABLED
+
+
+def span(name, category='phase', **args):
+    """
+    Return a context manager recording the time spent in its block as a span:
+
+        with tracing.span('fill_water', target=9.5):
+            ...
+    """
+    if not enabled:
+        return NULL_SPAN
+    return Span(tracer, name, category, args or None)
+
+
+def traced(name=None, category='phase'):
+    """Decorator recording every call of a function as a span (named after the function by default)."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(tracer, span_name, category, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def export_chrome_trace(path=os.path.join(BASE_DIRECTORY, TRACE_FILE)):
+    """Write the spans recorded so far as Chrome trace-event JSON, see Tracer.export_chrome_trace()."""
+    return tracer.export_chrome_trace(path)
@@ -0,0 +1,261 @@
+import collections
+import os
+import struct
+import sys
+import threading
+
+from file_operations.plant_vals_file_manager import BASE_DIRECTORY
+from user_controlled_constants import TRAFFIC_LOG_FILE
+from utilities import clock
+
+# Recording of the raw traffic between the controller and its devices: every write and read of the Atlas boards,
+# every ADS1115 conversion (by channel), every read of the 1-wire temperature probe and every pump start and stop,
+# each stamped with the clock time it completed at. A field problem (a pH loop oscillating overnight) recorded on
+# the Pi can then be fed back into the control code at a desk, see simulation/replay.py.
+#
+# File layout: a header, then variable size records appended one after the other.
+# Header: magic, format version, wall clock time and monotonic time when the recording started
+HEADER_FORMAT = struct.Struct('<4sHdd')
+MAGIC = b'HTRC'
+VERSION = 1
+# Record: monotonic timestamp, kind, device (I2C address, ADC channel or pump id), payload length, then the payload
+RECORD_FORMAT = struct.Struct('<dBBH')
+# Payload length of a record without payload (a missing temperature probe), told apart from an empty one
+NO_PAYLOAD = 0xFFFF
+
+TRAFFIC_LOG_PATH = os.path.join(BASE_DIRECTORY, TRAFFIC_LOG_FILE)
+
+# Record kinds and their payloads
+I2C_WRITE = 1     # bytes written
+I2C_READ = 2      # bytes read, without the trailing NUL padding of the Atlas answers
+I2C_ERROR = 3     # errno of the failed transaction ('<H')
+ADC_READ = 4      # raw conversion ('<h')
+TEMP_READ = 5     # text line of the probe, no payload if the probe is missing
+PUMP_START = 6    # throttle ('<b', 1 or -1)
+PUMP_STOP = 7     # nothing
+KIND_NAMES = {I2C_WRITE: 'i2c write', I2C_READ: 'i2c read', I2C_ERROR: 'i2c error', ADC_READ: 'adc read',
+              TEMP_READ: 'temp read', PUMP_START: 'pump start', PUMP_STOP: 'pump stop'}
+
+ERRNO_FORMAT = struct.Struct('<H')
+ADC_FORMAT = struct.Struct('<h')
+THROTTLE_FORMAT = struct.Struct('<b')
+
+TrafficRecord = collections.namedtuple('TrafficRecord', 'timestamp kind device payload')
+TrafficLog = collections.namedtuple('TrafficLog', 'wall_time start records')
+
+
+class TrafficRecorder:
+    """
+    Append only binary log of the device traffic.
+
+    Records are a 12 byte header plus their payload (one Atlas reading is about 30 bytes, one ADC conversion 14),
+    written through a buffered file under a lock, so several plant threads can record at once.
+    """
+
+    def __init__(self, path=TRAFFIC_LOG_PATH):
+        """
+        Args:
+            path: File the traffic is written to, replaced if it exists.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'wb')
+        self._file.write(HEADER_FORMAT.pack(MAGIC, VERSION, clock.wall_time(), clock.monotonic()))
+        self._lock = threading.Lock()
+        # Number of records written
+        self.count = 0
+
+    def record(self, kind, device, payload=b''):
+        """Append one record stamped with the current clock time (payload None for 'no data')."""
+        timestamp = clock.monotonic()
+        length = NO_PAYLOAD if payload is None else len(payload)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD_FORMAT.pack(timestamp, kind, device, length))
+            if payload:
+                self._file.write(payload)
+            self.count += 1
+
+    def record_pump(self, pump, running):
+        """Pump listener (see Pump.listeners) recording every start and stop."""
+        from file_operations.telemetry_ring import pump_id_of
+        if running:
+            self.record(PUMP_START, pump_id_of(pump), THROTTLE_FORMAT.pack(1 if pump.direction * running > 0 else -1))
+        else:
+            self.record(PUMP_STOP, pump_id_of(pump))
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class RecordingI2CDevice:
+    """Transport of one Atlas board (an I2CDeviceTransport) recording its writes, reads and bus errors."""
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    @property
+    def address(self):
+        return self.transport.address
+
+    def set_address(self, address):
+        self.transport.set_address(address)
+
+    def write(self, data):
+        try:
+            self.transport.write(data)
+        except IOError as error:
+            self.recorder.record(I2C_ERROR, self.address, ERRNO_FORMAT.pack(error.errno or 0))
+            raise
+        self.recorder.record(I2C_WRITE, self.address, bytes(data))
+
+    def read(self, num_of_bytes):
+        try:
+            data = self.transport.read(num_of_bytes)
+        except IOError as error:
+            self.recorder.record(I2C_ERROR, self.address, ERRNO_FORMAT.pack(error.errno or 0))
+            raise
+        # The boards pad their answers with NULs up to the requested length, the replay pads them back
+        self.recorder.record(I2C_READ, self.address, bytes(data).rstrip(b'\x00'))
+        return data
+
+    def close(self):
+        self.transport.close()
+
+
+class RecordingADC:
+    """ADS1115 wrapper recording every conversion with its channel."""
+
+    def __init__(self, adc, recorder):
+        self.adc = adc
+        self.recorder = recorder
+        # Channel converted in continuous mode
+        self._channel = None
+
+    def _recorded(self, channel, value):
+        self.recorder.record(ADC_READ, channel, ADC_FORMAT.pack(value))
+        return value
+
+    def read_adc(self, channel, gain=1):
+        return self._recorded(channel, self.adc.read_adc(channel, gain=gain))
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        self._channel = channel
+        return self._recorded(channel, self.adc.start_adc(channel, gain=gain, data_rate=data_rate))
+
+    def get_last_result(self):
+        return self._recorded(self._channel, self.adc.get_last_result())
+
+    def stop_adc(self):
+        self._channel = None
+        self.adc.stop_adc()
+
+
+class RecordingTemperatureSensor:
+    """1-wire probe wrapper recording every line read (or the missing probe)."""
+
+    def __init__(self, sensor, recorder):
+        self.sensor = sensor
+        self.recorder = recorder
+
+    def readline(self):
+        line = self.sensor.readline()
+        self.recorder.record(TEMP_READ, 0, None if line is None else line.encode('ascii'))
+        return line
+
+
+def record_device(name, device, recorder):
+    """
+    Return the device of a HardwareContext (see RECORDED_DEVICES in utilities/hardware.py) set up to record its
+    traffic with recorder.
+    """
+    if name in ('ph_sensor', 'ec_sensor'):
+        device.transport = RecordingI2CDevice(device.transport, recorder)
+        return device
+    if name == 'adc':
+        return RecordingADC(device, recorder)
+    if name == 'temp_sensor':
+        return RecordingTemperatureSensor(device, recorder)
+    raise ValueError("No traffic recording for the %r device" % name)
+
+
+# One recorder per file, shared by the hardware contexts of every plant
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def get_traffic_recorder(path=TRAFFIC_LOG_PATH):
+    """Return the shared recorder writing to path, created (and the file replaced) on first use."""
+    with _recorders_lock:
+        if path not in _recorders:
+            import atexit
+            _recorders[path] = TrafficRecorder(path)
+            atexit.register(_recorders[path].close)
+        return _recorders[path]
+
+
+def load_traffic(path=TRAFFIC_LOG_PATH):
+    """
+    Read a traffic log.
+
+    A record cut short (the controller lost power while writing it) ends the log.
+
+    Returns:
+        TrafficLog: wall clock and monotonic time of the start of the recording, and the list of TrafficRecord.
+    """
+    with open(path, 'rb') as traffic_file:
+        data = traffic_file.read()
+    if len(data) < HEADER_FORMAT.size:
+        raise ValueError("%s is not a traffic log" % path)
+    magic, version, wall_time, start = HEADER_FORMAT.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("%s is not a traffic log" % path)
+    if version != VERSION:
+        raise ValueError("%s uses an unsupported traffic log format (version %d)" % (path, version))
+    records = []
+    offset = HEADER_FORMAT.size
+    while offset + RECORD_FORMAT.size <= len(data):
+        timestamp, kind, device, length = RECORD_FORMAT.unpack_from(data, offset)
+        offset += RECORD_FORMAT.size
+        if length == NO_PAYLOAD:
+            payload = None
+        else:
+            if offset + length > len(data):
+                break
+            payload = data[offset:offset + length]
+            offset += length
+        records.append(TrafficRecord(timestamp, kind, device, payload))
+    return TrafficLog(wall_time, start, records)
+
+
+def format_record(record, start=0.0):
+    kind = KIND_NAMES.get(record.kind, 'kind %d' % record.kind)
+    if record.kind in (I2C_WRITE, I2C_READ):
+        detail = "0x%02x %r" % (record.device, record.payload)
+    elif record.kind == I2C_ERROR:
+        detail = "0x%02x errno %d" % (record.device, ERRNO_FORMAT.unpack(record.payload)[0])
+    elif record.kind == ADC_READ:
+        detail = "channel %d %d" % (record.device, ADC_FORMAT.unpack(record.payload)[0])
+    elif record.kind == TEMP_READ:
+        detail = "missing" if record.payload is None else record.payload.decode('ascii').strip()
+    else:
+        from utilities.pumps import PUMP_NAMES
+        detail = PUMP_NAMES[record.device - 1] if 0 < record.device <= len(PUMP_NAMES) else str(record.device)
+    return "%10.3f %-10s %s" % (record.timestamp - start, kind, detail)
+
+
+if __name__ == "__main__":
+    # Print a traffic log: python -m utilities.traffic_log [file]
+    traffic = load_traffic(sys.argv[1] if len(sys.argv) > 1 else TRAFFIC_LOG_PATH)
+    for traffic_record in traffic.records:
+        print(format_record(traffic_record, traffic.start))